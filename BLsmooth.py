@@ -49,6 +49,14 @@ def addcol(ms, incol, outcol):
 
 
 def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
+    """
+    Smooth one baseline, see smooth().
+    """
+    data, weights = smooth(data, weights, std_t, std_f)
+    outQueue.put([in_bl, data, weights])
+
+
+def smooth(data, weights, std_t, std_f):
     """
     Smooth one baseline.
     Multiply every element of the data by the weights, convolve both the
@@ -60,8 +68,6 @@ def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
 
     Parameters
     ----------
-    in_bl: boolean ndarray
-        Mask for everything not in this baseline.
     data: ndarray
         Data for one baseline that is to be smoothed.
     weights: ndarray
@@ -73,8 +79,6 @@ def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
 
     Returns
     -------
-    in_bl: boolean ndarray
-        Mask for everything not in this baseline.
     data: ndarray.
         Smoothed ata for one baseline.
     weights: ndarray
@@ -82,7 +86,7 @@ def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
     """
     data = np.nan_to_num(data * weights) # set bad data to 0 so nans don't propagate
     if np.isnan(data).all():
-        return in_bl, data, weights # flagged ants
+        return data, weights # flagged ants
     # smear weighted data and weights
     if options.onlyamp: # smooth only amplitudes
         dataAMP, dataPH = np.abs(data), np.angle(data)
@@ -110,7 +114,31 @@ def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
     # print( "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags[in_bl]])))
     # print( "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags[in_bl]])))
     # print( "NANs in weights: ", np.count_nonzero(np.isnan(weights)))
-    outQueue.put([in_bl, data, weights])
+    return data, weights
+
+
+def smooth_baseline_shm(slot, data, weights, i_bl, std_t, std_f, outQueue=None):
+    """
+    Smooth in place one baseline loaded in shared memory (see --stream).
+    data, weights: lib_multiproc.SharedArray
+    """
+    data.array[:], weights.array[:] = smooth(data.array, weights.array, std_t, std_f)
+    outQueue.put([slot, i_bl])
+
+
+def get_std(dist):
+    """
+    Return the std of the gaussian smoothing kernel in time and freq (in samples) for a baseline length in km.
+    """
+    std_t = options.ionfactor * (25.e3 / dist) ** options.bscalefactor * (freq / 60.e6)  # in sec
+    std_t = std_t / timepersample  # in samples
+    # TODO: for freq this is hardcoded, it should be thought better
+    # However, the limitation is probably smearing here
+    std_f = 1e6 / dist  # Hz
+    std_f = std_f / freqpersample  # in samples
+    logging.debug("-Time: sig={:.1f} samples ({:.1f}s) -Freq: sig={:.1f} samples ({:.2f}MHz)".format(
+        std_t, timepersample * std_t, std_f, freqpersample * std_f / 1e6))
+    return std_t, std_f
 
 
 
@@ -127,6 +155,8 @@ opt.add_option('-t', '--notime', help='Do not do smoothing in time [default: Fal
 opt.add_option('-q', '--nofreq', help='Do not do smoothing in frequency [default: False]', action="store_true", default=False)
 opt.add_option('-c', '--chunks', help='Split the I/O in n chunks. If you run out of memory, set this to a value > 2.', default=8, type='int')
 opt.add_option('-n', '--ncpu', help='Number of cores', default=4, type='int')
+opt.add_option('-S', '--stream', help='Stream one baseline at a time from the MS through shared memory, memory use is fixed and independent of --chunks [default: False]', action="store_true", default=False)
+opt.add_option('-p', '--prefetch', help='With --stream, number of baselines kept in memory [default: 2*ncpu]', default=None, type='int')
 (options, msfile) = opt.parse_args()
 
 if msfile == []:
@@ -167,62 +197,113 @@ if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
 elif options.weight and not options.nobackup:
     addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
 
-# Iterate over chunks of baselines
-for c, idx in enumerate(np.array_split(np.arange(n_bl), options.chunks)):
-    logging.debug('### Fetching chunk {}/{}'.format(c+1,options.chunks))
-
-    # get input data for this chunk
-    ants1_chunk, ants2_chunk = ants1[idx], ants2[idx]
-    chunk = pt.taql("SELECT FROM $ms WHERE any(ANTENNA1== $ants1_chunk && ANTENNA2==$ants2_chunk)")
-    data_chunk = chunk.getcol(options.incol)
-    weights_chunk = chunk.getcol('WEIGHT_SPECTRUM')
-    # flag NaNs and set weights to zero
-    flags = chunk.getcol('FLAG')
-    flags[np.isnan(data_chunk)] = True
-    weights_chunk[flags] = 0
-    del flags
-    # prepare output cols
-    smoothed_data = data_chunk.copy()
-    if options.weight:
-        new_weights = np.zeros_like(weights_chunk)
-
-    # Iterate on each baseline in this chunk
-    mpm = multiprocManager(options.ncpu, smooth_baseline)
-    for i_chunk, (ant1, ant2, dist) in enumerate(zip(ants1_chunk, ants2_chunk, dists[idx])):
+if options.stream:
+    # baselines to smooth
+    jobs = []
+    for i_bl, (ant1, ant2, dist) in enumerate(zip(ants1, ants2, dists)):
         if ant1 == ant2:
             continue  # skip autocorrelations
         elif np.isnan(dist):
             continue  # fix for missing antennas
-        logging.debug('Working on baseline: {} - {} (dist = {:.2f}km)'.format(ant1, ant2, dist))
-
-        in_bl = slice(i_chunk, -1, len(ants1_chunk))  # All times for 1 BL
-        data, weights= data_chunk[in_bl], weights_chunk[in_bl]
-
-        std_t = options.ionfactor * (25.e3 / dist) ** options.bscalefactor * (freq / 60.e6)  # in sec
-        std_t = std_t / timepersample  # in samples
-        # TODO: for freq this is hardcoded, it should be thought better
-        # However, the limitation is probably smearing here
-        std_f = 1e6 / dist  # Hz
-        std_f = std_f / freqpersample  # in samples
-        logging.debug("-Time: sig={:.1f} samples ({:.1f}s) -Freq: sig={:.1f} samples ({:.2f}MHz)".format(
-            std_t, timepersample * std_t, std_f, freqpersample * std_f / 1e6))
+        logging.debug('Baseline: {} - {} (dist = {:.2f}km)'.format(ant1, ant2, dist))
+        std_t, std_f = get_std(dist)
         if std_t < 0.5: continue  # avoid very small smoothing and flagged ants
-        # fill queue
-        mpm.put([in_bl, data, weights, std_t, std_f])
+        jobs.append([i_bl, std_t, std_f])
 
-    mpm.wait() # run queue
-    # reconstruct chunk column
-    for in_bl, data, weights in mpm.get():
-        smoothed_data[in_bl] = data
-        if options.weight:
-            new_weights[in_bl] = weights
-    # write to ms
-    logging.info('Writing %s column.' % options.outcol)
-    chunk.putcol(options.outcol, smoothed_data)
+    # a fixed number of shared memory slots, each one holding data and weights of one baseline
+    # the MS is time-ordered, so all times of a baseline are every n_bl rows
+    nslots = options.prefetch if options.prefetch is not None else 2*options.ncpu
+    nslots = max(1, min(nslots, len(jobs)))
+    data = ms.getcol(options.incol, startrow=0, nrow=n_t, rowincr=n_bl)
+    weights = ms.getcol('WEIGHT_SPECTRUM', startrow=0, nrow=n_t, rowincr=n_bl)
+    logging.info('Streaming %i baselines using %i slots of %.1f MB.' % (len(jobs), nslots, (data.nbytes+weights.nbytes)/1024**2))
     if options.weight:
         logging.warning('Writing WEIGHT_SPECTRUM column.')
-        chunk.putcol('WEIGHT_SPECTRUM', new_weights)
-    chunk.close()
+
+    with multiprocManager(options.ncpu, smooth_baseline_shm) as mpm:
+        slots = [(mpm.shared_array(data.shape, data.dtype), mpm.shared_array(weights.shape, weights.dtype)) for slot in range(nslots)]
+        del data, weights
+        free_slots = list(range(nslots))
+        to_read = iter(jobs)
+        n_done = 0
+        while n_done < len(jobs):
+            # prefetch: read new baselines in all the free slots, workers start as soon as one is queued
+            while len(free_slots) > 0:
+                job = next(to_read, None)
+                if job is None: break
+                slot = free_slots.pop()
+                i_bl, std_t, std_f = job
+                data, weights = slots[slot]
+                ms.getcolnp(options.incol, data.array, startrow=i_bl, nrow=n_t, rowincr=n_bl)
+                ms.getcolnp('WEIGHT_SPECTRUM', weights.array, startrow=i_bl, nrow=n_t, rowincr=n_bl)
+                # flag NaNs and set weights to zero
+                flags = ms.getcol('FLAG', startrow=i_bl, nrow=n_t, rowincr=n_bl)
+                flags[np.isnan(data.array)] = True
+                weights.array[flags] = 0
+                del flags
+                mpm.put([slot, data, weights, i_bl, std_t, std_f])
+            # write back one smoothed baseline while the others are processed
+            slot, i_bl = mpm.get_one()
+            data, weights = slots[slot]
+            ms.putcol(options.outcol, data.array, startrow=i_bl, nrow=n_t, rowincr=n_bl)
+            if options.weight:
+                ms.putcol('WEIGHT_SPECTRUM', weights.array, startrow=i_bl, nrow=n_t, rowincr=n_bl)
+            free_slots.append(slot)
+            n_done += 1
+            logging.debug('Done baseline {}/{}'.format(n_done, len(jobs)))
+        mpm.wait()
+
+else:
+    # the same workers are used for all chunks
+    mpm = multiprocManager(options.ncpu, smooth_baseline)
+    # Iterate over chunks of baselines
+    for c, idx in enumerate(np.array_split(np.arange(n_bl), options.chunks)):
+        logging.debug('### Fetching chunk {}/{}'.format(c+1,options.chunks))
+
+        # get input data for this chunk
+        ants1_chunk, ants2_chunk = ants1[idx], ants2[idx]
+        chunk = pt.taql("SELECT FROM $ms WHERE any(ANTENNA1== $ants1_chunk && ANTENNA2==$ants2_chunk)")
+        data_chunk = chunk.getcol(options.incol)
+        weights_chunk = chunk.getcol('WEIGHT_SPECTRUM')
+        # flag NaNs and set weights to zero
+        flags = chunk.getcol('FLAG')
+        flags[np.isnan(data_chunk)] = True
+        weights_chunk[flags] = 0
+        del flags
+        # prepare output cols
+        smoothed_data = data_chunk.copy()
+        if options.weight:
+            new_weights = np.zeros_like(weights_chunk)
+
+        # Iterate on each baseline in this chunk
+        for i_chunk, (ant1, ant2, dist) in enumerate(zip(ants1_chunk, ants2_chunk, dists[idx])):
+            if ant1 == ant2:
+                continue  # skip autocorrelations
+            elif np.isnan(dist):
+                continue  # fix for missing antennas
+            logging.debug('Working on baseline: {} - {} (dist = {:.2f}km)'.format(ant1, ant2, dist))
+
+            in_bl = slice(i_chunk, -1, len(ants1_chunk))  # All times for 1 BL
+            data, weights= data_chunk[in_bl], weights_chunk[in_bl]
+
+            std_t, std_f = get_std(dist)
+            if std_t < 0.5: continue  # avoid very small smoothing and flagged ants
+            # fill queue
+            mpm.put([in_bl, data, weights, std_t, std_f])
+
+        # reconstruct chunk column as results arrive
+        for in_bl, data, weights in mpm.get():
+            smoothed_data[in_bl] = data
+            if options.weight:
+                new_weights[in_bl] = weights
+        # write to ms
+        logging.info('Writing %s column.' % options.outcol)
+        chunk.putcol(options.outcol, smoothed_data)
+        if options.weight:
+            logging.warning('Writing WEIGHT_SPECTRUM column.')
+            chunk.putcol('WEIGHT_SPECTRUM', new_weights)
+        chunk.close()
+    mpm.wait()
 
 ms.close()
 logging.info("Done.")
@@ -24,11 +24,80 @@
 
 
 import os, sys, optparse
-from numpy import sin, cos
 import tables
 import casacore.tables as pt
 import numpy as np
 
+def get_soltab(soltab, direction):
+    """
+    Return values and weights of a soltab for one direction with shape (ant, time, freq),
+    other axes (e.g. pol) are taken at their first element
+    and the time and freq grids of the solutions (freq is None if there is no freq axis)
+    """
+    axes = soltab.val.attrs['AXES']
+    if isinstance(axes, bytes): axes = axes.decode()
+    axes = axes.split(',')
+    vals = soltab.val[:]
+    weights = soltab.weight[:]
+    idx = tuple(direction if ax == 'dir' else slice(None) if ax in ['ant','time','freq'] else 0 for ax in axes)
+    vals = vals[idx]
+    weights = weights[idx]
+    axes = [ax for ax in axes if ax in ['ant','time','freq']]
+    if not 'freq' in axes:
+        vals = vals[..., np.newaxis]
+        weights = weights[..., np.newaxis]
+        axes.append('freq')
+    order = [axes.index(ax) for ax in ['ant','time','freq']]
+    freqs = soltab.freq[:] if 'freq' in soltab else None
+    return np.transpose(vals, order), np.transpose(weights, order), soltab.time[:], freqs
+
+def interp_index(x, xp, mode='nearest'):
+    """
+    Indices and fractions to interpolate a grid xp on the points x: v(x) = v[i0]*(1-f) + v[i1]*f
+    mode: nearest or linear, outside the grid the edge values are used
+    """
+    if xp is None or len(xp) == 1:
+        zero = np.zeros(len(x), dtype=int)
+        return zero, zero, np.zeros(len(x))
+    i1 = np.clip(np.searchsorted(xp, x), 1, len(xp)-1)
+    i0 = i1-1
+    f = np.clip((x - xp[i0])/(xp[i1] - xp[i0]), 0, 1)
+    if mode == 'nearest': f = np.round(f)
+    return i0, i1, f
+
+def interp_sols(vals, weights, tidx, fidx, phasor=False):
+    """
+    Interpolate solutions (ant, time, freq) on the MS grid with the output of interp_index()
+    phasor: interpolate exp(1j*vals) and return the angle (for phases)
+    Return values and a bool array (False where a solution used has weight 0), shape (ant, MS time, MS freq)
+    """
+    (t0, t1, ft), (f0, f1, ff) = tidx, fidx
+    ft = ft[:, np.newaxis]
+    if phasor: vals = np.exp(1j*vals)
+    valid = (weights != 0)
+    out = 0
+    ok = True
+    for ti, wt in [(t0, 1-ft), (t1, ft)]:
+        for fi, wf in [(f0, 1-ff), (f1, ff)]:
+            w = wt*wf
+            out = out + vals[:, ti][:, :, fi] * w
+            ok = ok & ( valid[:, ti][:, :, fi] | (w == 0) )
+    if phasor: out = np.angle(out)
+    return out, ok
+
+def iter_timeblocks(t, ntimes=10):
+    """
+    Yield a table sorted in time (writes go to the MS), the first row and number of rows of blocks of ntimes timesteps
+    """
+    times = t.getcol('TIME')
+    if not np.all(np.diff(times) >= 0):
+        t = t.sort('TIME')
+        times = t.getcol('TIME')
+    start = np.append(np.flatnonzero(np.r_[True, times[1:] != times[:-1]]), len(times))
+    for i in range(0, len(start)-1, ntimes):
+        j = min(i+ntimes, len(start)-1)
+        yield t, start[i], start[j]-start[i]
+
 opt = optparse.OptionParser()
 opt.add_option('-i','--inms',help='Input MS',default='')
 opt.add_option('--incol',help='Input column',default='DATA')
@@ -36,6 +105,8 @@ opt.add_option('--outcol',help='Output column',default='CORRECTED_DATA')
 opt.add_option('--inh5',help='Input H5parm',default='')
 opt.add_option('-d','--dir',help='Direction (string)',default=None)
 opt.add_option('-c','--corrupt',action="store_true",default=False,help='Corrupt')
+opt.add_option('--interp',help='Interpolation of the solutions on the MS time/freq grid: nearest or linear (default: nearest)',default='nearest')
+opt.add_option('--ntimes',type='int',help='Timesteps processed at once (default: 10)',default=10)
 o, args = opt.parse_args()
 
 t = pt.table(o.inms, readonly=False)
@@ -43,50 +114,47 @@ h5 = tables.open_file(o.inh5)
 soltab_tec = h5.root.sol000.tec000
 soltab_csp = h5.root.sol000.scalarphase000
 directions = h5.root.sol000.source
-direction = np.argwhere(directions[:]['name'] == o.dir)[0][0]
+direction = np.argwhere(np.char.decode(directions[:]['name'].astype(bytes)) == o.dir)[0][0]
 
 print("Applying dir %s" % h5.root.sol000.tec000.dir[direction])
 #print "CSP HAVE A MINUS TO COMPENSATE NDPPP BUG"
 
-sols_tec = np.squeeze(soltab_tec.val) # remove freq axis with squeeze
-wgts_tec = np.squeeze(soltab_tec.weight)
-sols_csp = np.squeeze(soltab_csp.val)
-wgts_csp = np.squeeze(soltab_csp.weight)
+sols_tec, wgts_tec, times_tec, freqs_tec = get_soltab(soltab_tec, direction)
+sols_csp, wgts_csp, times_csp, freqs_csp = get_soltab(soltab_csp, direction)
 
-times = soltab_tec.time
 freqs = pt.table(o.inms+"/SPECTRAL_WINDOW",ack=False)[0]["CHAN_FREQ"]
-
-for timestep, buf in enumerate(t.iter("TIME")):
-    if timestep % 10 == 0: print("Timestep", timestep)
-
-    assert buf.getcell("TIME",0) == times[timestep]
-
-    data = buf.getcol(o.incol)
-    flag = buf.getcol("FLAG")
-
-    for rownr, row in enumerate(buf):
-        ant1 = row["ANTENNA1"]
-        ant2 = row["ANTENNA2"]
-        if (wgts_tec[ant1,direction,timestep] == 0).all() or (wgts_tec[ant2,direction,timestep] == 0).all() \
-                or (wgts_csp[ant1,direction,timestep] == 0).all() or (wgts_csp[ant2,direction,timestep] == 0).all():
-            flag[rownr,:,:] = True
-            print("skip flagged ", end=' ')
-            continue
-
-        g1 = sols_csp[ant1,direction,timestep] - sols_tec[ant1,direction,timestep] * 8.44797245e9 / freqs
-        #g1 = -1. * sols_tec[ant1,direction,timestep] * 8.44797245e9 / freqs
-        g1 = cos(g1) + 1j*sin(g1)
-        g2 = sols_csp[ant2,direction,timestep] - sols_tec[ant2,direction,timestep] * 8.44797245e9 / freqs
-        #g2 = -1. * sols_tec[ant2,direction,timestep] * 8.44797245e9 / freqs
-        g2 = cos(g2) + 1j*sin(g2)
-        for pol in range(4):
-            if o.corrupt:
-                data[rownr,:,pol] *= ( g1 * np.conj(g2) )
-            else:
-                data[rownr,:,pol] /= ( g1 * np.conj(g2) )
-
-    buf.putcol(o.outcol, data)
-    buf.putcol("FLAG", flag) 
+fidx_tec = interp_index(freqs, freqs_tec, o.interp)
+fidx_csp = interp_index(freqs, freqs_csp, o.interp)
+
+nblock = 0
+for tb, startrow, nrow in iter_timeblocks(t, o.ntimes):
+    if nblock % 10 == 0: print("Timestep block", nblock)
+    nblock += 1
+
+    times, tidx = np.unique(tb.getcol("TIME", startrow=startrow, nrow=nrow), return_inverse=True)
+    ant1 = tb.getcol("ANTENNA1", startrow=startrow, nrow=nrow)
+    ant2 = tb.getcol("ANTENNA2", startrow=startrow, nrow=nrow)
+    data = tb.getcol(o.incol, startrow=startrow, nrow=nrow)
+    flag = tb.getcol("FLAG", startrow=startrow, nrow=nrow)
+
+    # phase screen of each antenna, shape: ant, time, chan
+    tec, ok_tec = interp_sols(sols_tec, wgts_tec, interp_index(times, times_tec, o.interp), fidx_tec)
+    csp, ok_csp = interp_sols(sols_csp, wgts_csp, interp_index(times, times_csp, o.interp), fidx_csp, phasor=True)
+    g = np.exp( 1j*(csp - tec * 8.44797245e9 / freqs) )
+    ok = ok_tec & ok_csp
+
+    # shape: row, chan
+    corr = g[ant1, tidx] * np.conj(g[ant2, tidx])
+    good = ok[ant1, tidx] & ok[ant2, tidx]
+    corr[~good] = 1. # leave flagged data untouched
+    if o.corrupt:
+        data *= corr[:, :, np.newaxis]
+    else:
+        data /= corr[:, :, np.newaxis]
+    flag[~good] = True
+
+    tb.putcol(o.outcol, data, startrow=startrow, nrow=nrow)
+    tb.putcol("FLAG", flag, startrow=startrow, nrow=nrow)
 
 h5.close()
 t.close()
@@ -20,7 +20,7 @@
 import os, sys, logging, itertools
 import pyrap.tables as pt
 import numpy as np
-import scipy.optimize
+from lib_tec import fit_tec
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -35,39 +35,8 @@ mode = 'double'
 timeavg = 1
 freqavg = 4
 solvetec = False
-
-def getPh(phase, antIdx, ant):
-    """
-    Get the phases relative to an antenna towards all the other antennas "Phi 1->2"
-    The antenna is assumed to be at the first position of the BL ordinament, sign is corrected accordingly
-    """
-    phase[antIdx[1] == ant] *= -1 # account for "worng" BL direction
-    p = phase[(antIdx[0] == ant) | (antIdx[1] == ant)]
-    phase[antIdx[1] == ant] *= -1 # correct back the values
-    return p
-
-
-def getAmp(amp, antIdx, ant, ant2 = None):
-    """
-    Get the amps relative to an antenna towards all the other antennas "Lambda_12"
-    if ant2 != None: then return only that BL
-    """
-    if ant2 == None:
-        return amp[(antIdx[0] == ant) | (antIdx[1] == ant)]
-    else:
-        return amp[((antIdx[0] == ant) & (antIdx[1] == ant2)) | ((antIdx[0] == ant2) & (antIdx[1] == ant))]
-
-
-def getWe(weight, antIdx, ant, ant2 = None):
-    """
-    Get the weight relative to an antenna
-    if ant2 != None: then return only that BL
-    """
-    if ant2 == None:
-        return weight[(antIdx[0] == ant) | (antIdx[1] == ant)]
-    else:
-        return weight[((antIdx[0] == ant) & (antIdx[1] == ant2)) | ((antIdx[0] == ant2) & (antIdx[1] == ant))]
-
+ncpu = 1 # processes for the TEC fit
+timechunk = 10 # number of timesteps (multiple of timeavg) solved at once
 
 def norm(phase):
     """
@@ -81,50 +50,145 @@ def norm(phase):
     return out
 
 
-def angMean(angs, weights):
+def angMean(angs, weights, axis=None):
     """
-    Find the weighted mean of a series of angles
+    Find the weighted mean of a series of angles (along axis)
     """
     #assert len(angs) == len(weight)
     # normalization is unnecessary as we deal with just the angle
-    return np.angle( np.sum( weights * np.exp(1j*np.array(angs)) ))# / ( len(angs) * sum(weight) ) )
+    return np.angle( np.sum( weights * np.exp(1j*np.array(angs)), axis=axis ))# / ( len(angs) * sum(weight) ) )
 
 
-def angRMS(angs, weights):
+def angRMS(angs, weights, axis=None):
     """
-    Find the weighted rms of a series of angles
+    Find the weighted rms of a series of angles (along axis)
     """
-    diff = angs - angMean(angs, weights)
+    mean = angMean(angs, weights, axis=axis)
+    diff = angs - (mean if axis is None else np.expand_dims(mean, axis))
     diff[diff < -np.pi] += 2*np.pi
     diff[diff > np.pi] -= 2*np.pi
-    return np.sqrt( angMean(diff**2, weights) ) # weighted std dev
+    return np.sqrt( angMean(diff**2, weights, axis=axis) ) # weighted std dev
 
 
 def findtec(phases, weights, freq, time, ant):
     """
-    Find tec
-    time, ant are just for plotting purposes
+    Find tec of all solutions at once with a grid search on the par1complex cost (see lib_tec.fit_tec)
+    phases, weights: (time, ant, freq)
+    time, ant are just for plotting purposes: index of the first time and antenna names
+    Return tec and its error, shape (time, ant)
     """
-    # TODO: add weights
-    par1complex = lambda p, freq, phases, weights: ( abs(np.cos(8.44797245e9*p[0]/freq) - np.cos(phases)) +\
-                                            abs(np.sin(8.44797245e9*p[0]/freq) - np.sin(phases)) ) * weights
-#    par2complex = lambda p, freq, phases, weights: ( abs(np.cos(2.*8.44797245e9*p[0]/freq + p[1]) - np.cos(phases)) +\
-#                                                     abs(np.sin(2.*8.44797245e9*p[0]/freq + p[1]) - np.sin(phases)) ) * weights
-    fitresult, success = scipy.optimize.leastsq(par1complex, [0], args=(freq, phases, weights), maxfev=10000)
-#    fitresult, success = scipy.optimize.basinhopping(par1complex, [0], T=1., minimizer_kwargs={'args':(freq, phases, weights)})
-#    fitresult, success = scipy.optimize.leastsq(par1complex, [0,0], args=(freq, phases, weights), maxfev=10000)
-    logging.debug("leastsqr"+str(fitresult))
+    tec, dtec = fit_tec(phases, weights, freq, ncpu=ncpu)
+    logging.debug("grid search "+str(tec))
     if plotTEC:
-        fig.clf()
-        ax = fig.add_subplot(110)
-        fitfuncfastplot = lambda p, freq: np.mod(8.44797245e9*p[0]/freq + 1.*np.pi, 2.*np.pi) - np.pi
-        ax.plot(freq, np.mod(phases + np.pi, 2.*np.pi) - np.pi, 'or' )
-        TEC = np.mod((-8.44797245e9*(fitresult[0])/freq)+np.pi, 2*np.pi) - np.pi
-        residual = np.mod(phases-TEC+np.pi,2.*np.pi)-np.pi
-        ax.plot(freq, residual, '.', color='yellow')
-        ax.plot(freq, fitfuncfastplot(fitresult, freq), "r-")
-        plt.savefig(ant+'_T'+str(time)+'.png')
-    return fitresult[0]
+        fitfuncfastplot = lambda p, freq: np.mod(8.44797245e9*p/freq + 1.*np.pi, 2.*np.pi) - np.pi
+        for t, a in itertools.product(range(tec.shape[0]), range(tec.shape[1])):
+            fig.clf()
+            ax = fig.add_subplot(111)
+            ax.plot(freq, np.mod(phases[t,a] + np.pi, 2.*np.pi) - np.pi, 'or' )
+            TEC = np.mod((-8.44797245e9*(tec[t,a])/freq)+np.pi, 2*np.pi) - np.pi
+            residual = np.mod(phases[t,a]-TEC+np.pi,2.*np.pi)-np.pi
+            ax.plot(freq, residual, '.', color='yellow')
+            ax.plot(freq, fitfuncfastplot(tec[t,a], freq), "r-")
+            plt.savefig(ant[a]+'_T'+str(time+t)+'.png')
+    return tec, dtec
+
+
+def bl2mat(vals, tidx, ants1, ants2, Ntime, Nant, sign=1):
+    """
+    Scatter per-row values (nrow, nchan) into matrices (Ntime, nchan, Nant, Nant) where [t,f,a1,a2] is the baseline a1->a2
+    tidx: time index of each row
+    sign: -1 for phases, a2->a1 = -(a1->a2); autocorrelations (a1 == a2) are stored as sign*vals, i.e. with the
+          sign of a2->a1
+    missing baselines are 0
+    """
+    mat = np.zeros((Ntime, vals.shape[1], Nant, Nant), dtype=vals.dtype)
+    mat[tidx, :, ants1, ants2] = vals
+    mat[tidx, :, ants2, ants1] = sign*vals
+    return mat
+
+
+def closurePhase(P, W, antRef, antSol, mode='double'):
+    """
+    Closure phases of an antenna for all times and channels at once
+    P, W: phase and weight matrices (..., Nant, Nant) from bl2mat()
+    Return the closures (..., Nclosures) and their weights
+    """
+    Nant = P.shape[-1]
+    ph_ref = P[..., antRef, :]
+    ph_sol = P[..., antSol, :]
+    we_ref = W[..., antRef, :]
+    we_sol = W[..., antSol, :]
+    if mode == 'double':
+        # (ph_ref - ph_1) - (ph_sol - ph_1)
+        sols = norm( ph_ref - ph_sol )
+        sols_w = ( we_ref + we_sol ) /2.
+        # if antSol = ant1: p_rs + p_ss = p_rs (single, remove)
+        sols[..., antSol] = 0
+        sols_w[..., antSol] = 0
+        # if antRef = ant1: p_rr + p_rs = p_rs (single, keep)
+        sols_w[..., antRef] = we_ref[..., antSol] # autocorr gives 0 weight, no /2
+    elif mode == 'triple':
+        # (ph_ref - ph_2) + (ph_2 - ph_1) - (ph_sol - ph_1), [..., 2, 1]
+        sols = norm( ph_ref[..., :, np.newaxis] + P - ph_sol[..., np.newaxis, :] )
+        # weight of the tri baseline as in the original loop (i.e. of the ref antenna)
+        sols_w = ( we_ref[..., :, np.newaxis] + we_sol[..., np.newaxis, :] + we_ref[..., np.newaxis, :] ) /3.
+        # p_r1 + p_1r + p_rs = p_rs (single) and p_r1 + p_1s + p_ss = p_r1 + p_1s (double with 1)
+        sols_w[..., [antRef, antSol], :] = 0
+        sols = sols.reshape(sols.shape[:-2]+(-1,))
+        sols_w = sols_w.reshape(sols_w.shape[:-2]+(-1,))
+    return sols, sols_w
+
+
+def closureAmp(A, W, antSol):
+    """
+    Closure amplitudes a1S*aS3/a13 = e1 eS eS e2 / e1 e2 = e2**2 of an antenna for all times and channels at once
+    A, W: amplitude and weight matrices (..., Nant, Nant) from bl2mat()
+    Return the closures in log10 (..., Nclosures) and their weights
+    """
+    amp_sol = A[..., antSol, np.newaxis, :]
+    we_sol = W[..., antSol, np.newaxis, :]
+    amp_1S = A[..., :, antSol, np.newaxis]
+    we_1S = W[..., :, antSol, np.newaxis]
+    # [..., 1, 3]
+    sols_w = ( we_1S + we_sol + W ) /3.
+    # if any antenna of the closure relation is flagged or an autocorrelation, set the weight to 0
+    sols_w[ (W == 0) | (we_sol == 0) | (we_1S == 0) ] = 0
+    sols_w[..., antSol, :] = 0 # skip if 1==S
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sols = np.where(sols_w != 0, np.log10(1./np.sqrt(amp_1S * amp_sol / A)), 0) # for amplitude work in log space
+    return sols.reshape(sols.shape[:-2]+(-1,)), sols_w.reshape(sols_w.shape[:-2]+(-1,))
+
+
+def solveClosure(P, A, W, antRef, mode='double', solveamp=True):
+    """
+    Solve phases and amplitudes of all antennas for all times and channels at once
+    P, A, W: phase, amplitude and weight matrices (..., Nant, Nant) from bl2mat()
+    Return a dict of solutions 'phase', 'amp' (log10) of shape (..., Nant) and one of their weights
+    (1/rms of the closures, 0 where there are no valid closures)
+    """
+    Nant = P.shape[-1]
+    sols = {'amp':np.zeros(P.shape[:-1]), 'phase':np.zeros(P.shape[:-1])}
+    sols_w = {'amp':np.zeros(P.shape[:-1]), 'phase':np.zeros(P.shape[:-1])}
+    for antSol in range(Nant):
+        if antSol != antRef: # leave 0 in the solutions
+            ph, we = closurePhase(P, W, antRef, antSol, mode)
+            valid = np.any(we != 0, axis=-1)
+            sols['phase'][..., antSol] = np.where(valid, angMean(ph, we, axis=-1), 0) # weighted angular mean
+            with np.errstate(divide='ignore'):
+                sols_w['phase'][..., antSol] = np.where(valid, 1./angRMS(ph, we, axis=-1), 0) # weighted std dev
+
+        if not solveamp: continue
+
+        amp, we = closureAmp(A, W, antSol)
+        sum_we = np.sum(we, axis=-1)
+        valid = (sum_we != 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg = np.sum(we * amp, axis=-1)/sum_we # weighted avg
+            std = np.sqrt( np.sum(we * (amp - avg[..., np.newaxis])**2, axis=-1)/sum_we ) # weighted std dev
+        sols['amp'][..., antSol] = np.where(valid, avg, 0)
+        sols_w['amp'][..., antSol] = np.where(valid, 1./std, 0)
+
+    return sols, sols_w
 
 
 if plotph or plotamp or plotavg or plotall:
@@ -134,7 +198,7 @@ if plotph or plotamp or plotavg or plotall:
     mpl.use("Agg")
     import matplotlib.pyplot as plt
     import matplotlib.cm as cm
-    cmap = cm.get_cmap('Spectral')
+    cmap = plt.get_cmap('Spectral')
     fig = plt.figure()
     fig.subplots_adjust(wspace=0)
 
@@ -158,190 +222,117 @@ if solvetec: freqavg = Nfreq
 logging.info('Open table and fetch data')
 tms = pt.table(ms, readonly=True, ack=False)
 
-# get time
-Ntime = len(set(tms.getcol('TIME')))
+# get time, sorted so that each timestep is a contiguous block of rows
+tms = tms.sort('TIME')
+times, time_start = np.unique(tms.getcol('TIME'), return_index=True)
+time_start = np.append(time_start, tms.nrows())
+Ntime = len(times)
 assert Ntime%timeavg == 0
+timechunk = max(timechunk//timeavg, 1)*timeavg
+debugAnts = ['CS002LBA', 'RS310LBA', 'RS106LBA']
 
 # array with solutions
-solall = {'amp':np.zeros( (Ntime/timeavg,Nfreq/freqavg,Nant), dtype=np.float64), 'phase':np.zeros( (Ntime/timeavg,Nfreq/freqavg,Nant), dtype=np.float64)}
-# in these array I store the solution at each time and freq, every timeavg times then I combine them. I need to store all the frequencies.
-solsblock = {'amp':np.zeros( (timeavg,Nfreq,Nant), dtype=np.float64), 'phase':np.zeros( (timeavg,Nfreq,Nant), dtype=np.float64)}
-solsblock_w = {'amp':np.zeros( (timeavg,Nfreq,Nant), dtype=np.float64), 'phase':np.zeros( (timeavg,Nfreq,Nant), dtype=np.float64)}
-
-for t, ts in enumerate(tms.iter('TIME')):
-    logging.info('Working on time: '+str(t))
-    time = ts.getcell('TIME',0)
-    # shape: ant, chan, pol
-    weight = ts.getcol('WEIGHT_SPECTRUM')
-    flags = ts.getcol('FLAG')
+solall = {'amp':np.zeros( (Ntime//timeavg,Nfreq//freqavg,Nant), dtype=np.float64), 'phase':np.zeros( (Ntime//timeavg,Nfreq//freqavg,Nant), dtype=np.float64)}
+if solvetec: solall['dtec'] = np.zeros_like(solall['phase']) # TEC errors
+
+for t0 in range(0, Ntime, timechunk):
+    t1 = min(t0+timechunk, Ntime)
+    logging.info('Working on times: %i-%i' % (t0, t1-1))
+    startrow, nrow = time_start[t0], time_start[t1]-time_start[t0]
+    # shape: row, chan (single pol)
+    getcol = lambda col: tms.getcolslice(col, [0,0], [Nfreq-1,0], startrow=startrow, nrow=nrow)[:,:,0]
+    weight = getcol('WEIGHT_SPECTRUM')
+    flags = getcol('FLAG')
     weight[flags == True] = 0 # weight flagged data 0
-    data = ts.getcol('SMOOTHED_DATA')
+    data = getcol('SMOOTHED_DATA')
     data[ weight == 0 ] = 1. # remove nans
-    data_m = ts.getcol('MODEL_DATA')
-    ants1 = ts.getcol('ANTENNA1')
-    ants2 = ts.getcol('ANTENNA2')
-    ants = np.array(list(set(ants1)))
-    antIdx = np.array([ants1,ants2])
-
-    for f, freq in enumerate(chans):
-        logging.info('Working on freq: '+str(f))
-
-        # scalar
-        #data_amp = np.absolute(data[:,f,0])+np.absolute(data[:,f,3])
-        #data_ph = norm( np.angle(data[:,f,0])+np.angle(data[:,f,3]) )
-        #data_ph_m = norm( np.angle(data_m[:,f,0])+np.angle(data_m[:,f,3]) )
-        #weight = ( weight[:,f,0] + weight[:,f,3] )/2. # note that flags are not propagated in pol
-    
-        # single pol
-        data_ph = norm( np.angle(data_m[:,f,0]) - np.angle(data[:,f,0]) )
-        data_amp = np.abs( data_m[:,f,0] ) / np.abs ( data[:,f,0]  )
-        data_we = weight[:,f,0]
-        
-        # TODO: if ref ant is flagged?
-    
-        # cycle on antenna to solve for
-        for s, antSol in enumerate(ants):
-            #logging.info('Working on antenna: '+str(antSol))
-    
-            if antSol != antRef: # leave 0 in the solutions
-    
-                # PHASES
-                if mode == 'double':
-                    # double closure
-                    ph_ref = getPh(data_ph, antIdx, antRef)
-                    ph_sol = getPh(data_ph, antIdx, antSol)
-                    # (ph_ref - ph_1) - (ph_sol - ph_1)
-                    sols = norm( ph_ref - ph_sol )
-        
-                    # calculate weights
-                    we_ref = getWe(data_we, antIdx, antRef)
-                    we_sol = getWe(data_we, antIdx, antSol)
-                    sols_w = (we_ref + we_sol ) /2.
-        
-                    # if antSol = ant1: p_rs + p_ss = p_rs (single, remove)
-                    sols[antSol] = 0
-                    sols_w[antSol] = 0
-                    # if antRef = ant1: p_rr + p_rs = p_rs (single, keep)
-                    sols_w[antRef] = we_ref[antSol] # autocorr gives 0 weight, no /2
-        
-                elif mode == 'triple':
-                    ph_ref = getPh(data_ph, antIdx, antRef)
-                    ph_sol = getPh(data_ph, antIdx, antSol)
-                    we_ref = getWe(data_we, antIdx, antRef)
-                    we_sol = getWe(data_we, antIdx, antSol)
-                    # triple closure
-                    sols = []
-                    sols_w = []
-                    for at, ant2 in enumerate(ants):
-                        if ant2 == antRef: continue # p_r1 + p_1r + p_rs = p_rs (single)
-                        if ant2 == antSol: continue # p_r1 + p_1s + p_ss = p_r1 + p_1s (double with 1)
-                        # if ant1 == ant2: fall back in double -> p_r1 + p_11 + p_1s = p_r1 + p_1s (double with 1==2, keep)
-                        
-                        # (ph_ref - ph_2) + (ph_2 - ph_1) - (ph_sol - ph_1)
-                        ph_tri = getPh(data_ph, antIdx, ant2)
-                        sols.append( norm( ph_ref[at] + ph_tri - ph_sol ) )
-                        we_tri = getWe(data_we, antIdx, antRef)
-                        sols_w.append( (we_ref[at] + we_sol + we_tri ) /3. )
-        
-                if not (np.array(sols_w).flatten() == 0).all():
-                    avg = angMean( np.array(sols).flatten(), weights=np.array(sols_w).flatten() ) # weighted angular mean
-                    solsblock['phase'][t%timeavg,f,s] = avg 
-                    solsblock_w['phase'][t%timeavg,f,s] = 1./angRMS( np.array(sols).flatten(), np.array(sols_w).flatten() ) # weighted std dev
-
-                # Debug plots
-                if plotph and ( antNames[antSol] == 'CS002LBA' or antNames[antSol] == 'RS310LBA' or antNames[antSol] == 'RS106LBA' ):
+    data_m = getcol('MODEL_DATA')
+    ants1 = tms.getcol('ANTENNA1', startrow=startrow, nrow=nrow)
+    ants2 = tms.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+    tidx = np.unique(tms.getcol('TIME', startrow=startrow, nrow=nrow), return_inverse=True)[1]
+
+    # scalar
+    #data_amp = np.absolute(data[:,:,0])+np.absolute(data[:,:,3])
+    #data_ph = norm( np.angle(data[:,:,0])+np.angle(data[:,:,3]) )
+    #data_ph_m = norm( np.angle(data_m[:,:,0])+np.angle(data_m[:,:,3]) )
+    #weight = ( weight[:,:,0] + weight[:,:,3] )/2. # note that flags are not propagated in pol
+
+    # closure index: baselines as (time, chan, ant, ant) matrices
+    P = bl2mat( norm( np.angle(data_m) - np.angle(data) ), tidx, ants1, ants2, t1-t0, Nant, sign=-1 )
+    A = bl2mat( np.abs( data_m ) / np.abs ( data ), tidx, ants1, ants2, t1-t0, Nant )
+    W = bl2mat( weight, tidx, ants1, ants2, t1-t0, Nant )
+
+    # TODO: if ref ant is flagged?
+    sols, sols_w = solveClosure(P, A, W, antRef, mode, solveamp = not solvetec)
+
+    # Debug plots
+    if plotph or plotamp:
+        for antSol in [a for a in range(Nant) if antNames[a] in debugAnts]:
+            ph, ph_w = closurePhase(P, W, antRef, antSol, mode)
+            amp, amp_w = closureAmp(A, W, antSol)
+            for t, f in itertools.product(range(t1-t0), range(Nfreq)):
+                time, freq = times[t0+t], chans[f]
+                if plotph and antSol != antRef:
                     fig.clf()
                     ax = fig.add_subplot(111)
-                    ax.plot(range(len(sols)), sols, 'ro')
-                    ax.set_title( "Antenna "+antNames[antSol]+" rms: "+str(1./solsblock_w['phase'][t%timeavg,f,s]) )
-                    ax.plot([0,36],[solsblock['phase'][t%timeavg,f,s],solsblock['phase'][t%timeavg,f,s]], 'k-')
+                    ax.plot(range(ph.shape[-1]), ph[t,f], 'ro')
+                    ax.set_title( "Antenna "+antNames[antSol]+" rms: "+str(1./sols_w['phase'][t,f,antSol]) )
+                    ax.plot([0,36],[sols['phase'][t,f,antSol],sols['phase'][t,f,antSol]], 'k-')
                     ax.set_ylim(ymin=-np.pi, ymax=np.pi)
                     ax.set_xlim(xmin=-1, xmax=36)
                     logging.debug('Plotting ph_T%d_F%d_%s.png' % (time, freq, antNames[antSol]))
                     plt.savefig('ph_T%d_F%d_%s.png' % (time, freq, antNames[antSol]), bbox_inches='tight')
-
-            if solvetec : continue # skip amp if TEC solve
-        
-            # AMPLITUDES
-            # a1S*aS3/a13 = e1 eS eS e2 / e1 e2 = e2**2
-            # TODO: convert to log space
-            amp_sol = getAmp(data_amp, antIdx, antSol)
-            we_sol = getWe(data_we, antIdx, antSol)
-            sols = []
-            sols_w = []
-            for ant1 in ants:
-                if ant1 == antSol: continue # skip if 1==S
-                amp_1 = getAmp(data_amp, antIdx, ant1)
-                we_1 = getWe(data_we, antIdx, ant1)
-                amp_1S = getAmp(data_amp, antIdx, ant1, ant2=antSol)
-                we_1S = getWe(data_we, antIdx, ant1, ant2=antSol)
-                sols.append(1./np.sqrt(amp_1S * amp_sol / amp_1))
-                sols_w.append( (we_1S + we_sol + we_1) /3.)
-    
-                # if any antenna of the closure relation is flagged or an autocorrelation, set the weight to 0
-                sols_w[-1][ we_1 == 0 ] = 0
-                sols_w[-1][ we_sol == 0 ] = 0
-                if we_1S == 0: sols_w[-1] = np.zeros_like(sols_w[-1])
-    
-            if not (np.array(sols_w).flatten() == 0).all():
-                sols = np.log10(sols) # for amplitude work in log space
-                avg = np.average( np.array(sols).flatten(), weights=np.array(sols_w).flatten() ) # weighted avg
-                solsblock['amp'][t%timeavg,f,s] = avg 
-                solsblock_w['amp'][t%timeavg,f,s] = 1./np.sqrt( np.average( ( np.array(sols).flatten() - avg )**2,\
-                    weights=np.array(sols_w).flatten()) ) # weighted std dev
-
-            # Debug plots
-            if plotamp and ( antNames[antSol] == 'CS002LBA' or antNames[antSol] == 'RS310LBA' or antNames[antSol] == 'RS106LBA' ):
-                fig.clf()
-                ax = fig.add_subplot(111)
-                for a in range(len(sols)):
-                    ax.plot(range(len(sols[a][(sols_w[a] != 0)])), sols[a][(sols_w[a] != 0)], 'bo')
-                ax.set_title( "Antenna "+antNames[antSol]+" rms: "+str(1./solsblock_w['amp'][t%timeavg,f,s]) )
-                ax.plot([0,36],[solsblock['amp'][t%timeavg,f,s],solsblock['amp'][t%timeavg,f,s]], 'k-')
-                logging.debug('Plotting amp_T%d_F%d_%s.png' % (time, freq, antNames[antSol]))
-                plt.savefig('amp_T%d_F%d_%s.png' % (time, freq, antNames[antSol]), bbox_inches='tight')
-    
-        # end freq cycle
+                if plotamp and not solvetec:
+                    fig.clf()
+                    ax = fig.add_subplot(111)
+                    good = (amp_w[t,f] != 0)
+                    ax.plot(range(np.count_nonzero(good)), amp[t,f][good], 'bo')
+                    ax.set_title( "Antenna "+antNames[antSol]+" rms: "+str(1./sols_w['amp'][t,f,antSol]) )
+                    ax.plot([0,36],[sols['amp'][t,f,antSol],sols['amp'][t,f,antSol]], 'k-')
+                    logging.debug('Plotting amp_T%d_F%d_%s.png' % (time, freq, antNames[antSol]))
+                    plt.savefig('amp_T%d_F%d_%s.png' % (time, freq, antNames[antSol]), bbox_inches='tight')
 
     # save actual solutions by re-averaging inside the freq/time steps
-    if (t+1) % timeavg == 0:
-        for s in range(Nant):
-
-            if plotavg: 
-                fig.clf()
-
-            for f in range(Nfreq/freqavg):
-                if solvetec:
-                    solall['phase'][t/timeavg,f,s] = findtec( solsblock['phase'][:,f*freqavg:(f+1)*freqavg,s].flatten(),\
-                        weights=solsblock_w['phase'][:,f*freqavg:(f+1)*freqavg,s].flatten(), freq=chans, time = t/timeavg, ant = antNames[s])
-                else:
-                    solall['phase'][t/timeavg,f,s] = angMean( solsblock['phase'][:,f*freqavg:(f+1)*freqavg,s].flatten(),\
-                        weights=solsblock_w['phase'][:,f*freqavg:(f+1)*freqavg,s].flatten() )
-                    # convert back from log space
-                    solall['amp'][t/timeavg,f,s] = 10**np.average( solsblock['amp'][:,f*freqavg:(f+1)*freqavg,s].flatten(),\
-                        weights=solsblock_w['amp'][:,f*freqavg:(f+1)*freqavg,s].flatten() )
-
-                # Debug plots
-                # color: freq, xaxis: time, table: ant
-                if plotph or plotamp: 
-                    times = list(range(solsblock['amp'].shape[0]))
-                    ax = fig.add_subplot(121)
-                    ax.set_title("PHASE - Antenna "+antNames[s])
-                    ax.set_xlim(xmin=-0.5, xmax=len(times)-0.5)
-                    for i in range(f*freqavg,(f+1)*freqavg):
-                        ax.errorbar(times, solsblock['phase'][:,i,s], yerr=1./solsblock_w['phase'][:,i,s], c=cmap(float(i)/freqavg), fmt='o')
-                    ax.plot([times[0],times[-1]], [solall['phase'][t/timeavg,f,s], solall['phase'][t/timeavg,f,s]], 'k-')
-            
-                    ax = fig.add_subplot(122)
-                    ax.set_title("AMP - Antenna "+antNames[s])
-                    for i in range(f*freqavg,(f+1)*freqavg):
-                        ax.errorbar(times, solsblock['amp'][:,i,s], yerr=1./solsblock_w['amp'][:,i,s], c=cmap(float(i)/freqavg), fmt='o')
-                    ax.plot([times[0],times[-1]], np.log10([solall['amp'][t/timeavg,f,s], solall['amp'][t/timeavg,f,s]]), 'k-')
-
-                    logging.debug('Plotting Fin_T%d_F%d_%s.png' % (t/timeavg, f, antNames[s]))
-                    plt.savefig('Fin_T%d_F%d_%s.png' % (t/timeavg, f, antNames[s]), bbox_inches='tight')
-
-    #if t == 20: break
+    # shape: time block, time in block, freq block, freq in block, ant
+    blockshape = ((t1-t0)//timeavg, timeavg, Nfreq//freqavg, freqavg, Nant)
+    for k in sols:
+        sols[k] = sols[k].reshape(blockshape)
+        sols_w[k] = sols_w[k].reshape(blockshape)
+    tb0 = t0//timeavg
+    if solvetec:
+        # all time blocks and antennas at once, fitting together all channels of the timesteps in a block
+        ph = sols['phase'][:,:,0].transpose(0,3,1,2).reshape(blockshape[0], Nant, -1)
+        we = sols_w['phase'][:,:,0].transpose(0,3,1,2).reshape(blockshape[0], Nant, -1)
+        solall['phase'][tb0:tb0+blockshape[0],0], solall['dtec'][tb0:tb0+blockshape[0],0] = \
+            findtec( ph, weights=we, freq=np.tile(chans, timeavg), time = tb0, ant = antNames )
+    else:
+        solall['phase'][tb0:tb0+blockshape[0]] = angMean( sols['phase'], sols_w['phase'], axis=(1,3) )
+        # convert back from log space
+        with np.errstate(divide='ignore', invalid='ignore'):
+            solall['amp'][tb0:tb0+blockshape[0]] = 10**( np.sum(sols_w['amp'] * sols['amp'], axis=(1,3)) / np.sum(sols_w['amp'], axis=(1,3)) )
+
+    # Debug plots
+    # color: freq, xaxis: time, table: ant
+    if plotph or plotamp:
+        for tb, f, s in itertools.product(range(blockshape[0]), range(blockshape[2]), range(Nant)):
+            fig.clf()
+            times_block = list(range(timeavg))
+            ax = fig.add_subplot(121)
+            ax.set_title("PHASE - Antenna "+antNames[s])
+            ax.set_xlim(xmin=-0.5, xmax=len(times_block)-0.5)
+            for i in range(freqavg):
+                ax.errorbar(times_block, sols['phase'][tb,:,f,i,s], yerr=1./sols_w['phase'][tb,:,f,i,s], c=cmap(float(i)/freqavg), fmt='o')
+            ax.plot([times_block[0],times_block[-1]], [solall['phase'][tb0+tb,f,s], solall['phase'][tb0+tb,f,s]], 'k-')
+
+            ax = fig.add_subplot(122)
+            ax.set_title("AMP - Antenna "+antNames[s])
+            for i in range(freqavg):
+                ax.errorbar(times_block, sols['amp'][tb,:,f,i,s], yerr=1./sols_w['amp'][tb,:,f,i,s], c=cmap(float(i)/freqavg), fmt='o')
+            ax.plot([times_block[0],times_block[-1]], np.log10([solall['amp'][tb0+tb,f,s], solall['amp'][tb0+tb,f,s]]), 'k-')
+
+            logging.debug('Plotting Fin_T%d_F%d_%s.png' % (tb0+tb, f, antNames[s]))
+            plt.savefig('Fin_T%d_F%d_%s.png' % (tb0+tb, f, antNames[s]), bbox_inches='tight')
+
     # end time cycle
 
 if plotall:
@@ -355,7 +346,7 @@ if plotall:
             ax.set_title("PHASE - Antenna "+ant)
             ax.plot( solall['phase'][:,:,a], 'o', markersize=3 )
             ax = fig.add_subplot(212)
-            ax.set_title("AMP - Antenna "+antNames[s])
+            ax.set_title("AMP - Antenna "+ant)
             ax.plot( solall['amp'][:,:,a], '-', markersize=3 )
         logging.debug('Plotting '+ant+'.png')
         plt.savefig(ant+'.png', bbox_inches='tight')
@@ -20,6 +20,7 @@
 import os, sys
 import matplotlib.pyplot as plt
 import numpy as np
+from lib_tec import fit_tec, tec_cost
 
 def getPhaseWrapBase(freqs):
     """
@@ -28,10 +29,10 @@ def getPhaseWrapBase(freqs):
     """
     freqs = np.array(freqs)
     nF = freqs.shape[0]
-    A = np.zeros((nF, 2), dtype=np.float)
+    A = np.zeros((nF, 2), dtype=float)
     A[:, 1] = freqs * 2 * np.pi * 1e-9
     A[:, 0] = -8.44797245e9 / freqs
-    steps = np.dot(np.dot(np.linalg.inv(np.dot(A.T, A)), A.T), 2 * np.pi * np.ones((nF, ), dtype=np.float))
+    steps = np.dot(np.dot(np.linalg.inv(np.dot(A.T, A)), A.T), 2 * np.pi * np.ones((nF, ), dtype=float))
     return steps
 
 TECfixed = 0.1
@@ -47,16 +48,22 @@ def norm(phase):
     return out
 
 
-MODEL = lambda t: norm((8.449e9*t/freq))
+# t can be an array of trial TECs, the result is (len(t), len(freq))
+MODEL = lambda t: norm((8.449e9*np.asarray(t)[...,np.newaxis]/freq))
 DATA = MODEL(TECfixed)
 
-chi = lambda t: sum(DATA-MODEL(t))**2
-#plt.plot(tec, np.log10([chi(t) for t in tec]))
+chi = lambda t: np.sum(DATA-MODEL(t), axis=-1)**2
+#plt.plot(tec, np.log10(chi(tec)))
 
-chi = lambda t: sum(abs(np.cos(MODEL(t))  - np.cos(DATA)) + abs(np.sin(MODEL(t))  - np.sin(DATA)))
-plt.plot(tec, np.log10([chi(t) for t in tec]))
+chi = lambda t: np.sum(abs(np.cos(MODEL(t))  - np.cos(DATA)) + abs(np.sin(MODEL(t))  - np.sin(DATA)), axis=-1)
+plt.plot(tec, np.log10(chi(tec)))
 plt.ylim(0,2.5)
 plt.savefig('test.png')
 
+# same landscape with the squared residuals minimised by the TEC fit
+#plt.plot(tec, np.log10(tec_cost(tec, DATA, np.ones_like(DATA), freq)))
+fit, dfit = fit_tec(DATA, np.ones_like(DATA), freq)
+print('Fitted TEC:', fit, '+/-', dfit, 'TECU (true:', TECfixed, ')')
+
 steps = getPhaseWrapBase(freq)
 print('TEC jumps are of:', steps[0], 'TECU')
@@ -33,51 +33,107 @@ class MShandler():
         """
         logging.info('Reading: %s' % ms_file)
         self.ms_file = ms_file
-        self.ms = table(ms_files[0], readonly=False, ack=False)
+        self.ms = table(ms_file, readonly=False, ack=False)
 
-    def get_flags_aggr(self):
+    def iter_timeblocks(self, ntimes=50):
         """
+        Iterate on blocks of ntimes timesteps
+        Yield a table sorted in time (writes go to the MS), the first row and number of rows of the block
+        and the boundaries of each timestep in the block (rows relative to the first row)
         """
-        ms = self.ms_file
-        return taql('select NTRUES(GAGGR(FLAG), [0, 2]) as FLAG, SHAPE(GAGGR(FLAG)) as N from $ms where ANTENNA1 != ANTENNA2 groupby TIME')
-
-    def get_flags(self):
+        times = self.ms.getcol('TIME')
+        if np.all(np.diff(times) >= 0): t = self.ms
+        else:
+            t = self.ms.sort('TIME')
+            times = t.getcol('TIME')
+        start = np.append(np.flatnonzero(np.r_[True, times[1:] != times[:-1]]), len(times))
+        for i in range(0, len(start)-1, ntimes):
+            j = min(i+ntimes, len(start)-1)
+            yield t, start[i], start[j]-start[i], start[i:j+1]-start[i]
+
+    def get_flags(self, t, startrow, nrow):
         """
+        Return flags (nrow, nchan, npol) and a mask of the cross-correlation rows
         """
-        ms = self.ms_file
-        return taql('select FLAG from $ms where ANTENNA1 != ANTENNA2')
-
-
-def flagonmindata(MSh, mode, fract):
-    t = MSh.get_flags_aggr()
-    f = t.getcol('FLAG').astype(float) # shape: time/chan
-    n = t.getcol('N')
-    ntime = len(n)
-    nbl = n[0,0]
-    nchan = n[0,1]
-    npol = n[0,2]
-    ff = f/(nbl*npol) # fraction of flagged data per timestep and chan
-    fffullyflag = np.array(ff == 1.)
-    ff = np.array(ff > fract, dtype=bool)
-    logging.info( "Fully flagged timestep/chan: %i (%f%%) -> %i (%f%%)" % \
-            ( np.sum(fffullyflag), 100*np.sum(fffullyflag)/float(np.size(fffullyflag)), np.sum(ff), 100*np.sum(ff)/float(np.size(ff)) ) ) 
-    ff = np.repeat(ff, nbl, axis=0) # repeat time axis for nbl times
-    ff = np.expand_dims(ff, axis=2) # add pol axis
-    ff = np.repeat(ff, npol, axis=2) # repeat new pol axis for npol times
-    msflag = MSh.get_flags()
-    print("count before:", np.count_nonzero(msflag.getcol('FLAG')))
-    ff = np.array(ff | msflag.getcol('FLAG'), dtype=bool)
-    print("count after:", np.count_nonzero(ff))
-    msflag.putcol('FLAG', ff)
-    msflag.flush()
+        flag = t.getcol('FLAG', startrow=startrow, nrow=nrow)
+        cross = t.getcol('ANTENNA1', startrow=startrow, nrow=nrow) != t.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+        return flag, cross
+
+
+def flagonmindata(MSh, mode, fract, ntimes=50):
+    """
+    Extend flags on the cross-correlations one block of timesteps at a time
+    mode: None: flag timestep/chan with a fraction of flagged data (all baselines and pols) > fract
+          subchan: flag the whole timestep (all chans) if the flagged fraction of the timestep is > fract
+          subtime: flag the whole channel (all timesteps) if the flagged fraction of the channel is > fract
+          residual: flag what is left of a baseline/timestep if its flagged fraction (all chans and pols) is > fract
+    ntimes: number of timesteps read at once
+    """
+    # subtime needs the statistics of all timesteps first
+    if mode == 'subtime':
+        nflagged = 0; ntot = 0
+        for t, startrow, nrow, bounds in MSh.iter_timeblocks(ntimes):
+            flag, cross = MSh.get_flags(t, startrow, nrow)
+            nflagged += np.sum(flag[cross], axis=(0,2))
+            ntot += np.count_nonzero(cross)*flag.shape[2]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chanflag = nflagged/ntot > fract
+        logging.info( "Flagged chans: %i/%i" % (np.sum(chanflag), np.size(chanflag)) )
+
+    count_before = 0; count_after = 0
+    nfullyflag = 0; nflag = 0; ncells = 0
+    for t, startrow, nrow, bounds in MSh.iter_timeblocks(ntimes):
+        flag, cross = MSh.get_flags(t, startrow, nrow)
+        count_before += np.count_nonzero(flag[cross])
+
+        if mode == 'residual':
+            flag[ cross & (np.mean(flag, axis=(1,2)) > fract) ] = True
+
+        elif mode == 'subtime':
+            flag[:, chanflag, :] |= cross[:, np.newaxis, np.newaxis]
+
+        else:
+            # fraction of flagged data per timestep and chan
+            f = np.add.reduceat(np.sum(flag & cross[:, np.newaxis, np.newaxis], axis=2), bounds[:-1], axis=0) # shape: time/chan
+            n = np.add.reduceat(cross, bounds[:-1]) * flag.shape[2] # shape: time
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ff = f/n[:, np.newaxis]
+                if mode == 'subchan':
+                    ff[:] = (np.sum(f, axis=1)/(n*flag.shape[1]))[:, np.newaxis]
+            nfullyflag += np.sum(ff == 1.)
+            ff = np.array(ff > fract, dtype=bool)
+            nflag += np.sum(ff); ncells += np.size(ff)
+            ff = np.repeat(ff, np.diff(bounds), axis=0) # repeat time axis for the rows of each timestep
+            flag |= (ff & cross[:, np.newaxis])[:, :, np.newaxis]
+
+        count_after += np.count_nonzero(flag[cross])
+        t.putcol('FLAG', flag, startrow=startrow, nrow=nrow)
+
+    if mode is None or mode == 'subchan':
+        logging.info( "Fully flagged timestep/chan: %i (%f%%) -> %i (%f%%)" % \
+            ( nfullyflag, 100*nfullyflag/float(ncells), nflag, 100*nflag/float(ncells) ) )
+    print("%s - count before:" % MSh.ms_file, count_before)
+    print("%s - count after:" % MSh.ms_file, count_after)
+    MSh.ms.flush()
+
+
+def flagonmindata_ms(ms_file, mode, fract, ntimes=50):
+    """
+    Open and process a single MS (for parallel runs)
+    """
+    MSh = MShandler(ms_file)
+    flagonmindata(MSh, mode, fract, ntimes)
+    MSh.ms.close()
 
 
 def readArguments():
     import argparse
     parser=argparse.ArgumentParser("Flag data that do not come with enough unflagged data.")
     parser.add_argument("-v", "--verbose", help="Be verbose. Default is False", required=False, action="store_true")
-    parser.add_argument("-m", "--mode", type=str, help="Mode can be: NO MODE IMPLEMENTED", required=False, default=None)
+    parser.add_argument("-m", "--mode", type=str, help="Mode can be: residual (flag the rest of a baseline/timestep), subchan (flag whole timesteps), subtime (flag whole channels); default: flag timestep/chan", required=False, default=None)
     parser.add_argument("-f", "--fractbad", type=float, help="Fraction of bad data allowed, if higher flagging is triggered (default 0.5) ", required=False, default=0.5)
+    parser.add_argument("-t", "--ntimes", type=int, help="Number of timesteps read at once (default 50)", required=False, default=50)
+    parser.add_argument("-n", "--ncpu", type=int, help="Number of MSs processed in parallel (default 1)", required=False, default=1)
     parser.add_argument("ms_files", type=str, help="MeasurementSet name(s).", nargs="+")
     args=parser.parse_args()
     return vars(args)
@@ -89,6 +145,8 @@ if __name__=="__main__":
     verbose      = args["verbose"]
     mode         = args["mode"]
     fract        = args["fractbad"]
+    ntimes       = args["ntimes"]
+    ncpu         = args["ncpu"]
     ms_files     = args["ms_files"]
 
     if mode != 'residual' and mode != 'subchan' and mode != 'subtime' and mode is not None:
@@ -98,10 +156,13 @@ if __name__=="__main__":
     if verbose: logging.basicConfig(level=logging.DEBUG)
     else: logging.basicConfig(level=logging.INFO)
 
-    logging.info('Reading MSs...')
-    MSh = MShandler(ms_files)
-
     logging.info('Extend flags (fraction: %f)...' % fract)
-    flagonmindata(MSh, mode, fract)
+    if ncpu > 1 and len(ms_files) > 1:
+        import multiprocessing as mp
+        with mp.Pool(min(ncpu, len(ms_files))) as p:
+            p.starmap(flagonmindata_ms, [(ms_file, mode, fract, ntimes) for ms_file in ms_files])
+    else:
+        for ms_file in ms_files:
+            flagonmindata_ms(ms_file, mode, fract, ntimes)
 
     logging.debug('Running time %.0f s' % (time.time()-start_time))
@@ -17,48 +17,71 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import sys, os
+import sys, os, shutil
 import optparse
 import pyrap.images
 import pyrap.images.coordinates
-from scipy import odr
 import numpy as np
-import math
 
-# solve memory leak
-import matplotlib
-matplotlib.use('Agg')
-from matplotlib.cbook import report_memory
-import pylab
-
-def f(B, x):
-      return B[0]*x + B[1]
-
-def linear_fit(x, y, xerr=None, yerr=None):
-    from scipy import odr
-    linear = odr.Model(f)
-    if xerr == None: xerr = np.ones(len(x))
-    if yerr == None: yerr = np.ones(len(y))
-    for i,e in enumerate(yerr):
-	    if e == 0: yerr[i] = 1
-    mydata = odr.Data(x, y, wd=1/xerr, we=1/yerr)
-    myodr = odr.ODR(mydata, linear, beta0=[-1., 0.])
-    myoutput = myodr.run()
-    return(myoutput.beta[0],myoutput.beta[1],myoutput.sd_beta[0],myoutput.sd_beta[1])
-    #return(myoutput.beta[0],myoutput.beta[1],myoutput.sd_beta[0],myoutput.sd_beta[1])
+def linear_fit_vec(x, y, yerr=None):
+    """
+    Weighted least squares fit of y = a*x + b for every pixel at once
+    x: (N,) e.g. log10 frequencies
+    y: (N, ...) e.g. log10 fluxes of N images
+    yerr: (N, ...) or None, errors on y (0 is treated as 1)
+    Return a, b, sa, sb arrays with the shape of y[0], errors scaled by the residual variance (as odr sd_beta)
+    """
+    x = np.asarray(x, dtype=float).reshape((-1,)+(1,)*(y.ndim-1))
+    if yerr is None: w = np.ones_like(y)
+    else: w = 1/np.where(yerr == 0, 1, yerr)**2
+    S = np.sum(w, axis=0)
+    Sx = np.sum(w*x, axis=0)
+    Sy = np.sum(w*y, axis=0)
+    Sxx = np.sum(w*x*x, axis=0)
+    Sxy = np.sum(w*x*y, axis=0)
+    D = S*Sxx - Sx**2
+    a = (S*Sxy - Sx*Sy)/D
+    b = (Sxx*Sy - Sx*Sxy)/D
+    n = len(x)
+    if n > 2: res_var = np.sum(w*(y - a*x - b)**2, axis=0)/(n-2)
+    else: res_var = np.ones_like(a)
+    sa = np.sqrt(res_var*S/D)
+    sb = np.sqrt(res_var*Sxx/D)
+    return a, b, sa, sb
 
 # if values is > 5 sigma for each map then OK, otherwise do not perform regression
-def badrms(values, rmsvalues):
-  for t in range(len(values)):
-    if (values[t] < 5*rmsvalues[t]): 
-      return False # TURN TO TRUE TO ACTIVATE
-  return False
-
-opt = optparse.OptionParser(usage="%prog images", version="%prog 0.3")
-opt.add_option('-o', '--outimg', help='Output spctral index image [default = spidx.img]', default='estrap.img')
+def badrms(values, rmsvalues, active=False):
+  """
+  values: (N, ...) image stack, rmsvalues: (N,)
+  Return a bool array with True for pixels below 5 sigma in any map (all False unless active)
+  """
+  bad = np.any(values < 5*rmsvalues.reshape((-1,)+(1,)*(values.ndim-1)), axis=0)
+  return bad & active
+
+def write_image(template, outname, data, freq=None):
+  """
+  Write data as an image like template (casa image, or fits if outname ends with .fits)
+  """
+  casaname = outname[:-5]+'.tmpimg' if outname.endswith('.fits') else outname
+  img = pyrap.images.image(template)
+  img.saveas(casaname, overwrite=True)
+  img = pyrap.images.image(casaname)
+  img.putdata(data.reshape(img.shape()))
+  del img
+  if freq is not None:
+    os.system('patchCasaFreq '+casaname+' '+str(freq))
+  if outname.endswith('.fits'):
+    img = pyrap.images.image(casaname)
+    img.tofits(outname, overwrite=True)
+    del img
+    shutil.rmtree(casaname)
+
+opt = optparse.OptionParser(usage="%prog images", version="%prog 0.4")
+opt.add_option('-o', '--outimg', help='Output estrapolated image, .fits for a fits file [default = estrap.img]', default='estrap.img')
 opt.add_option('-m', '--maskimg', help='Mask image tells image_estrapolate.py where perform linear regression')
 opt.add_option('-r', '--rmsfile', help='RMSs file with one entry per line entry like "filename RMS_VALUE"')
 opt.add_option('-f', '--freq', help='Frequency to estrapolate [Hz]' )
+opt.add_option('-b', '--badrms', help='Do not fit pixels below 5 sigma in any map (needs --rmsfile) [default = False]', action='store_true', default=False)
 (options, imglist) = opt.parse_args()
 outimg = options.outimg
 rmsfile = options.rmsfile
@@ -70,54 +93,50 @@ sys.stdout.flush()
 
 # Read RMS values from file
 if (rmsfile != None):
-	print("Reading RMS file: "+rmsfile)
-	try:
-	    rmsdata = np.loadtxt(rmsfile, comments='#', dtype=np.dtype({'names':['file','rms'], 'formats':['S50',float]}))
-	except IOError:
-	    print("ERROR: error opening RMSs file, probably a wring name/format")
-	    exit(1)
-
-# Read images one by one.
+  print("Reading RMS file: "+rmsfile)
+  try:
+    rmsdata = np.loadtxt(rmsfile, comments='#', dtype=np.dtype({'names':['file','rms'], 'formats':['U200',float]}))
+  except IOError:
+    print("ERROR: error opening RMSs file, probably a wring name/format")
+    exit(1)
+
+# Read images one by one (casa images or fits).
 values = []
 frequencies = []
 rmsvalues = []
 for name in imglist:
-    print("--- Reading file: "+name)
+  print("--- Reading file: "+name)
+  try:
+    image = pyrap.images.image(name)
+    # workaround for getting correct axes
+    index = np.where(np.array(image.coordinates().get_names())=='direction')[0][0]
+    imgdata = np.array(image.getdata())
+    for i in range(index):
+      imgdata = imgdata[0]
+    values.append(imgdata)
+    frequencies.append(image.coordinates().get_referencevalue()[0])
+  except:
+    print("ERROR: error accessing iamges data, probably wrong name or data format")
+    exit(1)
+
+  print("Freq: ", image.coordinates().get_referencevalue()[0])
+  if (rmsfile != None):
     try:
-      image = pyrap.images.image(name)
-      # workaround for getting correct axes
-      index = np.where(np.array(image.coordinates().get_names())=='direction')[0][0]
-      imgdata = np.array(image.getdata())
-      for i in range(index):
-        imgdata = imgdata[0]
-      values.append(imgdata)
-      frequencies.append(image.coordinates().get_referencevalue()[0])
-    except:
-      print("ERROR: error accessing iamges data, probably wrong name or data format")
+      rmsvalues.append([rms for (file, rms) in np.atleast_1d(rmsdata) if file == name][0])
+      print("RMS: ", rmsvalues[-1])
+    except IndexError:
+      print("ERROR: error accessing RMSs data, probably wrong names in the file")
       exit(1)
+  else:
+    rmsvalues.append(0)
+  sys.stdout.flush()
 
-    print("Freq: ", image.coordinates().get_referencevalue()[0])
-    if (rmsfile != None):
-      try:
-	rmsvalues.append([rms for (file, rms) in rmsdata  if file == name][0])
-        print("RMS: ", [rms for (file, rms) in rmsdata  if file == name][0])
-      except IndexError:
-	print("ERROR: error accessing RMSs data, probably wrong names in the file")
-	exit(1)
-    else:
-	rmsvalues.append(0)
-    sys.stdout.flush()
-
-values = np.array(values)
-frequencies = np.array(frequencies)
-rmsvalues = np.array(rmsvalues)
+values = np.array(values, dtype=float)
+frequencies = np.array(frequencies, dtype=float)
+rmsvalues = np.array(rmsvalues, dtype=float)
 imgsizeX = values.shape[1]
 imgsizeY = values.shape[2]
 
-# var used if dozone=T
-zoneval4reg=np.zeros(len(imglist))
-zonepixelnum=0
-
 # Read mask image
 if (maskimg):
   print("Reading mask-image = "+maskimg)
@@ -125,51 +144,30 @@ if (maskimg):
   image = pyrap.images.image(maskimg)
   maskimgval = np.array(image.getdata()[0][0])
 else:
-  maskimgval = np.ones(imgsizeX*imgsizeY)
-  maskimgval = maskimgval.reshape(imgsizeX, imgsizeY)
+  maskimgval = np.ones((imgsizeX, imgsizeY))
 
 print("")
-print("Performing regression", end=' ')
+print("Performing regression")
 sys.stdout.flush()
 
-# Make regression pixel by pixel
-estrap = np.empty(imgsizeX*imgsizeY)
-err = np.empty(imgsizeX*imgsizeY)
-estrap = estrap.reshape(imgsizeX, imgsizeY)
-err = err.reshape(imgsizeX, imgsizeY)
-val4reg = np.empty(len(imglist))
-for i in range(0, imgsizeX):
-  for j in range(0, imgsizeY):
-    val4reg=values.transpose()[j][i]
-    # if the mask is set to 0 or rms check is true then skip this pixel
-    if (maskimgval[i][j] == 0 or (rmsfile != None and badrms(val4reg, rmsvalues))):
-      a = np.nan # TODO: set a mask, not to nan
-      b = np.nan # TODO: set a mask, not to nan
-      sa = np.nan # TODO: set a mask, not to nan
-    else:
-      yerr=0.434*rmsvalues/val4reg
-      (a, b, sa, sb) = linear_fit(x=np.log10(frequencies), y=np.log10(val4reg), yerr=yerr)
-
-    estrap[i][j] = np.power(10,(a*np.log10(freq)+b))
-    err[i][j] = -100*sa/a # error in %
-  print(".", end=' ')
-  sys.stdout.flush()
+# Make regression on all pixels at once,
+# if the mask is set to 0 or rms check is true then skip the pixel
+skip = (maskimgval == 0)
+if rmsfile != None: skip |= badrms(values, rmsvalues, active=options.badrms)
+with np.errstate(invalid='ignore', divide='ignore'):
+  yerr = 0.434*rmsvalues.reshape(-1,1,1)/values
+  (a, b, sa, sb) = linear_fit_vec(x=np.log10(frequencies), y=np.log10(values), yerr=yerr)
+  a[skip] = np.nan # TODO: set a mask, not to nan
+  b[skip] = np.nan
+  sa[skip] = np.nan
+  estrap = np.power(10,(a*np.log10(freq)+b))
+  err = -100*sa/a # error in %
 
 # Write data
 print("Writing spidx data.")
-estrapimg = pyrap.images.image(imglist[0])
-estrapimg.saveas(outimg)
-estrapimg = pyrap.images.image(outimg)
-estrapimg.putdata(estrap)
-#estrapimg.tofits(outimg + ".fits")
-del estrapimg
-os.popen('patchCasaFreq '+outimg+' '+str(freq))
-rmsimg = pyrap.images.image(imglist[0])
-rmsimg.saveas(outimg + "-rms")
-rmsimg = pyrap.images.image(outimg + "-rms")
-rmsimg.putdata(err)
-#rmsimg.tofits(outimg + "-rms.fits")
-del rmsimg
+write_image(imglist[0], outimg, estrap, freq)
+if outimg.endswith('.fits'): write_image(imglist[0], outimg[:-5] + "-rms.fits", err)
+else: write_image(imglist[0], outimg + "-rms", err)
 
 print("Done.")
 sys.stdout.flush()
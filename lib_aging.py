@@ -21,6 +21,10 @@ e = 1.602176634e-19 # Coulomb
 eps0 = 8.8541878128e-12 # F/m
 U_cmb = 4.19e-14  # J m-3 CMB energy density at z=0
 
+# Tabulated JP spectra, bump the version if the model or the table layout change
+JP_LOOKUP_FILE = __file__.replace('lib_aging.py','')+'lib_aging_data/JP_lookup.npz'
+JP_LOOKUP_VERSION = 2
+
 def nu_c(E, B, alpha):
     """
     Critical frequency for synchrotron
@@ -47,6 +51,68 @@ def create_F_lookup():
         results = p.map(F_accurate, xvals)
     np.save(__file__.replace('lib_aging.py','')+'lib_aging_data/F(X)_lookup.npy', np.array([xvals, results]))
 
+def jp_x(nu, B, t, z):
+    """
+    Frequency in units of the JP break frequency: x = nu(1+z) / (a B E_cut^2) with E_cut = 1/(t K(B,z)) the energy
+    above which no electrons are left. The normalized JP spectrum depends only on x and the injection index.
+    Parameters
+    ----------
+    nu: float or array, frequency in Hertz
+    B: float or array, magnetic field in Tesla
+    t: float or array, age in Myrs
+    z: float, redshift
+
+    Returns
+    -------
+    x: float or array
+    """
+    a = 3*e/(4*np.pi*m_e**3*c**4) # nu_c = a E^2 B sin(alpha)
+    K = (B**2/(2*mu0) + U_cmb*(1+z)**4)*(4*sigma_T/(3*m_e**2*c**3))
+    return nu*(1+z)*(t*1e6*3.154e7*K)**2/(a*B)
+
+def jp_norm(nu, B, iidx, z, N0=1.):
+    """
+    Flux density normalization such that S = jp_norm * H(x, iidx), with H tabulated in the JP lookup table.
+    This is the evaluate_grid() prefactor times the power-law scaling (nu(1+z)/(a B))^-iidx.
+    """
+    a = 3*e/(4*np.pi*m_e**3*c**4)
+    C0 = (z+1)**-2*N0*3**0.5*e**3*B/(8*np.pi*eps0*c*m_e)
+    return C0*(nu*(1+z)/(a*B))**-iidx
+
+def _JP_lookup_row(iidx, logx, nE, nsegE, nalpha):
+    # one injection index of the JP table: evaluate a reference source at the ages that give the requested x
+    nu0, B0 = 1.4e9, 5e-10 # at these values the electrons are far from E_min and E_max
+    t = np.sqrt(10**logx/jp_x(nu0, B0, 1., 0.)) # x scales as t^2
+    S = S_model().evaluate_grid(nu0, B0, iidx, t, 0., nE=nE, nsegE=nsegE, nalpha=nalpha)
+    with np.errstate(divide='ignore'):
+        return np.maximum(np.log10(S/jp_norm(nu0, B0, iidx, 0.)), -300)
+
+def create_JP_lookup(iidx_range=(0.2, 1.5), n_iidx=53, logx_range=(-6, 2.5), n_x=681, ncpu=None, nE=16, nsegE=32, nalpha=48):
+    """
+    Tabulate the JP spectrum shape log10 H(log10 x, iidx) (see jp_x() and jp_norm()) and save it in JP_LOOKUP_FILE.
+    Age, magnetic field and redshift only enter through x, so the table covers any (nu, B, t, z).
+    The injection indices are computed in parallel on ncpu processes (default: all).
+    """
+    iidx = np.linspace(*iidx_range, n_iidx)
+    logx = np.linspace(*logx_range, n_x)
+    with mp.Pool(ncpu) as p:
+        logH = p.starmap(_JP_lookup_row, [(i, logx, nE, nsegE, nalpha) for i in iidx])
+    np.savez(JP_LOOKUP_FILE, version=JP_LOOKUP_VERSION, iidx=iidx, logx=logx, logH=np.array(logH))
+    log.info('Saved JP lookup table (%i injection indices x %i frequencies) in %s' % (n_iidx, n_x, JP_LOOKUP_FILE))
+
+def load_JP_lookup():
+    """
+    Load the JP lookup table and return an interpolator of log10 H on the (iidx, log10 x) grid.
+    """
+    try:
+        lookup = np.load(JP_LOOKUP_FILE)
+    except FileNotFoundError:
+        raise FileNotFoundError('Missing %s, create it with: lib_aging.py --build_JP_lookup' % JP_LOOKUP_FILE)
+    if lookup['version'] != JP_LOOKUP_VERSION:
+        raise ValueError('%s has version %i, expected %i. Recreate it with: lib_aging.py --build_JP_lookup' % \
+                         (JP_LOOKUP_FILE, lookup['version'], JP_LOOKUP_VERSION))
+    return interpolate.RegularGridInterpolator((lookup['iidx'], lookup['logx']), lookup['logH'])
+
 def n_e(E, iidx, B, t, z):
     """
     Electron density taking into account Jaffe-Perola + IC losses
@@ -144,6 +210,7 @@ class S_model():
             xF_dat = np.load(f)
         self.F_interp = interpolate.InterpolatedUnivariateSpline(xF_dat[0], xF_dat[1], ext=0, check_finite=False)
         self.epsrel = epsrel
+        self.JP_interp = None # loaded on first use of evaluate_lookup()
 
     def evaluate(self, nu, B, iidx, t, z, N0=1.):
         """
@@ -234,24 +301,130 @@ class S_model():
         return C0*integrate.dblquad(integrand, 0, np.pi, E_min, E_max, epsrel=self.epsrel)[0] # rough integration
 
     def F(self, x):
-        return np.vectorize(self._F)(x)
-
-    def _F(self, x):
         # F(x): Use asymptotes below and above, in between interpolate lookup table
         # Mourad Fouka1and Saad Ouichaoui, 2013
-        if x > 25:
-            return np.sqrt(np.pi*x/2)*np.exp(-x)
-        elif x < 1e-4:
-            return np.pi*2**(5/3)/(special.gamma(1/3)*np.sqrt(3))*x**(1/3)
-        else:
-            return self.F_interp(x)
+        x = np.asarray(x, dtype=float)
+        result = np.empty_like(x)
+        high = x > 25
+        low = x < 1e-4
+        mid = ~(high | low)
+        result[high] = np.sqrt(np.pi*x[high]/2)*np.exp(-x[high])
+        result[low] = np.pi*2**(5/3)/(special.gamma(1/3)*np.sqrt(3))*x[low]**(1/3)
+        result[mid] = self.F_interp(x[mid])
+        return result[()] # scalar if x is scalar
+
+    def evaluate_grid(self, nu, B, iidx, t, z, N0=1., nE=16, nsegE=32, nalpha=48):
+        """
+        Same as evaluate() but vectorized: nu, B and t can be arrays (broadcast together, e.g. nu[np.newaxis,:]
+        and t[:,np.newaxis] for spectra at many ages) and are all computed at once.
+        The integral is done on a fixed grid: composite Gauss-Legendre in log E (nsegE segments of nE nodes up to
+        the JP energy cutoff, denser towards the cutoff) and Gauss-Legendre in pitch angle (nalpha nodes).
+        Parameters
+        ----------
+        nu: float or numpy array
+            Frequency in Hertz
+        B: float or numpy array
+            B in Tesla
+        iidx: float
+            Injection index, positive definition
+        t: float, or numpy array
+            Age in Myrs
+        z: float
+            Redshift
+        N0: float,
+            Normaliation factor, optional.
+
+        Returns
+        -------
+        flux density: float or numpy array
+            Arbitrary units
+        """
+        nu, B, t = np.broadcast_arrays(np.asarray(nu, dtype=float), np.asarray(B, dtype=float), np.asarray(t, dtype=float))
+        shape = nu.shape
+        nu = nu.flatten()*(1+z) # redshift frequency
+        B = B.flatten()
+        t = t.flatten()*1e6*3.154e7 # Myrs to seconds
+        C0 = (z+1)**-2*N0*3**0.5*e**3*B/(8*np.pi*eps0*c*m_e)
+        E_min, E_max = 0.5e6*1.60218e-19, 1.e11*1.60218e-19 # eV, TODO: units...
+
+        # n_e(E) is zero above the energy where beta=1
+        K = t*(B**2/(2*mu0) + U_cmb*(1+z)**4)*(4*sigma_T/(3*m_e**2*c**3))
+        with np.errstate(divide='ignore'):
+            logE_up = np.minimum(np.log10(E_max), -np.log10(K))
+
+        # quadrature nodes and weights on [0,1]
+        x, w = np.polynomial.legendre.leggauss(nE)
+        x, w = (x+1)/2, w/2
+        v = ((np.arange(nsegE)[:,np.newaxis] + x)/nsegE).flatten()
+        # u = 1-(1-v)^2 packs the nodes towards the cutoff, where (1-beta)^(2*iidx-1) is not smooth
+        u = 1 - (1-v)**2
+        wu = np.tile(w/nsegE, nsegE)*2*(1-v)
+        x, w = np.polynomial.legendre.leggauss(nalpha)
+        alpha = 1e-4 + (np.pi-1e-4)*(x+1)/2
+        walpha = (np.pi-1e-4)*w/2
+        sin_alpha = np.sin(alpha)
+
+        result = np.zeros(len(nu))
+        # do few points at a time to limit memory, arrays are (point, E, alpha)
+        step = max(1, int(2e6/(len(u)*nalpha)))
+        for i in range(0, len(nu), step):
+            s = slice(i, i+step)
+            logE_range = np.maximum(logE_up[s]-np.log10(E_min), 0)
+            logE = np.log10(E_min) + logE_range[:,np.newaxis]*u # (point, E)
+            E = 10**logE
+            beta = E*K[s,np.newaxis]
+            n = E**(-2*iidx-1)*np.clip(1-beta, 0, None)**((2*iidx+1)-2)
+            n[beta >= 1] = 0.
+            x = nu[s,np.newaxis,np.newaxis]/nu_c(E[:,:,np.newaxis], B[s,np.newaxis,np.newaxis], alpha)
+            integrand = np.log(10)*(E*n)[:,:,np.newaxis]*self.F(x)*0.5*sin_alpha**2
+            integrand[np.isnan(integrand)] = 0.0  # case zero times infinity
+            result[s] = logE_range*np.einsum('pea,e,a->p', integrand, wu, walpha)
+        return (C0*result).reshape(shape)[()]
+
+    def evaluate_lookup(self, nu, B, iidx, t, z, N0=1., method='linear'):
+        """
+        Same as evaluate_grid() but interpolated in the precomputed JP lookup table (see create_JP_lookup()).
+        Below the table the spectrum is a power law, above it the flux is set to zero.
+        Parameters
+        ----------
+        nu: float or numpy array
+            Frequency in Hertz
+        B: float or numpy array
+            B in Tesla
+        iidx: float or numpy array
+            Injection index, positive definition
+        t: float, or numpy array
+            Age in Myrs
+        z: float
+            Redshift
+        N0: float,
+            Normaliation factor, optional.
+        method: str,
+            Interpolation in the table, 'linear' or 'cubic'.
+
+        Returns
+        -------
+        flux density: float or numpy array
+            Arbitrary units
+        """
+        if self.JP_interp is None:
+            self.JP_interp = load_JP_lookup()
+        iidx_grid, logx_grid = self.JP_interp.grid
+        nu, B, iidx, t = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (nu, B, iidx, t)])
+        if np.any((iidx < iidx_grid[0]) | (iidx > iidx_grid[-1])):
+            raise ValueError('Injection index outside of the JP lookup table (%.2f-%.2f).' % (iidx_grid[0], iidx_grid[-1]))
+        with np.errstate(divide='ignore'):
+            logx = np.log10(jp_x(nu, B, t, z))
+        logH = self.JP_interp(np.stack([iidx, np.clip(logx, logx_grid[0], logx_grid[-1])], axis=-1), method=method).reshape(nu.shape)
+        S = np.where(logx > logx_grid[-1], 0., jp_norm(nu, B, iidx, z, N0)*10**logH)
+        return S[()]
 
 
 def get_si(nu1, nu2, S1, S2):
     return np.log(S1 / S2) / np.log(nu1 / nu2)
 
 
-def get_aging_si(nu1, nu2, B, injection_index, times, z, model=None):
+def get_aging_si(nu1, nu2, B, injection_index, times, z, model=None, lookup=False):
     """
     Return the Jaffe-Perola aging path in a color-color plot.
     Parameters
@@ -268,20 +441,18 @@ def get_aging_si(nu1, nu2, B, injection_index, times, z, model=None):
         times at which to evaluate the SI in Myr
     z: float
         Redshift
+    lookup: bool
+        Interpolate in the JP lookup table instead of integrating
     Returns
     -------
     si: array, sequence of the  spectral indices at different times
     """
-    try:
-        times[0]
-    except IndexError:
-        times = [times]
-    S_array = np.zeros((len(times), 2))
+    times = np.atleast_1d(np.array(times, dtype=float))
     if model is None:
         model = S_model()
-    for i, t in enumerate(times):
-        S_array[i,0] = model.evaluate(nu1, B, injection_index, t, z)
-        S_array[i,1] = model.evaluate(nu2, B, injection_index, t, z)
+    # all times at once, S_array is (time, freq)
+    evaluate = model.evaluate_lookup if lookup else model.evaluate_grid
+    S_array = evaluate(np.array([nu1, nu2])[np.newaxis,:], B, injection_index, times[:,np.newaxis], z)
     si = get_si(nu1, nu2, S_array[:,0], S_array[:,1])
     return si
 
@@ -341,10 +512,8 @@ def get_model_si_vs_B(nu1, nu2, B_range, injection_index, z, t):
     -------
     si: array, sequence of the  spectral indices at different times
     """
-    S_array = np.zeros((len(B_range), 2))
-    for i, B in enumerate(B_range):
-        S_array[i,0] = S_model(nu1, B, injection_index, t, z)
-        S_array[i,1] = S_model(nu2, B, injection_index, t, z)
+    # all B at once, S_array is (B, freq)
+    S_array = S_model().evaluate_grid(np.array([nu1, nu2])[np.newaxis,:], np.array(B_range)[:,np.newaxis], injection_index, t, z)
     si = get_si(nu1, nu2, S_array[:,0], S_array[:,1])
     return si
 
@@ -383,11 +552,9 @@ def plot_S_model():
     sed = synch.sed_flux(nu_range*u.Hz)
     sed = sed.value / nu_range
 
-    results = np.zeros((len(age_range), len(nu_range)))
-    for i, age in enumerate(age_range):
-        with mp.Pool() as p:
-            results[i] = p.starmap(S_model, [[nu, B, 0.65, 1000, age] for nu in nu_range])
-        print(results[i], nu_range)
+    # spectra at all ages at once, results is (age, freq)
+    results = S_model().evaluate_grid(nu_range[np.newaxis,:], B, 0.65, age_range[:,np.newaxis], 0.001)
+    print(results, nu_range)
 
     PL = (nu_range**-0.65)
     PL /= (PL[0]/sed[0])
@@ -410,3 +577,49 @@ def plot_S_model():
     plt.legend()
     plt.savefig(__file__.replace('lib_aging.py','')+'lib_aging_data/synch_vs_nu.png')
 
+def test_evaluate_grid():
+    # regression test of the vectorized integration against the dblquad one and a finer grid
+    # NOTE: for old electrons at high frequency dblquad can miss the sharp JP cutoff in energy
+    # (~1% off at 200 Myr and 5 GHz), the fixed grid integrates up to the cutoff
+    from time import time
+    model = S_model()
+    nu_range = np.array([50e6, 144e6, 400e6, 1.4e9, 5e9])
+    age_range = np.array([0., 20., 60., 120., 200.])
+    B, iidx, z = 5e-10, 0.65, 0.1
+    t1 = time()
+    S_grid = model.evaluate_grid(nu_range[np.newaxis,:], B, iidx, age_range[:,np.newaxis], z)
+    t2 = time()
+    S_quad = np.array([[model.evaluate(nu, B, iidx, age, z) for nu in nu_range] for age in age_range])
+    t3 = time()
+    print("Time grid: {:.3f} s - dblquad: {:.3f} s".format(t2-t1, t3-t2))
+    print("Max relative difference: {}".format(np.max(np.abs(S_grid/S_quad-1))))
+    np.testing.assert_allclose(S_grid[:-1], S_quad[:-1], rtol=1e-3)
+    np.testing.assert_allclose(S_grid[-1,:-1], S_quad[-1,:-1], rtol=1e-3)
+    for iidx in [0.25, 0.65, 1.4]:
+        S_grid = model.evaluate_grid(nu_range[np.newaxis,:], B, iidx, age_range[:,np.newaxis], z)
+        S_fine = model.evaluate_grid(nu_range[np.newaxis,:], B, iidx, age_range[:,np.newaxis], z, nsegE=256)
+        np.testing.assert_allclose(S_grid, S_fine, rtol=1e-4)
+
+def test_evaluate_lookup():
+    # the lookup table has to reproduce the integration for other B and z than the ones used to build it
+    model = S_model()
+    nu_range = np.array([50e6, 144e6, 400e6, 1.4e9, 5e9])
+    age_range = np.array([0., 20., 60., 120., 200.])
+    for B, iidx, z in [(5e-10, 0.65, 0.1), (2e-10, 0.83, 0.5), (1e-9, 0.5, 0.)]:
+        S_grid = model.evaluate_grid(nu_range[np.newaxis,:], B, iidx, age_range[:,np.newaxis], z)
+        S_lookup = model.evaluate_lookup(nu_range[np.newaxis,:], B, iidx, age_range[:,np.newaxis], z)
+        np.testing.assert_allclose(S_lookup, S_grid, rtol=2e-2)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Create the lookup tables of lib_aging in lib_aging_data/.')
+    parser.add_argument('--build_F_lookup', action='store_true', help='Tabulate the synchrotron kernel F(x).')
+    parser.add_argument('--build_JP_lookup', action='store_true', help='Tabulate the JP spectra for evaluate_lookup().')
+    parser.add_argument('--ncpu', default=None, type=int, help='Number of processes, default: all.')
+    args = parser.parse_args()
+    log.basicConfig(level=log.INFO)
+
+    if args.build_F_lookup:
+        create_F_lookup()
+    if args.build_JP_lookup:
+        create_JP_lookup(ncpu=args.ncpu)
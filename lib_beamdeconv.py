@@ -246,26 +246,161 @@ def convolve(A1,B1,C1,A2,B2,C2):
     k = np.log(factor*2.)
     return A,B,C#,factor
 
-def findCommonBeam(beams, debugplots=False, confidence=0.005):
+def commonBeamQuadratic(beamsQuad, tol=1e-9):
+    '''Given the quadratic parametrization (A_i,B_i,C_i) of N beams return the (A,B,C) of the common beam of minimal area.
+    
+    In quadratic form a beam is the matrix M = [[A,B/2],[B/2,C]] and beam i can be deconvolved from the common beam
+    if M_i - M is positive definite. The area scales as 1/sqrt(det M), so this is the convex problem:
+    maximize log det M subject to M_i - M > 0 for all i (the minimum-area ellipse enclosing all beams).
+    It is solved with a log-barrier Newton method in the 3 parameters, all beams are handled at once as arrays.
+    The solution is strictly inside the constraints and its log det is within `tol` of the optimum.'''
+    Q = np.array(beamsQuad, dtype=np.double).reshape(-1,3)
+    N = len(Q)
+    Hdet = np.array([[0.,0.,1.],[0.,-0.5,0.],[1.,0.,0.]]) # hessian of det = A*C - B**2/4
+    def det(q):
+        return q[...,0]*q[...,2] - q[...,1]**2/4.
+    def logdetDerivs(q):
+        # gradient and hessian of log det for (...,3) quadratic parameters
+        d = det(q)
+        g = np.stack([q[...,2], -q[...,1]/2., q[...,0]], axis=-1)/d[...,np.newaxis]
+        h = Hdet/d[...,np.newaxis,np.newaxis] - g[...,:,np.newaxis]*g[...,np.newaxis,:]
+        return g, h
+    def feasible(m):
+        D = Q - m
+        return m[0] > 0 and det(m) > 0 and np.all(D[:,0] > 0) and np.all(det(D) > 0)
+    def barrier(m, mu):
+        return -np.log(det(m)) - mu*np.sum(np.log(det(Q - m)))
+    # strictly feasible start: a circle inside all beams (half the smallest eigenvalue)
+    lamMin = (Q[:,0] + Q[:,2])/2. - np.sqrt((Q[:,0] - Q[:,2])**2 + Q[:,1]**2)/2.
+    m = np.array([0.5*lamMin.min(), 0., 0.5*lamMin.min()])
+    mu = 1.
+    while True:
+        for i in range(100):
+            g0, h0 = logdetDerivs(m)
+            gi, hi = logdetDerivs(Q - m)
+            grad = -g0 + mu*np.sum(gi, axis=0)
+            hess = -h0 - mu*np.sum(hi, axis=0)
+            step = -np.linalg.solve(hess, grad)
+            decrement = -np.dot(grad, step)
+            if decrement/2. < 1e-12:
+                break
+            # backtracking line search, staying inside the constraints
+            t = 1.
+            f = barrier(m, mu)
+            while not feasible(m + t*step) or barrier(m + t*step, mu) > f - 0.25*t*decrement:
+                t /= 2.
+                if t < 1e-20: break
+            m = m + t*step
+        # each 2x2 log det barrier contributes 2*mu to the duality gap
+        if 2*N*mu < tol:
+            break
+        mu /= 10.
+    return tuple(m)
+
+def elliptic2quadratic_vec(beams, k=np.log(2)):
+    '''Vectorized elliptic2quadratic() for centered beams.
+    beams: (...,3) array of bmaj,bmin,bpa (pa in deg)
+    return (...,3) array of A,B,C'''
+    beams = np.asarray(beams, dtype=np.double)
+    a0 = k/(beams[...,0]/2.)**2
+    c0 = k/(beams[...,1]/2.)**2
+    theta = (beams[...,2] + 90.)*np.pi/180.
+    cos2 = np.cos(theta)**2
+    sin2 = np.sin(theta)**2
+    return np.stack([a0*cos2 + c0*sin2, (a0 - c0)*np.sin(2.*theta), c0*cos2 + a0*sin2], axis=-1)
+
+
+def quadratic2elliptic_vec(quads, F=-np.log(2)):
+    '''Vectorized quadratic2elliptic() for centered beams.
+    quads: (...,3) array of A,B,C
+    return (...,3) array of bmaj,bmin,bpa (pa in deg) and a (...) boolean mask of the valid solutions.
+    Invalid entries (parabolic, degenerate or hyperbolic cases where the scalar version fails) are NaN.
+    As in the scalar version, inf quadratic parameters (delta function) give 0,0,0.'''
+    quads = np.asarray(quads, dtype=np.double)
+    A, B, C = quads[...,0], quads[...,1], quads[...,2]
+    delta = np.isinf(A) & np.isinf(B) & np.isinf(C)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        phi = np.where(A != C, np.arctan2(B, A-C)/2., 0.)
+        c = np.cos(phi)
+        s = np.sin(phi)
+        A1 = A*c*c + B*c*s + C*s*s
+        C1 = A*s*s - B*c*s + C*c*c
+        bmaj = np.sign(A1)*2.*np.sqrt(-F/np.abs(A1))
+        bmin = np.sign(C1)*2.*np.sqrt(-F/np.abs(C1))
+        valid = (B**2 - 4*A*C != 0) & (A1 != 0) & (C1 != 0) & (bmaj*bmin > 0)
+    swap = bmin > bmaj
+    result = np.stack([np.where(swap, bmin, bmaj), np.where(swap, bmaj, bmin), phi*180./np.pi], axis=-1)
+    result[~valid] = np.nan
+    result[delta] = 0.
+    return result, valid | delta
+
+
+def deconvolve_vec(quads1, quads2):
+    '''Vectorized deconvolve(): solves G(quads1) = convolution(G(quads2), G(quadsk)) for (...,3) arrays of A,B,C
+    (broadcast together, e.g. one target beam and many beams).
+    Returns the (...,3) array of Ak,Bk,Ck and a (...) boolean mask of the valid solutions.
+    Delta function solutions are (inf,inf,inf), invalid ones are NaN.'''
+    quads1, quads2 = np.broadcast_arrays(np.asarray(quads1, dtype=np.double), np.asarray(quads2, dtype=np.double))
+    A1, B1, C1 = quads1[...,0], quads1[...,1], quads1[...,2]
+    A2, B2, C2 = quads2[...,0], quads2[...,1], quads2[...,2]
+    D = B1**2 - 2*B1*B2 + B2**2 - 4*A1*C1 + 4* A2* C1 + 4* A1* C2 - 4* A2* C2
+    delta = np.abs(D) < 10*(1-2./3.-1./3.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.stack([(-A2* B1**2 + A1* B2**2 + 4* A1* A2* C1 - 4* A1* A2* C2)/D,
+                           (-B1**2 *B2 + B1* B2**2 + 4* A1* B2* C1 - 4* A2* B1* C2)/D,
+                           (B2**2 *C1 - B1**2 *C2 + 4* A1* C1* C2 - 4* A2* C1* C2)/D], axis=-1)
+        valid = result[...,1]**2 - 4*result[...,0]*result[...,2] != 0
+    result[~valid] = np.nan
+    result[delta] = np.inf
+    return result, valid | delta
+
+
+def convolve_vec(quads1, quads2):
+    '''Vectorized convolve() for (...,3) arrays of A,B,C (broadcast together).
+    Returns the (...,3) array of A,B,C and a (...) boolean mask of the valid solutions, invalid ones are NaN.'''
+    quads1, quads2 = np.broadcast_arrays(np.asarray(quads1, dtype=np.double), np.asarray(quads2, dtype=np.double))
+    A1, B1, C1 = quads1[...,0], quads1[...,1], quads1[...,2]
+    A2, B2, C2 = quads2[...,0], quads2[...,1], quads2[...,2]
+    D1 = 4.*A1*C1 - B1**2
+    D2 = 4.*A2*C2 - B2**2
+    D3 = -2.*B1 * B2 + 4.*A2*C1 + 4.*A1*C2 + D1+D2
+    D4 = C2*D1+C1*D2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = 2.*np.pi*np.sqrt(D1 + 0j)*np.sqrt(D2 + 0j)/np.sqrt(D3/D4 + 0j)/np.sqrt(D4/(D1*D2) + 0j)
+        valid = (D1*D2*D3*D4 != 0) & (D3 >= 0) & (np.abs(np.imag(factor)) <= 10.*(7./3 - 4./3 - 1.))
+        result = np.stack([(A2*D1 + A1 * D2)/D3, (B2*D1+B1*D2)/D3, D4/D3], axis=-1)
+    result[~valid] = np.nan
+    return result, valid
+
+
+def deconvolve_ell_vec(t_beams, beams):
+    '''Vectorized deconvolve_ell(): the beams to convolve (...,3) `beams` with to get `t_beams`,
+    all in elliptical coordinates (bmaj,bmin,bpa) and broadcast together.
+    E.g. deconvolve_ell_vec(target_beam, channel_beams) gives the kernels of all channels at once.
+    Returns the (...,3) array of bmaj,bmin,bpa and a (...) boolean mask of the valid solutions.'''
+    quads, valid = deconvolve_vec(elliptic2quadratic_vec(t_beams), elliptic2quadratic_vec(beams))
+    result, valid_ell = quadratic2elliptic_vec(quads)
+    return result, valid & valid_ell
+
+
+def findCommonBeam(beams, debugplots=False, confidence=0.005, mc=False):
     '''Given a list `beams` where each element of beams is a list of elliptic beam parameters (bmaj_i,bmin_i, bpa_i)
     with bpa in degrees
     return the beam parameters of the common beam of minimal area.
     
     Common beam means that all beams can be convolved to the common beam.
     
+    By default the minimal beam is computed deterministically with commonBeamQuadratic().
+    If `mc` is True the old Metropolis-Hastings search is used instead.
+    
     `confidence` parameter is basically how confident you want solution. So 0.01 is knowing solution to 1%.
     Specifically it's how long to sample so that there are enough statistics to properly sample likelihood with required accuracy.
-    default is 0.005. Computation time scale inversely with it.'''
+    default is 0.005. Computation time scale inversely with it. Only used if `mc` is True.'''
     def beamArea(bmaj,bmin,bpa=None):
         return bmaj*bmin*np.pi/4./np.log(2.)
     def isCommonBeam(beamCandQuad,beamsQuad):
-        for beamQuad in beamsQuad:
-            try:
-                Ak,Bk,Ck = deconvolve(beamCandQuad[0],beamCandQuad[1],beamCandQuad[2],beamQuad[0],beamQuad[1],beamQuad[2])
-                bmaj,bmin,bpa = quadratic2elliptic(Ak,Bk,Ck)
-            except:
-                return False
-        return True 
+        quadsK, valid = deconvolve_vec(beamCandQuad, beamsQuad)
+        return np.all(valid & quadratic2elliptic_vec(quadsK)[1])
     def samplePrior(beamLast, beamsQuad):
         iter = 0
         while True:
@@ -310,42 +445,45 @@ def findCommonBeam(beams, debugplots=False, confidence=0.005):
     else:
         bmajMax = np.max(beams,axis=0)[0]
         beam0 = [bmajMax,bmajMax,0.]
-    #MC search, 1/binning = confidence
-    binning = int(1./confidence)
-    Nmax = 1e6
-    beamsMH = np.zeros([binning*binning,3],dtype=np.double)
-    beamsMul = np.zeros(binning*binning,dtype=np.double)
-    beamsMH[0,:] = beam0
-    beamsMul[0] = 1
-    accepted = 1
-    Si = misfit(beam0,areaLargest)
-    Li = np.exp(-Si)
-    maxL = Li
-    maxLBeam = beam0
-    iter = 0
-    while accepted < binning**2 and iter < Nmax:
-        beam_j = samplePrior(beamsMH[accepted-1], beamsQuad)
-        Sj = misfit(beam_j,areaLargest)
-        Lj = np.exp(-Sj)
-        #print("Sj = {}".format(Sj))
-        if Sj < Si or np.log(np.random.uniform()) < Si - Sj:
-            Si = Sj
-            beamsMH[accepted,:] = beam_j
-            beamsMul[accepted] += 1
-            #print("Accepted")
-            accepted += 1
-        else:
-            beamsMul[accepted-1] += 1
-        if Lj > maxL:
-            maxL = Lj
-            maxLBeam = beam_j
-        iter += 1
-    if accepted == binning**2:
-        pass
-        #print("Converged in {} steps with an acceptance rate of {}".format(iter,float(accepted)/iter))
+    if not mc:
+        maxLBeam = list(quadratic2elliptic(*commonBeamQuadratic(beamsQuad)))
     else:
-        beamsMH = beamsMH[:iter,:]
-        beamsMul = beamsMul[:iter]
+        #MC search, 1/binning = confidence
+        binning = int(1./confidence)
+        Nmax = 1e6
+        beamsMH = np.zeros([binning*binning,3],dtype=np.double)
+        beamsMul = np.zeros(binning*binning,dtype=np.double)
+        beamsMH[0,:] = beam0
+        beamsMul[0] = 1
+        accepted = 1
+        Si = misfit(beam0,areaLargest)
+        Li = np.exp(-Si)
+        maxL = Li
+        maxLBeam = beam0
+        iter = 0
+        while accepted < binning**2 and iter < Nmax:
+            beam_j = samplePrior(beamsMH[accepted-1], beamsQuad)
+            Sj = misfit(beam_j,areaLargest)
+            Lj = np.exp(-Sj)
+            #print("Sj = {}".format(Sj))
+            if Sj < Si or np.log(np.random.uniform()) < Si - Sj:
+                Si = Sj
+                beamsMH[accepted,:] = beam_j
+                beamsMul[accepted] += 1
+                #print("Accepted")
+                accepted += 1
+            else:
+                beamsMul[accepted-1] += 1
+            if Lj > maxL:
+                maxL = Lj
+                maxLBeam = beam_j
+            iter += 1
+        if accepted == binning**2:
+            pass
+            #print("Converged in {} steps with an acceptance rate of {}".format(iter,float(accepted)/iter))
+        else:
+            beamsMH = beamsMH[:iter,:]
+            beamsMul = beamsMul[:iter]
     if debugplots:
         import pylab as plt
 #         plt.hist(beamsMH[:,0],bins=binning)
@@ -377,8 +515,34 @@ def findCommonBeam(beams, debugplots=False, confidence=0.005):
     return maxLBeam
     
 def fftGaussian(A,B,C,X,Y):
+    '''Fourier transform of gaussian(A,B,C,x,y), X and Y are frequencies in cycles per unit of x and y'''
     D = 4*A*C-B**2
-    return 2*np.pi/np.sqrt(D)*np.exp(-4*np.pi/D*(-C*X**2 +B*X*Y -A*Y**2))
+    return 2*np.pi/np.sqrt(D)*np.exp(-4*np.pi**2/D*(C*X**2 -B*X*Y +A*Y**2))
+
+def convolveGaussianFFT(data, bmaj, bmin, bpa, preserve_nan=True):
+    '''Convolve a 2D array with a unit-sum elliptical gaussian of bmaj,bmin (FWHM in pixels) and bpa (deg), oriented
+    as EllipticalGaussian2DKernel(..., (90+bpa)*np.pi/180.), multiplying by the analytic transfer function fftGaussian().
+    NaNs and everything outside the array are missing data: they are excluded with a normalized convolution
+    conv(data)/conv(mask), the array is zero padded by 3 FWHM to avoid wrap-around.
+    If `preserve_nan` NaN pixels stay NaN, otherwise they are interpolated.'''
+    from scipy import fft
+    A,B,C = elliptic2quadratic(bmaj,bmin,bpa)
+    pad = int(np.ceil(3*bmaj))
+    shape = [fft.next_fast_len(n + pad, real=True) for n in data.shape]
+    X = fft.rfftfreq(shape[1])[np.newaxis,:]
+    Y = fft.fftfreq(shape[0])[:,np.newaxis]
+    transfer = fftGaussian(A,B,C,X,Y)/fftGaussian(A,B,C,0.,0.)
+    def conv(a):
+        return fft.irfft2(fft.rfft2(a, shape)*transfer, shape)[:data.shape[0],:data.shape[1]]
+    mask = np.isfinite(data)
+    num = conv(np.where(mask, data, 0.))
+    den = conv(mask.astype(np.double))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = num/den
+    result[den < 1e-8] = np.nan # too far from any valid pixel
+    if preserve_nan:
+        result[~mask] = np.nan
+    return result
 
 def gaussian(A,B,C,X,Y):
     return np.exp(-A*X**2 - B*X*Y - C*Y**2)
@@ -439,7 +603,7 @@ def test_deltaFunctionDeconvolve():
     return True
 
 def test_timing():
-    from time import clock
+    from time import time as clock
     i = 0
     t1 = clock()
     for i in range(10000):
@@ -461,7 +625,63 @@ def test_timing():
         
         bmaj2_,bmin2_,bpa2_ = quadratic2elliptic(Ak,Bk,Ck)
     print(("Time avg. ~ {} seconds".format((clock()-t1)/10000)))
+    # same with the vectorized functions
+    beams1 = np.random.uniform(size=(10000,3))*[1.,1.,180.] - [0.,0.,90.]
+    beams1[:,1] *= beams1[:,0]
+    beams2 = np.random.uniform(size=(10000,3))*[1.,1.,180.] - [0.,0.,90.]
+    beams2[:,1] *= beams2[:,0]
+    t1 = clock()
+    quads1 = elliptic2quadratic_vec(beams1)
+    quadsC, valid = convolve_vec(quads1, elliptic2quadratic_vec(beams2))
+    quadsK, valid = deconvolve_vec(quadsC, quads1)
+    beams2_, valid = quadratic2elliptic_vec(quadsK)
+    print(("Time avg. vectorized ~ {} seconds".format((clock()-t1)/10000)))
+
+def test_vec(N=1000):
+    # vectorized functions must give the same as the scalar ones
+    np.random.seed(1234)
+    beams1 = np.random.uniform(size=(N,3))*[1.,1.,180.] - [0.,0.,90.]
+    beams1[:,1] *= beams1[:,0]
+    beams2 = np.random.uniform(size=(N,3))*[1.,1.,180.] - [0.,0.,90.]
+    beams2[:,1] *= beams2[:,0]
+    quads1 = elliptic2quadratic_vec(beams1)
+    quads2 = elliptic2quadratic_vec(beams2)
+    assert np.allclose(quads1, [elliptic2quadratic(*b) for b in beams1])
+    assert np.allclose(quadratic2elliptic_vec(quads1)[0], beams1)
+    quadsC, valid = convolve_vec(quads1, quads2)
+    assert np.all(valid) and np.allclose(quadsC, [convolve(*q1,*q2) for q1, q2 in zip(quads1, quads2)])
+    quadsK, valid = deconvolve_vec(quadsC, quads1)
+    assert np.all(valid) and np.allclose(quadsK, [deconvolve(*qC,*q1) for qC, q1 in zip(quadsC, quads1)])
+    assert np.allclose(quadratic2elliptic_vec(quadsK)[0], [quadratic2elliptic(*qK) for qK in quadsK])
+    # beams larger than the target cannot be deconvolved
+    beamsK, valid = deconvolve_ell_vec([0.5,0.5,0.], beams1)
+    for b, bK, v in zip(beams1, beamsK, valid):
+        try:
+            bK_scalar = deconvolve_ell(0.5,0.5,0.,*b)
+        except AssertionError:
+            bK_scalar = None
+        assert (bK_scalar is None and not v) or (v and np.allclose(bK, bK_scalar))
+    # delta function
+    beamsK, valid = deconvolve_ell_vec(beams1, beams1)
+    assert np.all(valid) and np.all(beamsK == 0)
+    return True
         
+def test_convolveGaussianFFT():
+    # away from the edges and the blanked pixels it must be the same as the image-space convolution
+    from astropy import convolution
+    np.random.seed(1234)
+    data = np.random.normal(size=(300,400))
+    data[100:110,200:230] = np.nan
+    bmaj, bmin, bpa = 12., 5., 30.
+    fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
+    gauss_kern = EllipticalGaussian2DKernel(bmaj*fwhm2sigma, bmin*fwhm2sigma, (90+bpa)*np.pi/180.)
+    conv_ref = convolution.convolve(data, gauss_kern, boundary=None, preserve_nan=True)
+    conv_fft = convolveGaussianFFT(data, bmaj, bmin, bpa)
+    inner = (slice(50,-50), slice(50,-50))
+    assert np.array_equal(np.isnan(conv_ref[inner]), np.isnan(conv_fft[inner]))
+    assert np.nanmax(np.abs(conv_ref[inner] - conv_fft[inner])) < 1e-3*np.nanstd(conv_ref[inner])
+    return True
+
 def test_findCommonBeam():
     np.random.seed(1234)
     for i in range(10):
@@ -473,3 +693,26 @@ def test_findCommonBeam():
             beams.append((bmaj,bmin,bpa))
         commonBeam = findCommonBeam(beams,debugplots=True)
         print(("Common beam amongst {} is {}".format(beams,commonBeam)))
+
+def test_commonBeamQuadratic(N=300):
+    # all beams must deconvolve from the common beam, and the common beam must be at least as small as the MC one
+    from time import time
+    np.random.seed(1234)
+    beams = []
+    for i in range(N):
+        bpa = np.random.uniform()*180.-90.#deg
+        bmaj = np.random.uniform(0.5,1.)
+        bmin = np.random.uniform(0.5,1.)*bmaj
+        beams.append((bmaj,bmin,bpa))
+    t1 = time()
+    commonBeam = findCommonBeam(beams)
+    t2 = time()
+    commonBeamMC = findCommonBeam(beams[:10], mc=True)
+    print("Common beam {} found in {:.3f} s".format(commonBeam, t2-t1))
+    for beam in beams:
+        bmaj,bmin,bpa = deconvolve_ell(*commonBeam,*beam)
+        assert bmaj > 0 and bmin > 0, "{} cannot be deconvolved from {}".format(beam, commonBeam)
+    commonBeam10 = findCommonBeam(beams[:10])
+    assert commonBeam10[0]*commonBeam10[1] <= commonBeamMC[0]*commonBeamMC[1]*(1+1e-6), \
+        "Deterministic beam {} larger than MC beam {}".format(commonBeam10, commonBeamMC)
+    return True
@@ -23,8 +23,19 @@
 # def your_function():
 #    ...
 
+# or, to cache reprojections of images:
+
+# cache = ReprojCache("cache_dir", maxsize=10)
+# data, footprint = cache.reproject((data, header), target_header, method='interp')
+
+# or, to cache image noise estimates:
+
+# image.calc_noise(cache=NoiseCache("noise_cache.pickle"))
+
+import os, time, hashlib, fcntl, logging
 from functools import wraps
 import pickle
+import numpy as np
 
 def diskcached(cachefile, saveafter=1):
     def cacheondisk(fn):
@@ -55,3 +66,157 @@ def diskcached(cachefile, saveafter=1):
         return usingcache
 
     return cacheondisk
+
+
+def locked_update(indexfile, update, write=True):
+    """
+    Load the dict pickled in indexfile, call update(index) and save it back (if write), return what update returned.
+    The file is locked so that more processes can share it.
+    """
+    with open(indexfile+'.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(indexfile, 'rb') as f:
+                index = pickle.load(f)
+        except:
+            index = {}
+        ret = update(index)
+        if write:
+            with open(indexfile+'.tmp', 'wb') as f:
+                pickle.dump(index, f)
+            os.replace(indexfile+'.tmp', indexfile)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return ret
+
+
+class ReprojCache(object):
+    """
+    Content-addressed on-disk cache of reprojected images.
+    Entries are keyed by a hash of the input data, input WCS, target header and reprojection method,
+    so that a change in any of them triggers a new reprojection. An index keeps size and last access
+    of every entry and the least recently used are removed when the cache gets larger than maxsize.
+    """
+
+    def __init__(self, cachedir='reproj_cache', maxsize=10):
+        """
+        cachedir: directory where the reprojected images and the index are stored
+        maxsize: max size of the cache in GB
+        """
+        self.cachedir = cachedir
+        self.maxsize = maxsize*1e9
+        self.indexfile = os.path.join(cachedir, 'index.pickle')
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+
+    def _update_index(self, update):
+        """
+        Load the index, modify it with update(index) and save it back.
+        """
+        return locked_update(self.indexfile, update)
+
+    def get_key(self, data, header, target_header, method, **kwargs):
+        """
+        Return the hash identifying a reprojection
+        data, header: input image and its header (only the celestial WCS is used)
+        target_header: output header (only the celestial WCS and the shape are used)
+        method: reprojection method
+        kwargs: other parameters of the reprojection ('parallel' is ignored)
+        """
+        from astropy.wcs import WCS as pywcs
+        data = np.ascontiguousarray(data)
+        h = hashlib.sha1()
+        h.update(('%s %s' % (data.shape, data.dtype)).encode())
+        h.update(data.tobytes())
+        h.update(pywcs(header).celestial.to_header_string().encode())
+        h.update(pywcs(target_header).celestial.to_header_string().encode())
+        h.update(('%s %s' % (target_header['NAXIS1'], target_header['NAXIS2'])).encode())
+        kwargs.pop('parallel', None)
+        h.update(('%s %s' % (method, sorted(kwargs.items()))).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return (data, footprint) for this key or None if not in cache
+        """
+        def touch(index):
+            if key not in index: return False
+            if not os.path.exists(index[key]['file']):
+                del index[key]
+                return False
+            index[key]['atime'] = time.time()
+            return True
+
+        if not self._update_index(touch): return None
+        logging.debug('Reprojection found in cache (%s).' % key)
+        with np.load(os.path.join(self.cachedir, key+'.npz')) as f:
+            return f['data'], f['footprint']
+
+    def put(self, key, data, footprint):
+        """
+        Store (data, footprint) and remove least recently used entries if needed
+        """
+        filename = os.path.join(self.cachedir, key+'.npz')
+        np.savez(filename.replace('.npz','.tmp.npz'), data=data, footprint=footprint)
+        os.replace(filename.replace('.npz','.tmp.npz'), filename)
+
+        def add(index):
+            index[key] = {'file':filename, 'size':os.path.getsize(filename), 'atime':time.time()}
+            # LRU cleanup, never remove the entry just added
+            for k in sorted(index, key=lambda k: index[k]['atime']):
+                if sum([e['size'] for e in index.values()]) <= self.maxsize or k == key: break
+                logging.debug('Remove from reprojection cache: %s' % k)
+                if os.path.exists(index[k]['file']): os.remove(index[k]['file'])
+                del index[k]
+
+        self._update_index(add)
+
+    def reproject(self, input_data, output_projection, method='interp', **kwargs):
+        """
+        Same as reproject.reproject_<method>(input_data, output_projection, **kwargs) using the cache
+        input_data: tuple (data, header)
+        output_projection: target header
+        method: interp or exact
+        """
+        from reproject import reproject_interp, reproject_exact
+        reproj = {'interp':reproject_interp, 'exact':reproject_exact}[method]
+
+        key = self.get_key(input_data[0], input_data[1], output_projection, method, **kwargs)
+        ret = self.get(key)
+        if ret is None:
+            ret = reproj(input_data, output_projection, **kwargs)
+            self.put(key, ret[0], ret[1])
+        return ret
+
+
+class NoiseCache(object):
+    """
+    Persistent cache of image noise estimates. Entries are keyed by a hash of the pixels the estimate is computed on
+    and of the estimator parameters, so a modified image (e.g. after convolution) or different blanking parameters
+    give a new entry.
+    """
+
+    def __init__(self, cachefile='noise_cache.pickle'):
+        """
+        cachefile: pickle file with all the estimates
+        """
+        self.cachefile = cachefile
+
+    def get_key(self, data, **kwargs):
+        """
+        Return the hash of the data used for the noise estimate and the estimator parameters
+        """
+        data = np.ascontiguousarray(data)
+        h = hashlib.sha1()
+        h.update(('%s %s' % (data.shape, data.dtype)).encode())
+        h.update(data.tobytes())
+        h.update(('%s' % sorted(kwargs.items())).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return the noise for this key or None if not in cache
+        """
+        return locked_update(self.cachefile, lambda index: index.get(key), write=False)
+
+    def put(self, key, noise):
+        locked_update(self.cachefile, lambda index: index.update({key: noise}))
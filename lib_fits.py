@@ -24,15 +24,26 @@ from astropy.wcs import WCS as pywcs
 from astropy.io import fits as pyfits
 from astropy.cosmology import FlatLambdaCDM
 from astropy.nddata import Cutout2D
-from astropy.coordinates import match_coordinates_sky, SkyCoord
+from astropy.coordinates import SkyCoord
 from astropy.convolution import Gaussian2DKernel
 import pyregion
 import astropy.units as u
 
-def flatten(filename, channel=0, stokes=0):
-    """ Flatten a fits file so that it becomes a 2D image. Return new header and data """
+def flatten(filename, channel=0, stokes=0, cutout=None, copy=True):
+    """ Flatten a fits file so that it becomes a 2D image. Return new header and data
 
-    f = pyfits.open(filename)
+    filename: name of the fits file or an already open HDUList (not closed here, it belongs to the caller)
+    cutout: (ra, dec, size) in deg, optional. Return only this region of the plane. size can be [size_ra, size_dec]
+    copy: if False and filename is an HDUList, return a view of its data instead of a copy. With a memory mapped
+        HDUList no pixel is read, e.g. to get only the flattened header
+    The file is memory mapped, so only the selected channel/stokes plane (and cutout) is read; the returned data
+    is a copy and does not keep the file open.
+    """
+
+    if isinstance(filename, pyfits.HDUList):
+        f = filename
+    else:
+        f = pyfits.open(filename)
     header_init = f[0].header
 
     naxis = header_init['NAXIS']
@@ -89,7 +100,21 @@ def flatten(filename, channel=0, stokes=0):
         pass
 
     # slice=(0,)*(naxis-2)+(np.s_[:],)*2
-    return header, f[0].data[tuple(dataslice)]
+    data = f[0].data[tuple(dataslice)]
+
+    if cutout is not None:
+        ra, dec, size = cutout
+        size = u.Quantity(size[::-1] if np.ndim(size) else size, u.deg) # Cutout2D wants (ny, nx)
+        cut = Cutout2D(data, SkyCoord(ra*u.deg, dec*u.deg), size, wcs=pywcs(header), mode='trim', copy=False)
+        header.update(cut.wcs.to_header())
+        header["NAXIS1"] = cut.data.shape[1]
+        header["NAXIS2"] = cut.data.shape[0]
+        data = cut.data
+
+    if copy or f is not filename:
+        data = np.array(data)
+    if f is not filename: f.close()
+    return header, data
 
 
 def correct_beam_header(header):
@@ -126,9 +151,74 @@ def find_freq(header):
 
     return None # no freq information found
  
+def clipped_stats(data, sigma=3, niter=20):
+    """
+    Sigma-clipped mean and std along the last axis of data (nans are ignored), vectorized over the other axes.
+    The values are sorted once, so each clipping iteration is a window in the sorted values whose
+    mean and std come from cumulative sums.
+    Returns mean, std and number of values used (nan mean and std if no values)
+    """
+    data = np.sort(data, axis=-1) # nans at the end
+    n = np.sum(~np.isnan(data), axis=-1)
+    shift = np.nanmedian(data) if np.any(n) else 0. # reduce cancellation in the cumulative sums
+    d = np.nan_to_num(data.astype(np.float64) - shift)
+    zeros = np.zeros(d.shape[:-1]+(1,))
+    cs = np.concatenate([zeros, np.cumsum(d, axis=-1)], axis=-1)
+    cs2 = np.concatenate([zeros, np.cumsum(d**2, axis=-1)], axis=-1)
+    valid = np.arange(d.shape[-1]) < n[...,np.newaxis] # sorted slots holding a value (not nan)
+
+    def window_stats(lo, hi):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            npix = hi - lo
+            mean = (np.take_along_axis(cs, hi[...,np.newaxis], -1) - np.take_along_axis(cs, lo[...,np.newaxis], -1))[...,0]/npix
+            var = (np.take_along_axis(cs2, hi[...,np.newaxis], -1) - np.take_along_axis(cs2, lo[...,np.newaxis], -1))[...,0]/npix - mean**2
+        return mean, np.sqrt(np.clip(var, 0, None))
+
+    lo, hi = np.zeros_like(n), n
+    for i in range(niter):
+        mean, std = window_stats(lo, hi)
+        # new window: values within mean +- sigma*std
+        with np.errstate(invalid='ignore'):
+            lo_new = np.sum((d < (mean - sigma*std)[...,np.newaxis]) & valid, axis=-1)
+            hi_new = np.sum((d <= (mean + sigma*std)[...,np.newaxis]) & valid, axis=-1)
+        # keep the old window if the new one is empty
+        empty = hi_new <= lo_new
+        lo_new, hi_new = np.where(empty, lo, lo_new), np.where(empty, hi, hi_new)
+        if np.all((lo_new == lo) & (hi_new == hi)): break
+        lo, hi = lo_new, hi_new
+    mean, std = window_stats(lo, hi)
+    return mean + shift, std, hi - lo
+
+
+def test_clipped_stats():
+    from astropy.stats import sigma_clipped_stats
+    rng = np.random.default_rng(1)
+    data = rng.normal(0, 1, (6, 400))
+    data[:, :8] = 100 # outliers
+    data[1:, 250:] = np.nan # blanked pixels
+    data[2] = np.nan # empty box
+    data[3, 200:250] = rng.normal(5, 20, 50) # wide outliers
+    mean, std, npix = clipped_stats(data, sigma=3, niter=20)
+    for i in range(len(data)):
+        if np.all(np.isnan(data[i])):
+            assert np.isnan(mean[i]) and npix[i] == 0
+            continue
+        m, _, s = sigma_clipped_stats(data[i], sigma=3, maxiters=20, cenfunc='mean', stdfunc='std')
+        assert np.isclose(mean[i], m, rtol=1e-10, atol=1e-12) and np.isclose(std[i], s, rtol=1e-10), (i, mean[i], m, std[i], s)
+    # stats of the last window when niter runs out
+    mean, std, npix = clipped_stats(data[1], sigma=3, niter=1)
+    m, _, s = sigma_clipped_stats(data[1], sigma=3, maxiters=1, cenfunc='mean', stdfunc='std')
+    assert np.isclose(mean, m, rtol=1e-10) and np.isclose(std, s, rtol=1e-10), (mean, m, std, s)
+
+
 class AllImages():
 
-    def __init__(self, filenames, channel=0, stokes=0):
+    def __init__(self, filenames, channel=0, stokes=0, cutout=None):
+        """
+        filenames: list of fits files
+        channel, stokes: plane to use for cubes
+        cutout: see Image
+        """
         if len(filenames) == 0:
             logging.error('Cannot find images!')
             raise ValueError()
@@ -137,7 +227,7 @@ class AllImages():
         self.images = []
         img_list, freqs = [], []
         for filename in filenames:
-            img_list.append(Image(filename))
+            img_list.append(Image(filename, channel=channel, stokes=stokes, cutout=cutout))
             freqs.append(img_list[-1].freq)
         self.images = [img_list[i] for i in np.argsort(freqs)]
         self.freqs = np.sort(freqs)
@@ -170,15 +260,16 @@ class AllImages():
         logging.info(f'Reference cat: {self[ref_idx].imagefile}')
         # keep only point sources
         target_beam = self.common_beam(circbeam=True)
+        from lib_skyindex import SkyIndex
+        ref_ra, ref_dec = np.asarray(ref_cat['RA']), np.asarray(ref_cat['DEC'])
         for i, image in enumerate(self):
             if i == ref_idx:
                 # skip ref_cat
                 continue
-            # cross match
-            idx_match, sep, _ = match_coordinates_sky(SkyCoord(ref_cat['RA'], ref_cat['DEC']), \
-                                                      SkyCoord(image.cat['RA'], image.cat['DEC']))
-            idx_matched_ref = np.arange(0, len(ref_cat))[sep < target_beam[0] * u.degree]
-            idx_matched_img = idx_match[sep < target_beam[0] * u.degree]
+            # cross match: one batched query of all reference sources
+            idx_match, sep = SkyIndex(image.cat['RA'], image.cat['DEC']).match(ref_ra, ref_dec)
+            idx_matched_ref = np.arange(0, len(ref_cat))[sep < target_beam[0]]
+            idx_matched_img = idx_match[sep < target_beam[0]]
 
             # find & apply shift
             if len(idx_match) < 5:
@@ -245,7 +336,7 @@ class AllImages():
             target_beam = [common_beam.major.to_value('deg'), common_beam.minor.to_value('deg'), common_beam.pa.to_value('deg')]
         return target_beam
 
-    def convolve_to(self, beam=None, circbeam=False):
+    def convolve_to(self, beam=None, circbeam=False, fft=False, ncpu=1):
         """
         Convolve all images to a common beam. By default, convolve to smallest common beam.
 
@@ -255,6 +346,10 @@ class AllImages():
             Beam parameters [b_major, b_minor, b_pa] in [asec, asec, deg]. None: find smallest common beam
         circbeam: bool, optional. Default = False
             Force circular beam
+        fft: bool, optional. Default = False
+            Convolve in the Fourier domain (see Image.convolve)
+        ncpu: int, optional. Default = 1
+            Number of images convolved in parallel (threads)
         """
 
         if beam is None:
@@ -264,10 +359,21 @@ class AllImages():
         logging.info('Final beam: %.1f" %.1f" (pa %.1f deg)' \
                      % (target_beam[0] * 3600., target_beam[1] * 3600., target_beam[2]))
 
-        for image in self.images:
-            image.convolve(target_beam)
+        # kernels of all images at once, the invalid ones (e.g. same beam) are left to Image.convolve
+        from lib_beamdeconv import deconvolve_ell_vec
+        kernels, valid = deconvolve_ell_vec(target_beam, [image.get_beam() for image in self.images])
+        kernels = [k if v else None for k, v in zip(kernels, valid)]
 
-    def regrid_common(self, size=None, region=None, pixscale=None, radec=None, square=False, action='regrid'):
+        if ncpu > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(ncpu) as executor:
+                # list() to re-raise exceptions
+                list(executor.map(lambda ik: ik[0].convolve(target_beam, fft=fft, convolve_beam=ik[1]), zip(self.images, kernels)))
+        else:
+            for image, kernel in zip(self.images, kernels):
+                image.convolve(target_beam, fft=fft, convolve_beam=kernel)
+
+    def regrid_common(self, size=None, region=None, pixscale=None, radec=None, square=False, action='regrid', cache=None):
         """
         Move all images to a common grid
         Parameters
@@ -283,6 +389,8 @@ class AllImages():
             If False, do not force square image.
         action: regrid, header, regrid_header
             The function can perform the regrid or just return the common header or both
+        cache: lib_cache.ReprojCache, optional. Default = None
+            If given, reuse previous identical reprojections
         """
 
         rwcs = pywcs(naxis=2)
@@ -350,7 +458,7 @@ class AllImages():
         logging.info(f'Regridded image size: {size} deg ({ysize:.0f},{xsize:.0f} pixels))')
         if action == 'regrid' or action == 'regrid_header':
             for image in self.images:
-                image.regrid(regrid_hdr)
+                image.regrid(regrid_hdr, cache=cache)
         if action == 'header' or action == 'regrid_header':
             return regrid_hdr
 
@@ -366,15 +474,22 @@ class AllImages():
 
 class Image(object):
 
-    def __init__(self, imagefile, channel=0, stokes=0):
+    def __init__(self, imagefile, channel=0, stokes=0, cutout=None):
         """
         imagefile: name of the fits file
+        channel, stokes: plane to use for cubes
+        cutout: (ra, dec, size) in deg, optional. Load only this region (see flatten)
+        Only the header is read here, the pixels are loaded at the first access of img_data
         """
 
         logging.info(f"Open {imagefile}")
         self.imagefile = imagefile
-        header = pyfits.open(imagefile)[0].header
-        header = correct_beam_header(header)
+        self._plane = dict(channel=channel, stokes=stokes, cutout=cutout)
+        self._img_data = None
+        # flattened header from a view of the memory mapped data, no pixel is read
+        with pyfits.open(imagefile, memmap=True, do_not_scale_image_data=True) as hdul:
+            header = correct_beam_header(hdul[0].header)
+            self.img_hdr = flatten(hdul, copy=False, **self._plane)[0]
         self.img_hdr_orig = header
 
         try:
@@ -398,14 +513,28 @@ class Image(object):
             self.mhz = None
 
         self.noise = None
-        self.img_hdr, self.img_data = flatten(self.imagefile, channel=channel, stokes=stokes)
-        self.img_hdu = pyfits.ImageHDU(data=self.img_data, header=self.img_hdr)
         self.set_beam(beam)
         self.set_freq(freq)
         self.ra = self.img_hdr['CRVAL1']
         self.dec = self.img_hdr['CRVAL2']
         self.get_degperpixel() # sets self.degperpixel (faster to call, no WCS call)
 
+    @property
+    def img_data(self):
+        """
+        2D data of the selected plane (and cutout), read from the file at the first access
+        """
+        if self._img_data is None:
+            self._img_data = flatten(self.imagefile, **self._plane)[1]
+        return self._img_data
+
+    @img_data.setter
+    def img_data(self, data):
+        self._img_data = data
+
+    @property
+    def img_hdu(self):
+        return pyfits.ImageHDU(data=self.img_data, header=self.img_hdr)
 
 
     def write(self, filename=None, inflate=False):
@@ -530,23 +659,29 @@ class Image(object):
         if invert: self.img_data[~mask] = blankvalue
         else: self.img_data[mask] = blankvalue
 
-    def blank_noisy(self, nsigma):
+    def blank_noisy(self, nsigma, local=False):
         """
         Set to nan pixels below nsigma*noise
+        local: use the background mean and rms maps (see calc_noise_map) instead of the image noise
         """
         nans_before = np.sum(np.isnan(self.img_data))
         self.img_data[np.isnan(self.img_data)] = 0  # temporary set nans to 0 to prevent error in "<"
-        self.img_data[np.where(self.img_data <= nsigma * self.noise)] = np.nan
+        if local:
+            self.img_data[np.where(self.img_data - self.mean_map <= nsigma * self.noise_map)] = np.nan
+        else:
+            self.img_data[np.where(self.img_data <= nsigma * self.noise)] = np.nan
         nans_after = np.sum(np.isnan(self.img_data))
         logging.debug('%s: Blanked pixels %i -> %i' % (self.imagefile, nans_before, nans_after))
 
-    def calc_noise(self, niter=1000, eps=None, sigma=5, bg_reg=None, force_recalc=False):
+    def calc_noise(self, niter=1000, eps=None, sigma=5, bg_reg=None, force_recalc=False, nsample=1e6, cache=None):
         """
         Return the rms of all the pixels in an image
         niter : robust rms estimation
         eps : convergency criterion, if None is 1% of initial rms
         bg_reg : If ds9 region file provided, use this as background region
         force_recalc : recalculate noise even if already set
+        nsample : use a regular subsample of ~nsample pixels for the robust estimation (None or 0: all pixels)
+        cache : lib_cache.NoiseCache, optional. Reuse the noise of identical pixels and parameters from previous runs
         """
         if not self.noise is None and force_recalc == False:
             print('WARNING: Noise already set, and force_recalc=False.')
@@ -565,32 +700,119 @@ class Image(object):
         else:
             from astropy.stats import median_absolute_deviation
             if eps == None: eps = 1e-3
-            data = self.img_data[ ~np.isnan(self.img_data) & (self.img_data != 0) ] # remove nans and 0s
+            data = self.get_noise_sample(nsample) # remove nans and 0s
             initial_len = len(data)
             if initial_len == 0: return 0
+            if cache is not None:
+                key = cache.get_key(data, niter=niter, eps=eps, sigma=sigma)
+                rms = cache.get(key)
+                if rms is not None:
+                    self.noise = rms
+                    logging.debug('%s: Noise: %.3f mJy/b (from cache)' % (self.imagefile, self.noise*1e3))
+                    return rms
             mad_old = 0.
             for i in range(niter):
                  mad = median_absolute_deviation(data)
                  logging.debug('%s: MAD noise: %f uJy on %f%% data' % (self.imagefile, mad*1e6, 100*len(data)/initial_len))
                  if np.isnan(mad): break
-                 if np.abs(mad_old-mad)/mad < eps:
+                 # the clipped sets are nested, so if nothing is clipped the next iteration is identical: converged
+                 clipped = data[np.abs(data) < (sigma*mad)]
+                 if mad == 0 or np.abs(mad_old-mad)/mad < eps or len(clipped) == len(data):
                      rms = np.nanstd( data )
                      self.noise = rms
                      #print('%s: Noise: %.3f mJy/b' % (self.imagefile, self.noise*1e3))
                      logging.debug('%s: Noise: %.3f mJy/b (data len: %i -> %i - %.2f%%)' % (self.imagefile, self.noise*1e3, initial_len, len(data), 100*len(data)/initial_len))
+                     if cache is not None: cache.put(key, rms)
                      return rms
     
-                 data = data[np.abs(data) < (sigma*mad)]
+                 data = clipped
                  mad_old = mad
             raise Exception('Noise estimation failed to converge.')
 
-
-    def convolve(self, target_beam, stokes=True):
+    def calc_noise_map(self, box=100, step=None, sigma=3, niter=20, minfrac=0.2, order=1, ncpu=1):
+        """
+        Sliding-box background mean and rms maps (similar to BDSF rms_box). Sigma-clipped statistics are computed in
+        boxes of box x box pixels every step pixels and interpolated between the box centres.
+        Boxes with less than minfrac valid (not nan and not 0) pixels take the values of the nearest valid box.
+        Sets and returns self.mean_map, self.noise_map
+        box : box size in pixels
+        step : distance between box centres in pixels, default box/3
+        sigma, niter : clipping (see clipped_stats)
+        order : spline order of the interpolation between box centres
+        ncpu : number of threads, each works on a row of boxes
+        """
+        from numpy.lib.stride_tricks import sliding_window_view
+        from scipy import ndimage
+        if step is None: step = max(1, box//3)
+        ny, nx = self.img_data.shape
+        box = min(box, ny, nx)
+        data = np.where(self.img_data == 0, np.nan, self.img_data)
+        tiles = sliding_window_view(data, (box, box))
+        # box corners, the last box is aligned to the image edge
+        y0 = np.unique(np.append(np.arange(0, ny-box+1, step), ny-box))
+        x0 = np.unique(np.append(np.arange(0, nx-box+1, step), nx-box))
+
+        def do_row(i):
+            mean, std, npix = clipped_stats(tiles[y0[i]][x0].reshape(len(x0), box*box), sigma=sigma, niter=niter)
+            bad = npix < minfrac*box*box
+            mean[bad], std[bad] = np.nan, np.nan
+            return mean, std
+
+        if ncpu > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(ncpu) as executor:
+                rows = list(executor.map(do_row, range(len(y0))))
+        else:
+            rows = [do_row(i) for i in range(len(y0))]
+        mean_grid = np.array([r[0] for r in rows])
+        rms_grid = np.array([r[1] for r in rows])
+        if np.all(np.isnan(rms_grid)):
+            raise ValueError('%s: not enough valid pixels for a noise map.' % self.imagefile)
+        # fill bad boxes with the nearest valid one
+        idx = ndimage.distance_transform_edt(np.isnan(rms_grid), return_distances=False, return_indices=True)
+        mean_grid, rms_grid = mean_grid[tuple(idx)], rms_grid[tuple(idx)]
+
+        # interpolate from box centres to pixels (in box-grid coordinates), constant outside the centres
+        yc, xc = y0 + (box-1)/2., x0 + (box-1)/2.
+        coords = np.meshgrid(np.interp(np.arange(ny), yc, np.arange(len(yc))),
+                             np.interp(np.arange(nx), xc, np.arange(len(xc))), indexing='ij', sparse=False)
+        self.mean_map = ndimage.map_coordinates(mean_grid, coords, order=order, mode='nearest')
+        self.noise_map = ndimage.map_coordinates(rms_grid, coords, order=order, mode='nearest')
+        logging.debug('%s: Noise map from %i x %i boxes (median rms: %.3f mJy/b)' % \
+                      (self.imagefile, len(y0), len(x0), np.median(rms_grid)*1e3))
+        return self.mean_map, self.noise_map
+
+    def get_noise_sample(self, nsample=1e6):
+        """
+        Return the non-blanked (not nan and not 0) pixels used for noise estimation.
+        nsample : if the image is larger, take one every N pixels to get ~nsample values (None or 0: all pixels)
+        """
+        flat = self.img_data.ravel()
+        step = 1
+        if nsample and flat.size > nsample:
+            step = int(flat.size // nsample)
+            # step not multiple of the row length, otherwise always the same columns are sampled
+            while np.gcd(step, self.img_data.shape[-1]) > 1: step += 1
+        data = flat[::step]
+        data = data[~np.isnan(data) & (data != 0)]
+        if step > 1 and len(data) < nsample/10:
+            # mostly blanked image, sample among the valid pixels
+            data = flat[~np.isnan(flat) & (flat != 0)]
+            data = data[::max(1, int(len(data)//nsample))]
+        return data
+
+
+    def convolve(self, target_beam, stokes=True, fft=False, convolve_beam=None):
         """
         Convolve *to* this rsolution
         beam = [bmaj, bmin, bpa]
+        fft = multiply by the analytic gaussian transfer function instead of convolving in image space,
+        much faster for large kernels. NaNs and pixels outside the image are excluded with a normalized convolution
+        (the image-space convolution sets the edges to zero instead)
+        convolve_beam = [bmaj, bmin, bpa] of the kernel if already known (see AllImages.convolve_to), otherwise
+        it is deconvolved here
         """
-        from lib_beamdeconv import deconvolve_ell, EllipticalGaussian2DKernel
+        from lib_beamdeconv import deconvolve_ell, EllipticalGaussian2DKernel, convolveGaussianFFT
         from astropy import convolution
 
         # if difference between beam is negligible <1%, skip - it mostly happens when beams are exactly the same
@@ -603,7 +825,8 @@ class Image(object):
                 raise ValueError('%s: target beam is smaller than current beam. Cannot convolve!.' % self.imagefile)
         except ZeroDivisionError: pass  # catch case where we have delta scale beam (model image)
         # first find beam to convolve with
-        convolve_beam = deconvolve_ell(target_beam[0], target_beam[1], target_beam[2], beam[0], beam[1], beam[2])
+        if convolve_beam is None:
+            convolve_beam = deconvolve_ell(target_beam[0], target_beam[1], target_beam[2], beam[0], beam[1], beam[2])
         if convolve_beam[0] is None:
             logging.error('Cannot deconvolve this beam.')
             sys.exit(1)
@@ -614,23 +837,33 @@ class Image(object):
         #print(self.imagefile,self.img_hdr['CDELT1'], self.img_hdr['CDELT2'])
         assert abs(self.img_hdr['CDELT1']) == abs(self.img_hdr['CDELT2'])
         pixsize = abs(self.img_hdr['CDELT1'])
-        fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
-        gauss_kern = EllipticalGaussian2DKernel((bmaj*fwhm2sigma)/pixsize, (bmin*fwhm2sigma)/pixsize, (90+bpa)*np.pi/180.) # bmaj and bmin are in pixels
-        self.img_data = convolution.convolve(self.img_data, gauss_kern, boundary=None, preserve_nan=True)
+        if fft:
+            self.img_data = convolveGaussianFFT(self.img_data, bmaj/pixsize, bmin/pixsize, bpa)
+        else:
+            fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
+            gauss_kern = EllipticalGaussian2DKernel((bmaj*fwhm2sigma)/pixsize, (bmin*fwhm2sigma)/pixsize, (90+bpa)*np.pi/180.) # bmaj and bmin are in pixels
+            self.img_data = convolution.convolve(self.img_data, gauss_kern, boundary=None, preserve_nan=True)
         if stokes: # if not stokes image (e.g. spectral index, do not renormalize)
             self.img_data *= (target_beam[0]*target_beam[1])/(beam[0]*beam[1]) # since we are in Jy/b we need to renormalise
 
         self.set_beam(target_beam) # update beam
 
-    def regrid(self, regrid_hdr):
-        """ Regrid image to new header """
+    def regrid(self, regrid_hdr, cache=None):
+        """
+        Regrid image to new header
+        cache: lib_cache.ReprojCache, optional. Default = None
+            If given, reuse a previous identical reprojection
+        """
         from reproject import reproject_interp, reproject_exact
         reproj = reproject_exact
         # store some info so to reconstruct headers
         beam = self.get_beam()
         freq = self.get_freq()
         logging.debug('%s: regridding' % (self.imagefile))
-        self.img_data, __footprint = reproj((self.img_data, self.img_hdr), regrid_hdr, parallel=True)
+        if cache is None:
+            self.img_data, __footprint = reproj((self.img_data, self.img_hdr), regrid_hdr, parallel=True)
+        else:
+            self.img_data, __footprint = cache.reproject((self.img_data, self.img_hdr), regrid_hdr, method='exact', parallel=True)
         # update headers
         self.img_hdr = copy.copy(regrid_hdr)
         self.set_freq(freq)
@@ -661,26 +894,61 @@ class Image(object):
         -------
 
         """
-        b = self.get_beam()
-        fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
-        b_sig_pix_ma = b[0] * fwhm2sigma / self.degperpixel
-        b_sig_pix_min = b[1] * fwhm2sigma / self.degperpixel
-        theta = np.deg2rad(b[2])
         dx, dy = np.array(pix1 - pix2)
 
         uncorrelated_variance = self.noise**2 # TODO which is the best mode to find noise?
 
-        # NOTE: It might very well be that there is an error in the definition of the angle here! So maybe +pi/2 or -theta would be correct.
-        if np.linalg.norm([dx, dy]) > 3*b_sig_pix_ma:
-            Cij = 0.
-        else:
-            # According to AEGEAN2.0 there is a factor of 1/4 in the exponent. But that is actually the wrong way around, since we need the square of the 2DGaussian and not the squareroot?
-            Cij = np.exp(-((dx*np.sin(theta)+dy*np.cos(theta))/(b_sig_pix_ma))**2
-                         -((dx*np.cos(theta)-dy*np.sin(theta))/(b_sig_pix_min))**2)
+        Cij = self.pixel_correlation(dx, dy)
         Cij *= uncorrelated_variance
         #print(Cij)
         return Cij
 
+    def pixel_correlation(self, dx, dy):
+        """
+        Beam correlation between pixels separated by dx, dy (scalars or arrays, in pixels),
+        zero beyond 3 beam sigmas (major axis). See pixel_covariance().
+        """
+        b = self.get_beam()
+        fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
+        b_sig_pix_ma = b[0] * fwhm2sigma / self.degperpixel
+        b_sig_pix_min = b[1] * fwhm2sigma / self.degperpixel
+        theta = np.deg2rad(b[2])
+
+        # NOTE: It might very well be that there is an error in the definition of the angle here! So maybe +pi/2 or -theta would be correct.
+        # According to AEGEAN2.0 there is a factor of 1/4 in the exponent. But that is actually the wrong way around, since we need the square of the 2DGaussian and not the squareroot?
+        Cij = np.exp(-((dx*np.sin(theta)+dy*np.cos(theta))/(b_sig_pix_ma))**2
+                     -((dx*np.cos(theta)-dy*np.sin(theta))/(b_sig_pix_min))**2)
+        return np.where(np.hypot(dx, dy) > 3*b_sig_pix_ma, 0., Cij)[()]
+
+    def pixel_covariance_matrix(self, mask):
+        """
+        Sparse covariance matrix of the pixels in mask, in the order of self.img_data[mask].
+        Only pairs closer than 3 beam sigmas are computed, all at once.
+        Parameters
+        ----------
+        mask: boolean array with the shape of the image
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix of shape (n, n) with n = number of pixels in mask
+        """
+        from scipy import sparse
+        from scipy.spatial import cKDTree
+        b = self.get_beam()
+        fwhm2sigma = 1./np.sqrt(8.*np.log(2.))
+        b_sig_pix_ma = b[0] * fwhm2sigma / self.degperpixel
+
+        pix = np.argwhere(mask) # same order as img_data[mask]
+        n = len(pix)
+        pairs = cKDTree(pix).query_pairs(3*b_sig_pix_ma, output_type='ndarray')
+        # same convention of pixel_covariance(): pix = (dx, dy) = (axis0, axis1)
+        dx, dy = (pix[pairs[:,0]] - pix[pairs[:,1]]).T
+        Cij = self.pixel_correlation(dx, dy)
+        i = np.concatenate([pairs[:,0], pairs[:,1], np.arange(n)])
+        j = np.concatenate([pairs[:,1], pairs[:,0], np.arange(n)])
+        C = np.concatenate([Cij, Cij, np.ones(n)])
+        return sparse.csr_matrix((C*self.noise**2, (i, j)), shape=(n, n))
+
     def make_catalogue(self):
         """
         Create catalogue for image alignmnt
@@ -750,3 +1018,31 @@ class Image(object):
         """
         return self.get_degperkpc(z) / self.get_degperpixel()
 
+
+
+def test_lazy_image():
+    # building AllImages reads only the headers: pixels written after it are the ones loaded at the first access
+    import tempfile
+    rng = np.random.default_rng(1)
+    header = pyfits.Header({'CTYPE1':'RA---SIN', 'CTYPE2':'DEC--SIN', 'CTYPE3':'FREQ', 'CTYPE4':'STOKES',
+                            'CRPIX1':50, 'CRPIX2':40, 'CRVAL1':10., 'CRVAL2':20., 'CDELT1':-1e-3, 'CDELT2':1e-3,
+                            'CRPIX3':1, 'CRVAL3':1.4e8, 'CDELT3':1e6, 'CRPIX4':1, 'CRVAL4':1, 'CDELT4':1,
+                            'BMAJ':5e-3, 'BMIN':4e-3, 'BPA':0.})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filenames = [os.path.join(tmpdir, f'{i}.fits') for i in range(3)]
+        for i, filename in enumerate(filenames):
+            header['CRVAL3'] = 1.4e8 + i*1e7
+            pyfits.writeto(filename, rng.normal(size=(2,3,80,100)).astype(np.float32), header)
+        images = AllImages(filenames, channel=2, stokes=1)
+        cutouts = AllImages(filenames, channel=1, cutout=(10., 20., 0.02))
+        assert all(image._img_data is None for image in images.images + cutouts.images)
+        data = [rng.normal(size=(2,3,80,100)).astype(np.float32) for filename in filenames]
+        for d, filename in zip(data, filenames):
+            pyfits.writeto(filename, d, header, overwrite=True)
+        for d, image, cutout in zip(data, images.images, cutouts.images):
+            assert np.array_equal(image.img_data, d[1,2])
+            assert cutout.img_data.shape == (cutout.img_hdr['NAXIS2'], cutout.img_hdr['NAXIS1']) == (20, 20)
+            assert np.array_equal(cutout.img_data, flatten(image.imagefile, channel=1, cutout=(10., 20., 0.02))[1])
+        # the data can still be replaced, e.g. by convolve()
+        image.img_data = np.zeros((80,100))
+        assert not np.any(image.img_data)
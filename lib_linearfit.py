@@ -128,45 +128,64 @@ def linear_fit_bootstrap(x, y, yerr, niter=1000, tolog=False):
     #
     # tolog : convert in log space x, y, and yerr before doing linear regression
     # use: (a, b, sa, sb) = linear_fit_bootstrap(x, y, yerr)
+    #
+    # All the realisations are drawn at once and solved in closed form (OLS), see linear_fit_bootstrap_multi()
 
-    from scipy import optimize
-    errfunc = lambda B, x, y: f(x, B[0], B[1]) - y
+    if yerr is not None: yerr = [yerr]
+    (a, b, sa, sb) = linear_fit_bootstrap_multi(x, [y], yerr, niter=niter, tolog=tolog)
+    return (a[0], b[0], sa[0], sb[0])
 
-    x = np.array(x)
-    y = np.array(y)
-    if yerr is not None: yerr = np.array(yerr)
+
+def linear_fit_bootstrap_multi(x, y, yerr, niter=1000, tolog=False):
+    """
+    Bootstrap errors of linear regressions of many sources at once (see linear_fit_bootstrap()).
+    Every realisation is an unweighted least squares fit solved with the normal equations.
+    Parameters
+    ----------
+    x: (npoints,) array of floats
+    y: (nsources, npoints) array of floats
+    yerr: (nsources, npoints) or (npoints,) array of floats or None
+        if None, the random variation is the std of the residuals of each source
+    niter: number of random realisations
+    tolog: convert in log space x, y, and yerr before doing linear regression
+
+    Returns
+    -------
+    a, b, sa, sb: (nsources,) arrays of floats
+    """
+    x = np.array(x, dtype=float)
+    y = np.array(y, dtype=float, ndmin=2)
+    if yerr is not None: yerr = np.broadcast_to(np.array(yerr, dtype=float), y.shape)
 
     if tolog:
         if yerr is not None: yerr = 0.434*yerr/y
         x=np.log10(x)
         y=np.log10(y)
 
-    pfit, pcov, infodict, errmsg, success = optimize.leastsq( errfunc, [-1, 0], args=(x, y), full_output=1)
+    xc = x - np.mean(x)
+    Sxx = np.sum(xc**2)
+    def ols(y):
+        # y: (..., npoints)
+        B0 = np.sum(xc*y, axis=-1)/Sxx
+        return B0, np.mean(y, axis=-1) - B0*np.mean(x)
+
+    pfit = ols(y)
 
     # 2 vals without error, cannot estimate sigmas
-    if len(y) == 2 and yerr is None: return (pfit[0], pfit[1], 0, 0)
-
-    residuals = errfunc( pfit, x, y )
-    s_res = np.std(residuals)
-    ps = []
-    # TODO: remove cycle and use only array shapes
-    # n random data sets are generated and fitted
-    for i in range(niter):
-      if yerr is None:
-          randomDelta = np.random.normal(0., s_res, len(y))
-          randomdataY = y + randomDelta
-      else:
-          randomDelta = np.array( [ np.random.normal(0., derr, 1)[0] for derr in yerr ] ) 
-          randomdataY = y + randomDelta
-      randomfit, randomcov = optimize.leastsq( errfunc, [-1, 0], args=(x, randomdataY), full_output=0)
-      ps.append( randomfit ) 
-
-    ps = np.array(ps)
-    mean_pfit = np.mean(ps,0)
+    if y.shape[1] == 2 and yerr is None: return (pfit[0], pfit[1], np.zeros(len(y)), np.zeros(len(y)))
+
+    if yerr is None:
+        residuals = y - f(x, pfit[0][:,np.newaxis], pfit[1][:,np.newaxis])
+        yerr = np.std(residuals, axis=1)[:,np.newaxis]
+    # n random data sets are generated and fitted, shape: (niter, nsources, npoints)
+    randomdataY = y + yerr*np.random.normal(0., 1., (niter,)+y.shape)
+    ps = ols(randomdataY)
+
+    mean_pfit = np.mean(ps, axis=1)
     Nsigma = 1. # 1sigma gets approximately the same as methods above
                 # 1sigma corresponds to 68.3% confidence interval
                 # 2sigma corresponds to 95.44% confidence interval
-    err_pfit = Nsigma * np.std(ps,0) 
+    err_pfit = Nsigma * np.std(ps, axis=1)
 
     return (mean_pfit[0], mean_pfit[1], err_pfit[0], err_pfit[1])
 
@@ -196,6 +215,56 @@ def linear_fit(x, y, yerr=None, tolog=False):
         return (out[0][0], out[0][1], 0, 0)
 
 
+def linear_fit_batch(x, y, yerr=None, tolog=False):
+    """
+    Vectorized version of linear_fit(): weighted LLS of many independent datasets
+    sharing the same x, solved in closed form. Errors are scaled by the reduced chi^2
+    as curve_fit does when only relative weights are given (inf if there are no d.o.f.).
+    Parameters
+    ----------
+    x: (n,) array of floats
+    y: (n,) or (n,m) array of floats
+    yerr: (n,) or (n,m) array of floats, optional
+    tolog: convert in log space x, y, and yerr before doing linear regression
+
+    Returns
+    -------
+    B0, B1, errB0, errB1: float or (m,) array of floats (err are in std dev)
+    """
+    x = np.array(x, dtype=float)
+    y = np.array(y, dtype=float)
+    assert len(x) == len(y)
+    if yerr is not None:
+        yerr = np.array(yerr, dtype=float)
+        if np.ndim(y) == 2 and np.ndim(yerr) == 1: yerr = yerr[:,np.newaxis]
+
+    if tolog:
+        if yerr is not None: yerr = 0.434*yerr/y
+        x = np.log10(x)
+        y = np.log10(y)
+
+    if np.ndim(y) == 2: x = x[:,np.newaxis]
+    w = np.ones_like(y) if yerr is None else np.broadcast_to(1./yerr**2, y.shape)
+
+    S = np.sum(w, axis=0)
+    Sx = np.sum(w*x, axis=0)
+    Sy = np.sum(w*y, axis=0)
+    Sxx = np.sum(w*x**2, axis=0)
+    Sxy = np.sum(w*x*y, axis=0)
+    D = S*Sxx - Sx**2
+    B0 = (S*Sxy - Sx*Sy)/D
+    B1 = (Sxx*Sy - Sx*Sxy)/D
+
+    dof = len(y) - 2
+    if dof > 0:
+        s_sq = np.sum(w*(y - B0*x - B1)**2, axis=0)/dof
+    else:
+        s_sq = np.inf
+    errB0 = np.sqrt(s_sq*S/D)
+    errB1 = np.sqrt(s_sq*Sxx/D)
+    return (B0, B1, errB0, errB1)
+
+
 # extimate errors and accept errors on x and y-data
 def linear_fit_odr(x, y, xerr=None, yerr=None, tolog=False):
     from scipy import odr
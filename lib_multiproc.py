@@ -31,82 +31,285 @@
 # mpm.wait()
 # for r in mpm.get():
 #     print "funct_output:", r
+#
+# The same workers can be reused for more batches of jobs, many small jobs are better
+# sent together (batchsize) and results can be returned in order or tagged by job id:
+# mpm = multiprocManager(ncpu, funct, batchsize=100)
+# for batch in batches:
+#     for funct_params in batch:
+#         mpm.put([funct_params])
+#     for r in mpm.get(ordered=True):
+#         print "funct_output:", r
+#     mpm.log_stats() # throughput of each worker and queue depth
+# mpm.wait()
+#
+# Large arrays can be passed through shared memory instead of being pickled:
+# def funct(i, data, result, outQueue=None):
+#     result.array[i] = data.array[i].sum()
+#
+# mpm = multiprocManager(ncpu, funct)
+# data = mpm.share(data_array)  # copy into shared memory
+# result = mpm.shared_array(shape=len(data_array))  # new empty shared array
+# for i in range(len(data_array)):
+#     mpm.put([i, data, result])  # only the handles are sent
+# mpm.wait()
+# print(result.array)
+# mpm.close()  # free the shared memory
 
-import sys
+import sys, time, queue
 import logging
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+
+class SharedArray(object):
+    """
+    A numpy array in shared memory. When pickled (e.g. sent to a worker) only the handle
+    (name, shape, dtype) is transferred and the receiver attaches to the same memory.
+    """
+
+    def __init__(self, shape, dtype=float, name=None):
+        """
+        shape, dtype: of the array
+        name: attach to an existing shared memory block, if None create a new one (and own it)
+        """
+        self.shape = tuple(np.atleast_1d(shape))
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            size = max(1, int(np.prod(self.shape))*self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return {'name':self.shm.name, 'shape':self.shape, 'dtype':self.dtype}
+
+    def __setstate__(self, state):
+        self.__init__(state['shape'], state['dtype'], name=state['name'])
+
+    def close(self):
+        """
+        Detach from the shared memory, the owner also frees it
+        """
+        if self.shm is None: return
+        self.array = None
+        self.shm.close()
+        if self.owner: self.shm.unlink()
+        self.shm = None
+
+    def __del__(self):
+        self.close()
 
 
 class multiprocManager(object):
 
+    class taggedQueue(object):
+        """
+        Output queue seen by funct, it tags every result with the id of its job
+        """
+
+        def __init__(self, outQueue, jobid):
+            self.outQueue = outQueue
+            self.jobid = jobid
+
+        def put(self, obj):
+            self.outQueue.put((self.jobid, obj))
+
     class multiThread(multiprocessing.Process):
         """
         This class is a working thread which load parameters from a queue and
         return in the output queue
         """
 
-        def __init__(self, inQueue, outQueue, funct):
+        def __init__(self, inQueue, outQueue, funct, statQueue):
             multiprocessing.Process.__init__(self)
             self.inQueue = inQueue
             self.outQueue = outQueue
             self.funct = funct
+            self.statQueue = statQueue
 
         def run(self):
 
             while True:
-                parms = self.inQueue.get()
+                batch = self.inQueue.get()
 
                 # poison pill
-                if parms is None:
+                if batch is None:
                     self.inQueue.task_done()
                     break
 
-                self.funct(*parms, outQueue=self.outQueue)
+                # a batch is a list of (jobid, parms)
+                start = time.time()
+                for jobid, parms in batch:
+                    self.funct(*parms, outQueue=multiprocManager.taggedQueue(self.outQueue, jobid))
+                self.statQueue.put((self.name, len(batch), time.time()-start))
                 self.inQueue.task_done()
 
 
-    def __init__(self, procs=1, funct=None):
+    def __init__(self, procs=1, funct=None, batchsize=1):
         """
         Manager for multiprocessing
         procs: number of processors
         funct: function to parallelize / note that the last parameter of this function must be the outQueue
         and it will be linked to the output queue
+        batchsize: number of jobs sent to a worker at once, use >1 for many small jobs
         """
         self.procs = procs
+        self.batchsize = batchsize
         self._threads = []
         self.inQueue = multiprocessing.JoinableQueue()
         self.outQueue = multiprocessing.Queue()
-        self.runs = 0
+        self.statQueue = multiprocessing.Queue()
+        self.runs = 0 # jobs whose results are still to be read
+        self._nextjob = 0 # id of the next job
+        self._batch = []
+        self._results = {} # results received out of order by get(ordered=True)
+        self._stats = {}
+        self._shared = []
         
+        # workers must share the resource tracker of this process, otherwise each of them
+        # would try to free the shared arrays it attached to when it exits
+        resource_tracker.ensure_running()
+
         logging.debug('Spawning %i threads...' % self.procs)
         for proc in range(self.procs):
-            t = self.multiThread(self.inQueue, self.outQueue, funct)
+            t = self.multiThread(self.inQueue, self.outQueue, funct, self.statQueue)
             self._threads.append(t)
             t.start()
 
     def put(self, args):
         """
         Parameters to give to the next jobs sent into queue
+        Return the job id (starting from 0), it tags its result in get(tagged=True)
         """
-        self.inQueue.put(args)
+        jobid = self._nextjob
+        self._batch.append((jobid, args))
+        self._nextjob += 1
         self.runs += 1
+        if len(self._batch) >= self.batchsize: self.flush()
+        return jobid
 
-    def get(self):
+    def flush(self):
+        """
+        Send the jobs not yet sent (when less than batchsize are waiting)
         """
-        Return all the results as an iterator
+        if len(self._batch) > 0:
+            self.inQueue.put(self._batch)
+            self._batch = []
+
+    def get(self, ordered=False, tagged=False):
         """
+        Return all the results as an iterator, as soon as they are available
+        ordered: return results in the same order of the put()
+        tagged: return (jobid, result)
+        """
+        self.flush()
         # NOTE: do not use queue.empty() check which is unreliable
         # https://docs.python.org/2/library/multiprocessing.html
-        for run in range(self.runs):
-            yield self.outQueue.get()
+        firstjob = self._nextjob - self.runs
+        for jobid in range(firstjob, self._nextjob):
+            if ordered:
+                while jobid not in self._results:
+                    r = self.outQueue.get()
+                    self._results[r[0]] = r[1]
+                r = (jobid, self._results.pop(jobid))
+            else:
+                r = self.outQueue.get()
+            self.runs -= 1
+            yield r if tagged else r[1]
+
+    def get_one(self, tagged=False):
+        """
+        Return the next available result
+        """
+        self.flush()
+        r = self.outQueue.get()
+        self.runs -= 1
+        return r if tagged else r[1]
+
+    def join(self):
+        """
+        Wait for all the jobs sent so far to finish, the workers stay alive and
+        can be reused with more put(). Results are still read with get().
+        """
+        self.flush()
+        self.inQueue.join()
 
     def wait(self):
         """
         Send poison pills to jobs and wait for them to finish
         The join() should kill all the processes
         """
+        self.flush()
         for t in self._threads:
             self.inQueue.put(None)
 
         # wait for all jobs to finish
         self.inQueue.join()
+        self.log_stats()
+
+    def stats(self):
+        """
+        Return a dict with, for every worker, the number of jobs done, the time spent and the jobs/s
+        and the number of batches still in the input queue (None if not available on this OS)
+        """
+        while True:
+            try:
+                name, njobs, dt = self.statQueue.get_nowait()
+            except queue.Empty:
+                break
+            s = self._stats.setdefault(name, {'jobs':0, 'time':0.})
+            s['jobs'] += njobs
+            s['time'] += dt
+        for s in self._stats.values():
+            s['rate'] = s['jobs']/s['time'] if s['time'] > 0 else np.inf
+        try:
+            qsize = self.inQueue.qsize()
+        except NotImplementedError:
+            qsize = None
+        return self._stats, qsize
+
+    def log_stats(self):
+        """
+        Log the throughput of every worker and the queue depth
+        """
+        stats, qsize = self.stats()
+        for name in sorted(stats):
+            logging.debug('%s: %i jobs in %.1f s (%.1f jobs/s)' % (name, stats[name]['jobs'], stats[name]['time'], stats[name]['rate']))
+        if qsize is not None:
+            logging.debug('Batches in queue: %i (%i jobs/batch) - results to read: %i' % (qsize, self.batchsize, self.runs))
+
+    def shared_array(self, shape, dtype=float):
+        """
+        Return a new zero-filled SharedArray, freed by close()
+        """
+        a = SharedArray(shape, dtype)
+        a.array[:] = 0
+        self._shared.append(a)
+        return a
+
+    def share(self, array):
+        """
+        Copy an array into a new SharedArray, freed by close()
+        """
+        a = SharedArray(np.shape(array), np.asarray(array).dtype)
+        a.array[:] = array
+        self._shared.append(a)
+        return a
+
+    def close(self):
+        """
+        Free all the shared arrays, results written there must be copied before
+        """
+        for a in self._shared:
+            a.close()
+        self._shared = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exit_type, value, tb):
+        self.close()
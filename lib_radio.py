@@ -18,12 +18,87 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 
-import os, sys, logging, re
+import os, sys, logging, re, copy
 import numpy as np
 from astropy.io import fits
 import pyregion
 from lib_fits import Image
 
+def _shape_bbox(shape, imshape):
+    """
+    Pixel bounding box (y0, y1, x0, x1) of a pyregion shape in image coords, or None if unknown
+    """
+    if shape.exclude: return None
+    c = shape.coord_list
+    if shape.name == 'polygon':
+        x, y = np.array(c[::2])-1, np.array(c[1::2])-1
+    elif shape.name in ['circle', 'annulus', 'ellipse', 'box', 'rotbox']:
+        if shape.name in ['circle', 'annulus']: r = max(c[2:])
+        elif shape.name == 'ellipse': r = max(c[2:-1])
+        else: r = np.hypot(c[2], c[3])/2.
+        x, y = np.array([c[0]-1-r, c[0]-1+r]), np.array([c[1]-1-r, c[1]-1+r])
+    else:
+        return None
+    ny, nx = imshape
+    return max(int(np.floor(y.min())), 0), min(int(np.ceil(y.max()))+1, ny), \
+           max(int(np.floor(x.min())), 0), min(int(np.ceil(x.max()))+1, nx)
+
+def region_labels(region, imshape):
+    """
+    Rasterize all shapes of a pyregion ShapeList (in image coords) into integer label maps: pixels inside
+    shape i are set to i+1, 0 elsewhere. Each shape is rasterized only in its bounding box; shapes that overlap
+    an already labelled one go into a new layer, so pixels can belong to more than one region.
+    Return an int array of shape (nlayers, ny, nx)
+    """
+    labels = [np.zeros(imshape, dtype=np.int32)]
+    for i, shape in enumerate(region):
+        bbox = _shape_bbox(shape, imshape)
+        if bbox is None:
+            y0, y1, x0, x1 = 0, imshape[0], 0, imshape[1]
+            mask = pyregion.ShapeList([shape]).get_mask(shape=imshape)
+        else:
+            y0, y1, x0, x1 = bbox
+            if y1 <= y0 or x1 <= x0: continue # outside the image
+            shape = copy.deepcopy(shape)
+            if shape.name == 'polygon':
+                shape.coord_list[::2] = [x-x0 for x in shape.coord_list[::2]]
+                shape.coord_list[1::2] = [y-y0 for y in shape.coord_list[1::2]]
+            else:
+                shape.coord_list[0] -= x0
+                shape.coord_list[1] -= y0
+            mask = pyregion.ShapeList([shape]).get_mask(shape=(y1-y0, x1-x0))
+        for layer in labels:
+            if not np.any(layer[y0:y1,x0:x1][mask]): break
+        else:
+            layer = np.zeros(imshape, dtype=np.int32)
+            labels.append(layer)
+        layer[y0:y1,x0:x1][mask] = i+1
+    return np.array(labels)
+
+def labelled_sum(labels, nregions, weights=None, valid=None):
+    """
+    Sum weights over every region and channel with a single bincount per label layer.
+    labels: (nlayers, ny, nx) from region_labels()
+    weights: (nchan, ny, nx) values to sum, if None count pixels
+    valid: bool (nchan, ny, nx) or (ny, nx), pixels to use
+    Return array (nchan, nregions)
+    """
+    shapes = [a.shape for a in (weights, valid) if a is not None and a.ndim == 3]
+    shape = np.broadcast_shapes(*shapes) if shapes else (1,)+labels.shape[1:]
+    nchan, nbin = shape[0], nregions+1
+    offset = (np.arange(nchan)*nbin)[:,None,None]
+    if weights is not None: weights = np.broadcast_to(weights, shape)
+    if valid is not None: valid = np.broadcast_to(valid, shape)
+    out = np.zeros(nchan*nbin)
+    for layer in labels:
+        idx = np.broadcast_to(layer+offset, shape)
+        w = weights
+        if valid is not None:
+            idx = idx[valid]
+            if w is not None: w = w[valid]
+        out += np.bincount(idx.ravel(), weights=None if w is None else w.ravel(), minlength=nchan*nbin)
+    return out.reshape(nchan, nbin)[:,1:]
+
 class RadioImage(Image):
 
     def __init__(self, imagefile):
@@ -47,12 +122,27 @@ class RadioImage(Image):
         logging.info('Beam area is',self.barea,'pixels')
 
         self.masks = []
+        self.labels = None
 
 
-    def set_region(self, regionfile, individual=False):
+    def set_region(self, regionfile, individual=False, labels=False):
+        """
+        regionfile: ds9 region file
+        individual: one region per shape, otherwise one region for the whole file
+        labels: store all regions in a single integer label map (see region_labels()) instead of one full-size
+                mask per region, fluxes are then extracted in one pass (for large catalogues of regions)
+        """
         self.masks = []
+        self.labels = None
         region = pyregion.open(regionfile).as_imagecoord(self.img_hdr)
-        if individual:
+        if labels:
+            if individual:
+                self.labels = region_labels(region, np.shape(self.img_data))
+                self.nregions = len(region)
+            else:
+                self.labels = region.get_mask(hdu=self.hdu,shape=np.shape(self.img_data)).astype(np.int32)[np.newaxis]
+                self.nregions = 1
+        elif individual:
             for region_split in region:
                 self.masks.append( pyregion.ShapeList([region_split]).get_mask(hdu=self.hdu,shape=np.shape(self.img_data)) )
         else:
@@ -62,12 +152,14 @@ class RadioImage(Image):
     def set_region_noise(self, regionfile):
         self.region_noise = regionfile
 
-    def get_flux(self, flux_scale_err = 0, nsigma = 0, with_upper_limits = False, upper_limit_sigma = 3):
+    def get_flux(self, flux_scale_err = 0, nsigma = 0, with_upper_limits = False, upper_limit_sigma = 3, covariance = False):
         """
         flux_scale_err = percentage of error to add to the flux scale (e.g. 0.05 to have a 5% error)
         nsigma: use only pixels above this sigma
         with_upper_limits: if no detection, set the value at upper_limit_sigma sigma. It also returns a bool array with True for limits
         upper_limit_sigma: numer of sigmas to consider a flux a limit (default: 3)
+        covariance: rms error from the sum of the pixel covariance matrix (see pixel_covariance_matrix) instead of
+                    noise*sqrt(npix/beam area)
         """
 
         # set self.noise
@@ -76,16 +168,30 @@ class RadioImage(Image):
         else:
             self.calc_noise(bg_reg = self.region_noise)
 
-        fluxes = []
-        errors = []
-        for mask in self.masks:
-            mask = np.logical_and(mask, ~np.isnan(self.img_data))
-            flux = np.nansum( self.img_data[mask] ) / self.barea
-            error_rms = self.noise * np.sqrt( np.count_nonzero(mask) / self.barea )
-            error_flux = flux_scale_err*flux
-            error = np.sqrt(error_rms**2+error_flux**2)
-            fluxes.append(flux)
-            errors.append(error)
+        if self.labels is not None and not covariance:
+            # all regions in one pass
+            valid = ~np.isnan(self.img_data)
+            npix = labelled_sum(self.labels, self.nregions, valid=valid)[0]
+            fluxes = labelled_sum(self.labels, self.nregions, weights=self.img_data[np.newaxis], valid=valid)[0] / self.barea
+            error_rms = self.noise * np.sqrt( npix / self.barea )
+            errors = np.sqrt(error_rms**2+(flux_scale_err*fluxes)**2)
+        else:
+            masks = self.masks
+            if self.labels is not None:
+                masks = [np.any(self.labels == i+1, axis=0) for i in range(self.nregions)]
+            fluxes = []
+            errors = []
+            for mask in masks:
+                mask = np.logical_and(mask, ~np.isnan(self.img_data))
+                flux = np.nansum( self.img_data[mask] ) / self.barea
+                if covariance:
+                    error_rms = np.sqrt( self.pixel_covariance_matrix(mask).sum() ) / self.barea
+                else:
+                    error_rms = self.noise * np.sqrt( np.count_nonzero(mask) / self.barea )
+                error_flux = flux_scale_err*flux
+                error = np.sqrt(error_rms**2+error_flux**2)
+                fluxes.append(flux)
+                errors.append(error)
 
         fluxes = np.array(fluxes)
         errors = np.array(errors)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# use:
+
+# ref = SkyIndex.from_catalogue('FIRST.fits', columns=['FINT','FPEAK'], cachedir='cache')
+# idx, sep = ref.match(ra, dec) # nearest neighbours, sep in deg
+# idx_list = ref.query_radius(ra, dec, 10/3600.) # all sources within 10"
+
+import os, hashlib, pickle, logging
+import numpy as np
+from scipy.spatial import cKDTree
+
+def radec2xyz(ra, dec):
+    """
+    Unit vectors of ra, dec in deg
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+
+def chord2sep(chord):
+    """
+    Angular separation in deg from the distance between unit vectors
+    """
+    return np.degrees(2*np.arcsin(np.clip(chord/2., 0, 1)))
+
+def sep2chord(sep):
+    """
+    Distance between unit vectors from the angular separation in deg
+    """
+    return 2*np.sin(np.radians(sep)/2.)
+
+
+class SkyIndex(object):
+    """
+    KD-tree of the unit vectors of a catalogue, built once and reused for many cross-matches.
+    """
+
+    def __init__(self, ra, dec, data=None):
+        """
+        ra, dec: coordinates in deg
+        data: dict of other columns (arrays of the same length) carried along, e.g. fluxes
+        """
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.data = {} if data is None else {k: np.asarray(v) for k, v in data.items()}
+        self.tree = cKDTree(radec2xyz(self.ra, self.dec))
+        self._neighbour_sep = None
+        self._subsets = {}
+
+    def __len__(self):
+        return len(self.ra)
+
+    def __getitem__(self, col):
+        if col == 'RA': return self.ra
+        if col == 'DEC': return self.dec
+        return self.data[col]
+
+    @classmethod
+    def from_catalogue(cls, catalogue, columns=[], ra_col='RA', dec_col='DEC', cachedir=None):
+        """
+        Build the index of a catalogue file (any format read by astropy Table).
+        If cachedir is given the index is saved there and reused as long as the catalogue file is unchanged.
+        columns: other columns to keep
+        """
+        cachefile = None
+        if cachedir is not None:
+            st = os.stat(catalogue)
+            key = hashlib.sha1(('%s %i %f %s %s %s' % (os.path.abspath(catalogue), st.st_size, st.st_mtime,
+                                                      ra_col, dec_col, sorted(columns))).encode()).hexdigest()
+            cachefile = os.path.join(cachedir, 'skyindex-%s.pickle' % key)
+            if os.path.exists(cachefile):
+                logging.debug('Load sky index of %s from %s.' % (catalogue, cachefile))
+                with open(cachefile, 'rb') as f:
+                    return pickle.load(f)
+
+        from astropy.table import Table
+        t = Table.read(catalogue)
+        index = cls(t[ra_col], t[dec_col], {c: t[c] for c in columns})
+        logging.debug('Sky index of %s: %i sources.' % (catalogue, len(index)))
+        if cachefile is not None:
+            if not os.path.exists(cachedir): os.makedirs(cachedir)
+            with open(cachefile+'.tmp', 'wb') as f:
+                pickle.dump(index, f)
+            os.replace(cachefile+'.tmp', cachefile)
+        return index
+
+    def match(self, ra, dec, nthneighbor=1):
+        """
+        Batched version of astropy match_coordinates_sky(): for every ra, dec (deg) return
+        the index of the nth nearest source and its separation in deg
+        """
+        if len(self) == 0 or len(np.atleast_1d(ra)) == 0:
+            return np.zeros(len(np.atleast_1d(ra)), dtype=int), np.full(len(np.atleast_1d(ra)), np.inf)
+        chord, idx = self.tree.query(radec2xyz(ra, dec), k=[nthneighbor])
+        return idx[...,0], chord2sep(chord[...,0])
+
+    def query_radius(self, ra, dec, radius):
+        """
+        For every ra, dec (deg) return the array of indices of the sources within radius (deg)
+        """
+        return [np.array(idx, dtype=int) for idx in self.tree.query_ball_point(radec2xyz(ra, dec), sep2chord(radius))]
+
+    def neighbour_sep(self):
+        """
+        Separation in deg of every source from its nearest neighbour in the catalogue (computed once)
+        """
+        if self._neighbour_sep is None:
+            self._neighbour_sep = self.match(self.ra, self.dec, nthneighbor=2)[1]
+        return self._neighbour_sep
+
+    def subset(self, mask):
+        """
+        Index of the selected sources (boolean mask), kept to be reused for the same mask
+        """
+        mask = np.asarray(mask, dtype=bool)
+        key = hashlib.sha1(mask.tobytes()).hexdigest()
+        if key not in self._subsets:
+            self._subsets[key] = SkyIndex(self.ra[mask], self.dec[mask], {k: v[mask] for k, v in self.data.items()})
+        return self._subsets[key]
+
+    def __getstate__(self):
+        # do not save the subsets
+        state = self.__dict__.copy()
+        state['_subsets'] = {}
+        return state
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# use:
+
+# tec, dtec = fit_tec(phases, weights, freqs) # phases: (..., nfreq), e.g. (time, ant, freq)
+# tec, dtec = fit_tec(phases, weights, freqs, ncpu=8) # split the first axis on 8 processes
+
+import logging
+import multiprocessing as mp
+import numpy as np
+
+TECCONST = 8.44797245e9 # phase [rad] = TECCONST * TEC [TECU] / freq [Hz]
+
+def tec_cost(tec, phases, weights, freq):
+    """
+    Wrapped-phase cost of TEC values: sum over freq of the squared par1complex residuals
+    ( |cos(model) - cos(phases)| + |sin(model) - sin(phases)| ) * weights
+    tec: (..., ntec) trial values
+    phases, weights: (..., nfreq)
+    freq: (nfreq)
+    Return cost (..., ntec)
+    """
+    model = TECCONST * tec[..., np.newaxis] / freq # (..., ntec, nfreq)
+    phases = phases[..., np.newaxis, :]
+    res = ( np.abs(np.cos(model) - np.cos(phases)) + np.abs(np.sin(model) - np.sin(phases)) ) * weights[..., np.newaxis, :]
+    return np.sum(res**2, axis=-1)
+
+
+def _fit_tec(phases, weights, freq, tecrange, tecstep, nrefine, maxsize):
+    """
+    Grid search + local refinement on 2D arrays (nsol, nfreq), see fit_tec()
+    """
+    nsol, nfreq = phases.shape
+    grid = np.arange(tecrange[0], tecrange[1]+tecstep/2., tecstep)
+    chunk = max(1, int(maxsize // (len(grid)*nfreq)))
+
+    # dense grid, in chunks of solutions to limit memory
+    tec = np.zeros(nsol)
+    for i in range(0, nsol, chunk):
+        cost = tec_cost(grid, phases[i:i+chunk], weights[i:i+chunk], freq)
+        tec[i:i+chunk] = grid[np.argmin(cost, axis=-1)]
+
+    # zoom around the minimum, 10x finer at every step
+    step = tecstep
+    offsets = np.arange(-10, 11)
+    for r in range(nrefine):
+        step /= 10.
+        trial = tec[:, np.newaxis] + step*offsets
+        cost = tec_cost(trial, phases, weights, freq)
+        tec = trial[np.arange(nsol), np.argmin(cost, axis=-1)]
+
+    # parabola through the minimum and its neighbours: sub-step position and curvature
+    trial = tec[:, np.newaxis] + step*np.array([-1, 0, 1])
+    c_m, c_0, c_p = tec_cost(trial, phases, weights, freq).T
+    curv = (c_p - 2*c_0 + c_m) / step**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(curv > 0, -(c_p - c_m) / (2*step*curv), 0)
+        tec += np.clip(shift, -step, step)
+        cmin = tec_cost(tec[:, np.newaxis], phases, weights, freq)[:, 0]
+        # as leastsq: cov = (J^T J)^-1 * residual variance, with d2cost/dtec2 = 2 J^T J
+        dtec = np.sqrt( 2./curv * cmin/max(nfreq-1, 1) )
+    dtec[~(curv > 0)] = np.inf
+    nodata = ~np.any(weights != 0, axis=-1)
+    tec[nodata] = 0
+    dtec[nodata] = np.inf
+    return tec, dtec
+
+
+def _fit_tec_star(args):
+    return _fit_tec(*args)
+
+
+def fit_tec(phases, weights, freq, tecrange=(-0.5, 0.5), tecstep=1e-3, nrefine=2, ncpu=1, maxsize=1e7):
+    """
+    Fit a single TEC to the wrapped phases of many solutions (e.g. all antennas and timesteps) at once:
+    the par1complex cost (see tec_cost()) is evaluated on a dense TEC grid as one broadcast array,
+    then the best value is refined locally.
+    phases, weights: (..., nfreq) the last axis is frequency, non-finite weights are treated as 0
+    freq: (nfreq) in Hz
+    tecrange: TEC range to search [TECU]
+    tecstep: step of the dense grid [TECU], must be smaller than the width of the minimum (~0.001 for LBA)
+    nrefine: number of 10x finer local grids
+    ncpu: split the first axis (e.g. time) in chunks processed in parallel
+    maxsize: max number of elements of the grid cost array per chunk
+    Return tec, dtec with shape phases.shape[:-1], dtec is inf where the minimum is not defined
+    (tec is 0 if all weights are 0)
+    """
+    phases = np.asarray(phases, dtype=float)
+    weights = np.broadcast_to(np.asarray(weights, dtype=float), phases.shape)
+    weights = np.where(np.isfinite(weights), weights, 0)
+    freq = np.asarray(freq, dtype=float)
+    shape = phases.shape[:-1]
+    nfreq = phases.shape[-1]
+
+    if ncpu > 1 and len(shape) > 0 and shape[0] > 1:
+        chunks = np.array_split(np.arange(shape[0]), min(ncpu, shape[0]))
+        args = [(phases[c].reshape(-1, nfreq), weights[c].reshape(-1, nfreq), freq, tecrange, tecstep, nrefine, maxsize) for c in chunks]
+        logging.debug('Fit TEC of %i solutions on %i processes.' % (np.prod(shape), len(chunks)))
+        with mp.Pool(len(chunks)) as p:
+            res = p.map(_fit_tec_star, args)
+        tec = np.concatenate([r[0] for r in res])
+        dtec = np.concatenate([r[1] for r in res])
+    else:
+        tec, dtec = _fit_tec(phases.reshape(-1, nfreq), weights.reshape(-1, nfreq), freq, tecrange, tecstep, nrefine, maxsize)
+
+    return tec.reshape(shape), dtec.reshape(shape)
+
+
+def test_fit_tec():
+    rng = np.random.default_rng(1)
+    freq = np.linspace(40e6, 70e6, 60)
+    tec_true = rng.uniform(-0.4, 0.4, (5, 7))
+    sigma = 0.3
+    phases = TECCONST * tec_true[..., np.newaxis] / freq + rng.normal(0, sigma, (5, 7, len(freq)))
+    phases = np.angle(np.exp(1j*phases))
+    tec, dtec = fit_tec(phases, np.ones_like(phases), freq)
+    assert np.all(np.abs(tec - tec_true) < 5*dtec), np.max(np.abs(tec - tec_true)/dtec)
+    assert np.all(dtec < 1e-3)
+    tec2, dtec2 = fit_tec(phases, np.ones_like(phases), freq, ncpu=2)
+    assert np.allclose(tec, tec2) and np.allclose(dtec, dtec2)
@@ -8,6 +8,7 @@ import numpy as np
 import sys
 import warnings
 from lib_linearfit import *
+from lib_radio import region_labels, labelled_sum
 
 def flatten(f,channel=0,freqaxis=0):
     """ Flatten a fits file so that it becomes a 2D image. Return new header and data """
@@ -46,7 +47,7 @@ def flatten(f,channel=0,freqaxis=0):
             slice.append(0)
         
     # slice=(0,)*(naxis-2)+(np.s_[:],)*2
-    return header,f[0].data[slice]
+    return header,f[0].data[tuple(slice)]
 
 class RadioError(Exception):
     """Base class for exceptions in this module."""
@@ -247,6 +248,77 @@ class applyregion:
             else:
                 self.error.append(0.)
 
+class regionstats:
+    """ per-region results of applyregions, same attributes as applyregion """
+    def __init__(self,rm):
+        self.rm = rm
+
+class applyregions:
+    """ apply every shape of a pyregion ShapeList to a radiomap as separate regions, in one pass over all channels """
+    def __init__(self,rm,region,offsource=None,mask=None,robustrms=3):
+        """
+        provides:
+        regions -- list of regionstats (one per shape) with the same quantities of applyregion
+        """
+        self.rm = rm
+        n = len(region)
+        d = np.array(rm.d)
+        nchan = len(d)
+        labels = region_labels(region, d.shape[1:])
+        pixels = labelled_sum(labels, n)[0]
+        valid = ~np.isnan(d)
+        if mask is not None: valid &= np.array(mask, dtype=bool).reshape(d.shape)
+        d = np.where(valid, d, 0)
+        # per-region values to pixels, column 0 is outside any region
+        pad = lambda v: np.concatenate([np.zeros((nchan,1)), np.nan_to_num(v)], axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            npix = labelled_sum(labels, n, valid=valid)
+            flux = labelled_sum(labels, n, weights=d, valid=valid)
+            mean = flux/npix
+            # rms around the mean, then again only with pixels below robustrms*rms (cut sources)
+            rms = np.zeros((nchan,n)); rnpix = np.zeros((nchan,n)); rsum = np.zeros((nchan,n))
+            for layer in labels:
+                rms += labelled_sum(layer[np.newaxis], n, weights=(d-pad(mean)[:,layer])**2, valid=valid)
+            rms = np.sqrt(rms/npix)
+            robust = []
+            for layer in labels:
+                robust.append(valid & (d < robustrms*pad(rms)[:,layer]))
+                rnpix += labelled_sum(layer[np.newaxis], n, valid=robust[-1])
+                rsum += labelled_sum(layer[np.newaxis], n, weights=d, valid=robust[-1])
+            robrms = np.zeros((nchan,n))
+            for layer, cut in zip(labels, robust):
+                robrms += labelled_sum(layer[np.newaxis], n, weights=(d-pad(rsum/rnpix)[:,layer])**2, valid=cut)
+            robrms = np.sqrt(robrms/rnpix)
+
+        # max and min, unbuffered on the labels of all channels
+        dmax = np.full(nchan*(n+1), -np.inf)
+        dmin = np.full(nchan*(n+1), np.inf)
+        offset = (np.arange(nchan)*(n+1))[:,None,None]
+        for layer in labels:
+            idx = (layer+offset)[valid]
+            np.maximum.at(dmax, idx, d[valid])
+            np.minimum.at(dmin, idx, d[valid])
+        dmax = dmax.reshape(nchan,n+1)[:,1:]
+        dmin = dmin.reshape(nchan,n+1)[:,1:]
+
+        self.regions = []
+        for j in range(n):
+            r = regionstats(rm)
+            r.rms = list(rms[:,j])
+            r.max = list(dmax[:,j])
+            r.min = list(dmin[:,j])
+            r.robustrms = list(robrms[:,j])
+            r.flux = list(flux[:,j]/rm.area)
+            r.mean = list(mean[:,j])
+            with np.errstate(invalid='ignore'):
+                r.mean_error = list(np.sqrt(mean[:,j]/np.sqrt(npix[:,j])))
+            if offsource is not None:
+                r.error = [offsource[i]*np.sqrt(pixels[j]/rm.area) for i in range(nchan)]
+            else:
+                r.error = [0.]*nchan
+            self.regions.append(r)
+
 def printflux(fgss,fluxerr=None):
     """
     fgss -- region to work on, 2d array [ radiomeasure x region ]
@@ -336,10 +408,7 @@ def radioflux(files,fgr,bgr=None,individual=False,action='Flux',fluxerr=0,nsigma
     for i, rm in enumerate(rms):
         fg_ir=pyregion.open(fgr).as_imagecoord(rm.headers[0])
         if individual:
-            fgs.append([])
-            for fg_ir_split in fg_ir:
-                fg=pyregion.ShapeList([fg_ir_split])
-                fgs[-1].append(applyregion(rm,fg,offsource=bgs[i],mask=mask))
+            fgs.append(applyregions(rm,fg_ir,offsource=bgs[i],mask=mask).regions)
         else:
             fgs.append([applyregion(rm,fg_ir,offsource=bgs[i],mask=mask)])
 
@@ -49,6 +49,11 @@ parser.add_argument('--find_noise', dest='find_noise', action='store_true', help
 parser.add_argument('--use_channel', dest='use_channel', type=int, default=0, help='Channel to be used in a cube image (default: 0)')
 parser.add_argument('--use_stokes', dest='use_stokes', type=int, default=0, help='Stokes to be used in a cube image (default: 0)')
 parser.add_argument('--save', dest='save', action='store_true', help='Save intermediate results (default: False)')
+parser.add_argument('--tiled', dest='tiled', action='store_true', help='Reproject each direction only on the part of the mosaic it covers (default: False)')
+parser.add_argument('--ncpu', dest='ncpu', default=1, type=int, help='Number of directions to reproject in parallel (default: 1)')
+parser.add_argument('--cache', dest='cache', help='Directory where to cache reprojected images, weights and noise estimates among runs (default: do not cache)')
+parser.add_argument('--cache_size', dest='cache_size', type=float, default=50, help='Max size of the reprojection cache in GB (default: 50)')
+parser.add_argument('--memmap', dest='memmap', action='store_true', help='Keep the mosaic accumulators memory-mapped on disk, useful for very large mosaics (default: False)')
 parser.add_argument('--output', dest='output', default='mosaic.fits', help='Name of output mosaic (default: mosaic.fits)')
 
 args = parser.parse_args()
@@ -79,6 +84,18 @@ if args.mask is not None:
     logging.debug('Reading mask: %s.' % args.mask)
     mask_n = pyfits.open(args.mask)[0]
 
+if args.cache is not None:
+    from lib_cache import ReprojCache, NoiseCache
+    cache = ReprojCache(args.cache, maxsize=args.cache_size)
+    noise_cache = NoiseCache(os.path.join(args.cache, 'noise.pickle'))
+else:
+    noise_cache = None
+
+if args.shift:
+    # one index of the reference catalogue for all directions
+    from lib_skyindex import SkyIndex
+    ref_index = SkyIndex.from_catalogue(ref_catalog, columns=['FINT','FPEAK'], cachedir=args.cache)
+
 if args.shift and not args.beamcorr:
     logging.warning('Attempting shift calculation on beam corrected images, this is not the best.')
 
@@ -104,8 +121,9 @@ class Direction(Image):
         if self.beam_data.shape != self.img_data.shape:
             beamfile = self.imagefile+'__beam.fits'
             logging.warning('Beam and image shape are different, regrid beam...')
-            if not os.path.exists(beamfile):
-                beam_data, footprint = reproj((self.beam_data, self.beam_hdr), self.img_hdr,
+            # with the cache a changed beam/image is noticed and the file remade
+            if args.cache is not None or not os.path.exists(beamfile):
+                beam_data, footprint = reproject((self.beam_data, self.beam_hdr), self.img_hdr,
                                             order='bilinear')  # , parallel=True)
                 # save temp regridded beam
                 pyfits.writeto(beamfile, header=self.img_hdr, data=beam_data, overwrite=True)
@@ -135,11 +153,12 @@ class Direction(Image):
     def calc_shift(self, ref_cat, separation=15):
         """
         Find a shift cross-matching source extracted from the image and a given catalog
+        ref_cat: lib_skyindex.SkyIndex of the reference catalogue (with FINT and FPEAK columns) or the catalogue file
         separation in arcsec
         """
         import bdsf
-        from astropy.coordinates import match_coordinates_sky
-        from astropy.coordinates import SkyCoord
+        from astropy.coordinates import Angle
+        from lib_skyindex import SkyIndex
         import astropy.units as u
         from scipy.stats import gaussian_kde
         from astropy.stats import median_absolute_deviation
@@ -155,33 +174,29 @@ class Direction(Image):
             bdsf_img.write_catalog(outfile=img_cat, catalog_type='srl', format='fits', clobber=True)
 
         # read catlogue
-        ref_t = Table.read(ref_cat)
+        if not isinstance(ref_cat, SkyIndex):
+            ref_cat = SkyIndex.from_catalogue(ref_cat, columns=['FINT','FPEAK'])
         img_t = Table.read(img_cat)
-        logging.debug('SHIFT: Initial len: %i (ref:%i)' % (len(img_t),len(ref_t)))
+        logging.debug('SHIFT: Initial len: %i (ref:%i)' % (len(img_t),len(ref_cat)))
  
         # reduce to isolated sources LOFAR
-        idx_match, sep, _ = match_coordinates_sky(SkyCoord(img_t['RA'], img_t['DEC']),\
-                                                  SkyCoord(img_t['RA'], img_t['DEC']), nthneighbor=2)
+        sep = SkyIndex(img_t['RA'], img_t['DEC']).neighbour_sep()*u.deg
     
         idx_match_img = np.arange(0,len(img_t))[sep>3*self.get_beam()[0]*u.arcsec]
         img_t = img_t[idx_match_img]
-        # reduce to isolated sources REF
-        idx_match, sep, _ = match_coordinates_sky(SkyCoord(ref_t['RA'], ref_t['DEC']),\
-                                                  SkyCoord(ref_t['RA'], ref_t['DEC']), nthneighbor=2)
-    
-        idx_match_ref = np.arange(0,len(ref_t))[sep>self.get_beam()[0]*u.arcsec]
-        ref_t = ref_t[idx_match_ref]
-        logging.debug('SHIFT: After isaolated sources len: %i (ref:%i)' % (len(img_t),len(ref_t)))
+        # reduce to isolated sources REF (neighbour separations are computed once per catalogue)
+        isolated_ref = ref_cat.neighbour_sep()*u.deg > self.get_beam()[0]*u.arcsec
+        logging.debug('SHIFT: After isaolated sources len: %i (ref:%i)' % (len(img_t),np.sum(isolated_ref)))
     
         # reduce to compact sources
         img_t = img_t[ (img_t['S_Code'] == 'S') ]
         img_t = img_t[ (img_t['Total_flux']/img_t['Peak_flux']) < 2 ]
-        ref_t = ref_t[ (ref_t['FINT']/ref_t['FPEAK']) < 1.2 ]
+        ref_t = ref_cat.subset( isolated_ref & ((ref_cat['FINT']/ref_cat['FPEAK']) < 1.2) )
         logging.debug('SHIFT: After compact source len: %i (ref:%i)' % (len(img_t),len(ref_t)))
     
         # cross match
-        idx_match, sep, _ = match_coordinates_sky(SkyCoord(img_t['RA'], img_t['DEC']),\
-                                                  SkyCoord(ref_t['RA'], ref_t['DEC']))
+        idx_match, sep = ref_t.match(img_t['RA'], img_t['DEC'])
+        sep = Angle(sep, unit=u.deg)
     
         sep_mad = median_absolute_deviation(sep[np.where(sep < (3*self.get_beam()[0])*u.deg)])
         sep_med = np.median(sep[np.where(sep < (3*self.get_beam()[0])*u.deg)])
@@ -228,6 +243,48 @@ class Direction(Image):
         #if not args.save:
         #    os.system('rm '+img_cat)
 
+def reproject(input_data, output_projection, **kwargs):
+    """
+    Reproject using the cache if requested
+    """
+    if args.cache is None:
+        return reproj(input_data, output_projection, **kwargs)
+    else:
+        return cache.reproject(input_data, output_projection, method='interp', **kwargs)
+
+def get_tile(d, regrid_hdr, pad=2):
+    """
+    Return the part of the output grid covered by the non-zero pixels of a direction
+    as (y0, y1, x0, x1) in output pixels
+    """
+    ys, xs = np.where(d.img_data)
+    if len(xs) == 0: return 0, 0, 0, 0
+    axmin, axmax, aymin, aymax = xs.min(), xs.max(), ys.min(), ys.max()
+    del(xs)
+    del(ys)
+    # sample the whole border, straight edges are not straight in the output projection
+    n = 100
+    bx = np.concatenate([np.linspace(axmin,axmax,n), np.full(n,axmax), np.linspace(axmin,axmax,n), np.full(n,axmin)])
+    by = np.concatenate([np.full(n,aymin), np.linspace(aymin,aymax,n), np.full(n,aymax), np.linspace(aymin,aymax,n)])
+    ra, dec = d.get_wcs().wcs_pix2world(bx, by, 0)
+    nx, ny = pywcs(regrid_hdr, naxis=2).wcs_world2pix(ra, dec, 0)
+    x0 = max(0, int(np.floor(np.nanmin(nx)))-pad)
+    x1 = min(regrid_hdr['NAXIS1'], int(np.ceil(np.nanmax(nx)))+pad+1)
+    y0 = max(0, int(np.floor(np.nanmin(ny)))-pad)
+    y1 = min(regrid_hdr['NAXIS2'], int(np.ceil(np.nanmax(ny)))+pad+1)
+    return y0, y1, x0, x1
+
+def get_tile_header(regrid_hdr, y0, y1, x0, x1):
+    """
+    Return the header of a cutout of the output grid
+    """
+    tile_hdr = regrid_hdr.copy()
+    tile_hdr['NAXIS1'] = x1-x0
+    tile_hdr['NAXIS2'] = y1-y0
+    tile_hdr['CRPIX1'] -= x0
+    tile_hdr['CRPIX2'] -= y0
+    return tile_hdr
+
 logging.info('Reading files...')
 directions = []
 beams = []
@@ -256,11 +313,15 @@ if args.beamarm:
     logging.debug('Minimum common beam: %.1f" %.1f" (pa %.1f deg)' % \
              (common_beam[0]*3600., common_beam[1]*3600., common_beam[2]))
 
+    # kernels of all directions at once, the invalid ones (e.g. same beam) are left to Image.convolve
+    from lib_beamdeconv import deconvolve_ell_vec
+    kernels, valid = deconvolve_ell_vec(common_beam, beams)
+
 
 for i, d in enumerate(directions):
 
     if args.beamarm:
-        d.convolve(common_beam)
+        d.convolve(common_beam, convolve_beam=kernels[i] if valid[i] else None)
 
     if args.beams is not None:
         d.set_beam_file(args.beams[i])
@@ -270,7 +331,7 @@ for i, d in enumerate(directions):
         d.apply_region(args.regions[i], blankvalue=0, invert=True)
 
     if args.noises is not None: d.noise = args.noises[i]
-    elif args.find_noise: d.calc_noise(force_recalc=True) # after beam cut/mask
+    elif args.find_noise: d.calc_noise(force_recalc=True, cache=noise_cache) # after beam cut/mask
 
     if args.scales is not None: d.scale = args.scales[i]
 
@@ -279,7 +340,7 @@ for i, d in enumerate(directions):
     d.calc_weight() # after setting: beam, noise, scale
 
     if args.shift:
-        d.calc_shift(ref_catalog)
+        d.calc_shift(ref_index)
 
 
 # prepare header for final gridding
@@ -346,60 +407,95 @@ else:
         sys.exit(1)
 
 logging.info('Making mosaic...')
-isum = np.zeros([ysize,xsize])
-wsum = np.zeros_like(isum)
-mask = np.zeros_like(isum,dtype=np.bool)
+if args.memmap:
+    # accumulators on disk next to the output, removed at the end
+    accfile = os.path.splitext(args.output)[0]+'-%s.npy'
+    isum = np.lib.format.open_memmap(accfile % 'isum', mode='w+', dtype=float, shape=(ysize,xsize))
+    wsum = np.lib.format.open_memmap(accfile % 'wsum', mode='w+', dtype=float, shape=(ysize,xsize))
+    mask = np.lib.format.open_memmap(accfile % 'mask', mode='w+', dtype=bool, shape=(ysize,xsize))
+else:
+    isum = np.zeros([ysize,xsize])
+    wsum = np.zeros_like(isum)
+    mask = np.zeros_like(isum,dtype=bool)
 if args.mask is not None:
     logging.debug('Reprojecting mask...')
     outname = args.mask.replace('.fits','-reproj.fits')
-    if os.path.exists(outname):
-        logging.debug('Loading %s...' % outname)
-        mask_n = pyfits.open(outname)[0]
-    else:
-        mask_n.data, footprint = reproj((mask_n.data, mask_n.header), regrid_hdr, order='bilinear')#, parallel=True)
-        if args.save:
-            pyfits.writeto(outname, header=regrid_hdr, data=mask_n.data, overwrite=True)
+    mask_n.data, footprint = reproject((mask_n.data, mask_n.header), regrid_hdr, order='bilinear')#, parallel=True)
+    if args.save:
+        pyfits.writeto(outname, header=regrid_hdr, data=mask_n.data, overwrite=True)
 
     # get numbers into mask in increasing order
     mask_numbers = sorted(np.unique(mask_n.data))
 
-for i, d in enumerate(directions):
+def reproject_direction(i):
+    """
+    Reproject image and weights of the i-th direction on its tile of the output grid
+    Return the tile slice, the image, the weights and the coverage mask (None if the tile is empty)
+    """
+    d = directions[i]
     logging.info('Working on: %s' % d.imagefile)
 
-    outname = d.imagefile.replace('.fits','-reproj.fits')
-    if os.path.exists(outname):
-        logging.debug('Loading %s...' % outname)
-        r = pyfits.open(outname)[0].data
+    if args.tiled:
+        y0, y1, x0, x1 = get_tile(d, regrid_hdr)
+        if y1 <= y0 or x1 <= x0:
+            logging.warning('%s: not covering the mosaic, skip.' % d.imagefile)
+            return None, None, None, None
+        logging.debug('Tile: x %i-%i y %i-%i' % (x0, x1, y0, y1))
     else:
-        logging.debug('Reprojecting data...')
-        r, footprint = reproj((d.img_data, d.img_hdr), regrid_hdr)#, parallel=True)
-        r[ np.isnan(r) ] = 0
-        if args.save:
-            pyfits.writeto(outname, header=regrid_hdr, data=r, overwrite=True)
-
-    outname = d.imagefile.replace('.fits','-reprojW.fits')
-    if os.path.exists(outname):
-        logging.debug('Loading %s...' % outname)
-        w = pyfits.open(outname)[0].data
-        mask |= (w>0)
-    else:
-        logging.debug('Reprojecting weights...')
-        w, footprint = reproj((d.weight_data, d.img_hdr), regrid_hdr)#, parallel=True)
-        mask |= ~np.isnan(w)
-        w[ np.isnan(w) ] = 0
-        if args.mask is not None:
-            w[mask_n.data != mask_numbers[i]] = 0
-        if args.save:
-            pyfits.writeto(outname, header=regrid_hdr, data=w, overwrite=True)
+        y0, y1, x0, x1 = 0, ysize, 0, xsize
+    tile = np.s_[y0:y1,x0:x1]
+    tile_hdr = get_tile_header(regrid_hdr, y0, y1, x0, x1)
+
+    logging.debug('Reprojecting data...')
+    r, footprint = reproject((d.img_data, d.img_hdr), tile_hdr)#, parallel=True)
+    r[ np.isnan(r) ] = 0
+    if args.save:
+        pyfits.writeto(d.imagefile.replace('.fits','-reproj.fits'), header=tile_hdr, data=r, overwrite=True)
+
+    logging.debug('Reprojecting weights...')
+    w, footprint = reproject((d.weight_data, d.img_hdr), tile_hdr)#, parallel=True)
+    m = ~np.isnan(w)
+    w[ np.isnan(w) ] = 0
+    if args.mask is not None:
+        w[mask_n.data[tile] != mask_numbers[i]] = 0
+    if args.save:
+        pyfits.writeto(d.imagefile.replace('.fits','-reprojW.fits'), header=tile_hdr, data=w, overwrite=True)
+    return tile, r, w, m
+
+def add_to_mosaic(tile, r, w, m):
+    if tile is None: return
     logging.debug('Add to mosaic...')
-    isum += r*w
-    wsum += w
+    mask[tile] |= m
+    isum[tile] += r*w
+    wsum[tile] += w
+
+if args.ncpu > 1:
+    from lib_multiproc import multiprocManager
+    def funct(i, outQueue=None):
+        outQueue.put(reproject_direction(i))
+
+    # start processes for multi-thread
+    mpm = multiprocManager(args.ncpu, funct)
+    for i in range(len(directions)):
+        mpm.put([i])
+    # reduce as results arrive, but always adding directions in the same order
+    # so that the floating point sums do not depend on the scheduling
+    for r in mpm.get(ordered=True):
+        add_to_mosaic(*r)
+    mpm.wait()
+else:
+    for i in range(len(directions)):
+        add_to_mosaic(*reproject_direction(i))
 
 logging.debug('Write mosaic: %s...' % args.output)
 # mask now contains True where a non-nan region was present in either map
-isum[wsum != 0] /= wsum[wsum != 0]
-isum[wsum == 0] = np.nan
-isum[~mask] = np.nan
+# normalise few rows at a time to avoid full-size temporary arrays
+nrows = max(1, int(1e7/xsize))
+for y in range(0, ysize, nrows):
+    isum_r, wsum_r = isum[y:y+nrows], wsum[y:y+nrows]
+    isum_r[wsum_r != 0] /= wsum_r[wsum_r != 0]
+    isum_r[wsum_r == 0] = np.nan
+    isum_r[~mask[y:y+nrows]] = np.nan
 
 #set beam
 try:
@@ -416,4 +512,9 @@ regrid_hdr['UNITS'] = 'Jy/beam'
 
 pyfits.writeto(args.output, header=regrid_hdr, data=isum, overwrite=True)
 
+if args.memmap:
+    del isum, wsum, mask
+    for acc in ['isum','wsum','mask']:
+        os.remove(accfile % acc)
+
 logging.debug('Done.')
@@ -20,6 +20,7 @@
 import optparse
 import numpy
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import casacore.tables as pt
 from casacore.quanta import quantity
 
@@ -67,17 +68,51 @@ def setupiofiles(inms, outms, incolumn, outcolumn):
   return outms
 
 
-def mslin2circ(incol, outcol, outms, skipmetadata):
+# correlations out = M . in, applied to the last axis of (nrow, nchan, 4) blocks
+I = 1j
+LIN2CIRC = 0.5*numpy.array([[1, -I,  I,  1],
+                            [1,  I,  I, -1],
+                            [1, -I, -I, -1],
+                            [1,  I, -I,  1]])
+CIRC2LIN = 0.5*numpy.array([[ 1,  1,  1,  1],
+                            [ I, -I,  I, -I],
+                            [-I, -I,  I,  I],
+                            [ 1, -1, -1,  1]])
+
+def iterchunks(tc, col, chunkrows=0, bytesperrow=None):
+  """
+  Yield (startrow, nrow) to stream a table in blocks
+  chunkrows: rows per block, if 0 blocks of ~256 MB of col
+  """
+  if chunkrows <= 0:
+    if bytesperrow is None:
+      bytesperrow = numpy.asarray(tc.getcell(col, 0)).nbytes
+    chunkrows = max(1, int(256e6 // bytesperrow))
+  for startrow in range(0, tc.nrows(), chunkrows):
+    yield startrow, min(chunkrows, tc.nrows()-startrow)
+
+def convertcol(tc, incol, outcol, M, chunkrows=0, nthreads=1):
+  """
+  Convert the correlations of incol into outcol block by block (fixed memory)
+  M: 4x4 conversion matrix (LIN2CIRC or CIRC2LIN)
+  nthreads: split the matrix multiply of each block on threads
+  """
+  buf = None
+  with ThreadPoolExecutor(nthreads) as executor:
+    for startrow, nrow in iterchunks(tc, incol, chunkrows):
+      data = tc.getcol(incol, startrow=startrow, nrow=nrow)
+      if buf is None or buf.shape != data.shape:
+        buf = numpy.empty_like(data)
+        Mt = M.T.astype(data.dtype) # exact also in single precision
+      # matmul does not work in place on its input: write in a reused buffer
+      bounds = numpy.linspace(0, nrow, nthreads+1).astype(int)
+      list(executor.map(lambda i: numpy.matmul(data[bounds[i]:bounds[i+1]], Mt, out=buf[bounds[i]:bounds[i+1]]), range(nthreads)))
+      tc.putcol(outcol, buf, startrow=startrow, nrow=nrow)
+      print("Converted rows %i-%i of %i" % (startrow, startrow+nrow-1, tc.nrows()))
+
+def mslin2circ(incol, outcol, outms, skipmetadata, chunkrows=0, nthreads=1):
   tc = pt.table(outms, readonly=False, ack=False)
-  dataXY = tc.getcol(incol)
-  I=numpy.complex(0.0,1.0)
-  dataRL = 0.5* numpy.transpose(numpy.array([
-           +dataXY[:,:,0]-I*dataXY[:,:,1]+I*dataXY[:,:,2]+dataXY[:,:,3],
-           +dataXY[:,:,0]+I*dataXY[:,:,1]+I*dataXY[:,:,2]-dataXY[:,:,3],
-           +dataXY[:,:,0]-I*dataXY[:,:,1]-I*dataXY[:,:,2]-dataXY[:,:,3],
-           +dataXY[:,:,0]+I*dataXY[:,:,1]-I*dataXY[:,:,2]+dataXY[:,:,3]]),
-           (1,2,0))
-  tc.putcol(outcol,dataRL)
+  convertcol(tc, incol, outcol, LIN2CIRC, chunkrows, nthreads)
 
   #Change metadata information to be circular feeds
   if not skipmetadata:
@@ -90,17 +125,9 @@ def mslin2circ(incol, outcol, outms, skipmetadata):
 
   tc.close()
 
-def mscirc2lin(incol, outcol, outms, skipmetadata):
+def mscirc2lin(incol, outcol, outms, skipmetadata, chunkrows=0, nthreads=1):
   tc = pt.table(outms,readonly=False, ack=False)
-  dataRL = tc.getcol(incol)
-  I=numpy.complex(0.0,1.0)
-  dataXY = 0.5* numpy.transpose(numpy.array([
-              +dataRL[:,:,0]+dataRL[:,:,1]+dataRL[:,:,2]+dataRL[:,:,3],
-           I*(+dataRL[:,:,0]-dataRL[:,:,1]+dataRL[:,:,2]-dataRL[:,:,3]),
-           I*(-dataRL[:,:,0]-dataRL[:,:,1]+dataRL[:,:,2]+dataRL[:,:,3]),
-              +dataRL[:,:,0]-dataRL[:,:,1]-dataRL[:,:,2]+dataRL[:,:,3] ]),
-           (1,2,0))
-  tc.putcol(outcol,dataXY)
+  convertcol(tc, incol, outcol, CIRC2LIN, chunkrows, nthreads)
 
   #Change metadata information to be circular feeds
   if not skipmetadata:
@@ -114,33 +141,37 @@ def mscirc2lin(incol, outcol, outms, skipmetadata):
   tc.close()
 
 
-def mergeweights(outms):
+def mergeweights(outms, chunkrows=0):
   """
   Merge weights (weights become the average across the 4 polarizations)
   """
   print("WARNING: updating weights, cannot reverse to original.")
   tc = pt.table(outms,readonly=False, ack=False)
-  weights = tc.getcol('WEIGHT_SPECTRUM')
-  shape = weights.shape
-  # find the mean along the pol axis and then expand the array
-  weights = numpy.repeat(numpy.mean(weights, axis=2), 4, axis=1).reshape(shape)
-  tc.putcol('WEIGHT_SPECTRUM',weights)
+  for startrow, nrow in iterchunks(tc, 'WEIGHT_SPECTRUM', chunkrows):
+    weights = tc.getcol('WEIGHT_SPECTRUM', startrow=startrow, nrow=nrow)
+    # find the mean along the pol axis and then expand the array
+    weights[:] = numpy.mean(weights, axis=2, keepdims=True)
+    tc.putcol('WEIGHT_SPECTRUM', weights, startrow=startrow, nrow=nrow)
   tc.close()
 
 
-def mergeflags(outms):
+def mergeflags(outms, chunkrows=0):
   """
   Merge flags (if a pol is flagged, flag everything)
   """
   #taql("UPDATE $outms set FLAG=True where any(FLAG)")
   tc = pt.table(outms,readonly=False, ack=False)
-  flag = tc.getcol('FLAG')
-  print("Initial flags:", numpy.count_nonzero(flag))
-  shape = flag.shape
-  # find if any data is flagged along the pol axis and then expand the array
-  flag = numpy.repeat( numpy.any(flag, axis=2), 4, axis=1).reshape(shape)
-  print("Final flags:", numpy.count_nonzero(flag))
-  tc.putcol('FLAG',flag)
+  nflag_in = 0
+  nflag_out = 0
+  for startrow, nrow in iterchunks(tc, 'FLAG', chunkrows):
+    flag = tc.getcol('FLAG', startrow=startrow, nrow=nrow)
+    nflag_in += numpy.count_nonzero(flag)
+    # find if any data is flagged along the pol axis and then expand the array
+    flag[:] = numpy.any(flag, axis=2, keepdims=True)
+    nflag_out += numpy.count_nonzero(flag)
+    tc.putcol('FLAG', flag, startrow=startrow, nrow=nrow)
+  print("Initial flags:", nflag_in)
+  print("Final flags:", nflag_out)
   tc.close()
 
 
@@ -162,6 +193,8 @@ opt.add_option('-o','--outms',help='Output MS (format: ms:COLUMN, default ms: In
 opt.add_option('-r','--reverse',action="store_true",default=False,help='Convert from circular to linear')
 opt.add_option('-s','--skipmetadata',action="store_true",default=False,help='Skip setting the metadata correctly')
 opt.add_option('-w','--weights',action="store_true",default=False,help='Weights are updated to reflect the combined polarization (cannot be undone with -r)')
+opt.add_option('-c','--chunkrows',type='int',default=0,help='Rows processed at once (default: 0, blocks of ~256 MB)')
+opt.add_option('-n','--nthreads',type='int',default=1,help='Threads for the conversion of each block (default: 1)')
 options, arguments = opt.parse_args()
 
 if options.outms == '':
@@ -186,9 +219,9 @@ print("INFO: inms: "+inms+" (column: "+incolumn+")")
 print("INFO: outms: "+outms+" (column: "+outcolumn+")")
 
 if options.reverse == True:
-   mscirc2lin(incolumn, outcolumn, outms, options.skipmetadata)
+   mscirc2lin(incolumn, outcolumn, outms, options.skipmetadata, options.chunkrows, options.nthreads)
 else:
-   mslin2circ(incolumn, outcolumn, outms, options.skipmetadata)
-if options.weights: mergeweights(outms)
-mergeflags(outms)
+   mslin2circ(incolumn, outcolumn, outms, options.skipmetadata, options.chunkrows, options.nthreads)
+if options.weights: mergeweights(outms, options.chunkrows)
+mergeflags(outms, options.chunkrows)
 updatehistory(outms)
@@ -25,7 +25,7 @@ from astropy.coordinates import match_coordinates_sky
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 import pyregion
-from lib_linearfit import linear_fit, linear_fit_bootstrap
+from lib_linearfit import linear_fit_batch, linear_fit_bootstrap_multi
 from lib_fits import AllImages
 # https://github.com/astrofrog/reproject
 from reproject import reproject_interp, reproject_exact
@@ -47,6 +47,7 @@ parser.add_argument('--fluxerr', dest='fluxerr', type=float, help='Fractional fl
 parser.add_argument('--save', dest='save', action='store_true', help='Save intermediate results (default: false)')
 parser.add_argument('--sigma', dest='sigma', type=float, help='Restrict to pixels above this sigma in all images')
 parser.add_argument('--circbeam', dest='circbeam', action='store_true', help='Force final beam to be circular (default: False, use minimum common beam area)')
+parser.add_argument('--fftconv', dest='fftconv', action='store_true', help='Convolve images in the Fourier domain, faster for large beams (default: false)')
 parser.add_argument('--bootstrap', dest='bootstrap', action='store_true', help='Use bootstrap to estimate errors (default: use normal X|Y with errors)')
 parser.add_argument('--output', dest='output', default='spidx.fits', type=str, help='Name of output mosaic (default: spidx.fits)')
 
@@ -65,7 +66,7 @@ if np.all([os.path.exists(name.replace('.fits', '-conv-regrid.fits')) for name i
     regrid_hdr = all_images.images[0].img_hdr
 else:
     all_images = AllImages(args.images)
-    all_images.convolve_to(beam=args.beam, circbeam=args.circbeam)
+    all_images.convolve_to(beam=args.beam, circbeam=args.circbeam, fft=args.fftconv, ncpu=args.ncpu)
     if args.save: all_images.write('conv')
     regrid_hdr = all_images.regrid_common(size=args.size, region=args.region, radec=args.radec, action='regrid_header')
     if args.save: all_images.write('conv-regrid')
@@ -96,62 +97,72 @@ ysize = regrid_hdr['NAXIS2']
 frequencies = [ image.get_freq() for image in all_images ]
 if args.noise: 
     rmserr = np.array([ image.noise for image in all_images ])
-else: yerr = None
+else: rmserr = np.zeros(len(all_images))
 spidx_data = np.empty(shape=(ysize,xsize))
 spidx_data[:] = np.nan
 spidx_err_data = np.empty(shape=(ysize,xsize))
 spidx_err_data[:] = np.nan
 
+def get_yerr(val4reg):
+    """ error on the fluxes, val4reg has frequencies on first axis """
+    rms = rmserr.reshape((-1,)+(1,)*(np.ndim(val4reg)-1))
+    if args.fluxerr:
+        return np.sqrt((args.fluxerr*val4reg)**2+rms**2)
+    elif args.noise:
+        return rmserr
+    else:
+        return None
+
+def fit_block(i, val4reg):
+    """ fit all the valid pixels of a block of rows starting at row i, val4reg: (nimages, nrows, xsize) """
+    # skip pixels with nans or non-positive values in any image
+    with np.errstate(invalid='ignore'):
+        valid = np.all(val4reg > 0, axis=0)
+    val4reg = val4reg[:,valid]
+    yerr = get_yerr(val4reg)
+    if not args.bootstrap:
+        (a, b, sa, sb) = linear_fit_batch(x=frequencies, y=val4reg, yerr=yerr, tolog=True)
+        return [i, valid, a, sa]
+    # the bootstrap keeps all the realisations in memory, do few pixels at a time
+    a = np.empty(val4reg.shape[1]); sa = np.empty(val4reg.shape[1])
+    npix = max(1, int(1e7/(1000*len(val4reg))))
+    for p in range(0, val4reg.shape[1], npix):
+        if yerr is None: yerr_p = None
+        else: yerr_p = np.transpose(yerr[:,p:p+npix] if np.ndim(yerr) == 2 else yerr)
+        (a[p:p+npix], b, sa[p:p+npix], sb) = linear_fit_bootstrap_multi(x=frequencies, y=val4reg[:,p:p+npix].T, yerr=yerr_p, tolog=True)
+    return [i, valid, a, sa]
+
+def store_block(r, spidx_data, spidx_err_data):
+    i = r[0]; valid = r[1]; a = r[2]; sa = r[3]
+    spidx_data[i:i+len(valid)][valid] = a
+    spidx_err_data[i:i+len(valid)][valid] = sa
+
+nrows = max(1, int(1e7/(xsize*len(all_images))))
 if args.ncpu > 1:
     from lib_multiproc import multiprocManager
-    def funct(i,j,frequencies, val4reg, yerr, bootstrap, outQueue=None):
-        if bootstrap:
-            (a, b, sa, sb) = linear_fit_bootstrap(x=frequencies, y=val4reg, yerr=yerr, tolog=True)
-        else:
-            (a, b, sa, sb) = linear_fit(x=frequencies, y=val4reg, yerr=yerr, tolog=True)
-        outQueue.put([i,j,a,sa])
+    def funct(i, images, out, outQueue=None):
+        # images and results are in shared memory, only the row number is sent
+        store_block(fit_block(i, images.array[:,i:i+nrows]), out.array[0], out.array[1])
+        outQueue.put(i)
 
     # start processes for multi-thread
-    mpm = multiprocManager(args.ncpu, funct)
-    for i in range(ysize):
-        print('%i/%i' % (i+1,ysize), end='\r')
-        sys.stdout.flush()
-        for j in range(xsize):
-            val4reg = np.array([ image.img_data[i,j] for image in all_images ])
-            if np.isnan(val4reg).any() or (np.array(val4reg) < 0).any(): continue
-            # add flux error
-            if args.fluxerr: 
-                yerr = np.sqrt((args.fluxerr*val4reg)**2+rmserr**2)
-            else:
-                yerr = rmserr
-            if (np.array(val4reg) <= 0).any(): continue
-            mpm.put([i,j,frequencies, val4reg, yerr, args.bootstrap])
-
-    print("Computing...")
-    mpm.wait()
-    for r in mpm.get():
-        i = r[0]; j = r[1]; a = r[2]; sa = r[3]
-        spidx_data[i,j] = a
-        spidx_err_data[i,j] = sa
+    with multiprocManager(args.ncpu, funct) as mpm:
+        images = mpm.shared_array((len(all_images),ysize,xsize))
+        for k, image in enumerate(all_images):
+            images.array[k] = image.img_data
+        out = mpm.shared_array((2,ysize,xsize))
+        out.array[:] = np.nan
+        for i in range(0, ysize, nrows):
+            mpm.put([i, images, out])
+        print("Computing...")
+        mpm.wait()
+        spidx_data[:] = out.array[0]
+        spidx_err_data[:] = out.array[1]
 else:
-    for i in range(ysize):
-        print('%i/%i' % (i+1,ysize), end='\r')
+    for i in range(0, ysize, nrows):
+        print('%i/%i' % (min(i+nrows,ysize),ysize), end='\r')
         sys.stdout.flush()
-        for j in range(xsize):
-            val4reg = np.array([ image.img_data[i,j] for image in all_images ])
-            if np.isnan(val4reg).any() or (np.array(val4reg) < 0).any(): continue
-            # add flux error
-            if args.fluxerr: 
-                yerr = np.sqrt((args.fluxerr*val4reg)**2+rmserr**2)
-            else:
-                yerr = rmserr
-            if (np.array(val4reg) <= 0).any(): continue
-            if args.bootstrap:
-                (a, b, sa, sb) = linear_fit_bootstrap(x=frequencies, y=val4reg, yerr=yerr, tolog=True)
-            else:
-                (a, b, sa, sb) = linear_fit(x=frequencies, y=val4reg, yerr=yerr, tolog=True)
-            spidx_data[i,j] = a
-            spidx_err_data[i,j] = sa
+        store_block(fit_block(i, np.array([ image.img_data[i:i+nrows] for image in all_images ])), spidx_data, spidx_err_data)
 
 if 'FREQ' in regrid_hdr.keys():
     del regrid_hdr['FREQ']